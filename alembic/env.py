@@ -6,7 +6,10 @@ from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 
 from alembic import context
-from app.main import app
+# the models register their tables on Base.metadata. not app.main, which
+# would create_all the tables before the migrations get to run
+from app.authnz import models as authnz_models  # noqa: F401
+from app.reader import models as reader_models  # noqa: F401
 
 
 # this is the Alembic Config object, which provides
@@ -23,7 +26,6 @@ fileConfig(config.config_file_name)
 # target_metadata = mymodel.Base.metadata
 config.set_main_option(
     "sqlalchemy.url", "postgresql://%s:%s@%s:%d/%s" % (settings.DB_USER, settings.DB_PASS, settings.DB_HOST, settings.DB_PORT, settings.DB_NAME))
-fastapi_app = app
 
 target_metadata = Base.metadata
 
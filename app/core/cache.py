@@ -1,10 +1,18 @@
+import hashlib
 import json
+import logging
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List
 
 import redis
 
 from app.core.config import settings
 
 
+logger = logging.getLogger(__name__)
+
+
 class CustomRedis:
     def __init__(self, host=None, port=settings.REDIS_PORT, db=settings.REDIS_DB):
         if host is None:
@@ -12,11 +20,186 @@ class CustomRedis:
         self._redis = redis.Redis(host, port, db)
 
     def get(self, key: str):
-        return json.loads(self._redis.get(key))
+        data = self._redis.get(key)
+        return None if data is None else json.loads(data)
 
     def set(self, key: str, data, ttl: int):
-        return self._redis.set(key, json.dumps(data), ex=ttl)
+        # datetimes are stored as strings, pydantic parses them back
+        return self._redis.set(key, json.dumps(data, default=str), ex=ttl)
+
+    def get_many(self, keys: List[str]) -> list:
+        return self._redis.mget(keys) if keys else []
+
+    def set_missing(self, values: Dict[str, int], ttl: int):
+        # setnx in one round trip, values already set are kept
+        pipe = self._redis.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(key, value, nx=True, ex=ttl)
+        pipe.execute()
+
+    def incr_many(self, keys: Iterable[str], ttl: int):
+        pipe = self._redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(key)
+            pipe.expire(key, ttl)
+        pipe.execute()
+
+    def delete_many(self, keys: List[str]):
+        if keys:
+            self._redis.delete(*keys)
+
+    def hincr_many(self, name: str, counts: Dict[str, int]):
+        pipe = self._redis.pipeline(transaction=False)
+        for field, count in counts.items():
+            pipe.hincrby(name, field, count)
+        pipe.execute()
+
+    def hgetall(self, name: str) -> Dict[str, int]:
+        return {
+            field.decode("utf-8"): int(value)
+            for field, value in self._redis.hgetall(name).items()
+        }
+
+
+_redis = None
 
 
 def get_redis():
-    return CustomRedis()
+    # one client (and connection pool) per process
+    global _redis
+    if _redis is None:
+        _redis = CustomRedis()
+    return _redis
+
+
+class ResponseCache:
+    """
+    Read through cache of json serializable values, invalidated by versions
+
+    cached keys embed the current version of everything they depend on (a
+    feed, a user, an entry), so a write only has to bump a version and the
+    stale values are never read again and expire on their own, like the
+    versions do (CACHE_VERSION_TTL) once nothing bumps them. when redis is
+    unavailable every lookup is a miss and the database is used directly
+    """
+
+    VERSION_KEY = "cache:version:%s:%s"
+    STATS_KEY = "cache:stats"
+
+    def __init__(self, redis_client: CustomRedis = None):
+        self._redis = redis_client
+        # hits and misses not written to redis yet
+        self._counts = Counter()
+        self._counted_at = time.monotonic()
+
+    @property
+    def redis(self) -> CustomRedis:
+        return self._redis or get_redis()
+
+    def versions(self, kind: str, ids: List[int]) -> List[int]:
+        keys = [self.VERSION_KEY % (kind, id) for id in ids]
+        found = self.redis.get_many(keys)
+        missing = [key for key, value in zip(keys, found) if value is None]
+        if missing:
+            # versions start at the current time, a version that got evicted
+            # can't come back with a value older entries were cached with
+            now = int(time.time() * 1000)
+            self.redis.set_missing(
+                {key: now for key in missing}, settings.CACHE_VERSION_TTL)
+            found = self.redis.get_many(keys)
+        return [int(value) for value in found]
+
+    def bump(self, kind: str, ids: Iterable[int]):
+        if not settings.CACHE_ENABLED:
+            return
+        try:
+            self.redis.incr_many(
+                (self.VERSION_KEY % (kind, id) for id in ids),
+                settings.CACHE_VERSION_TTL,
+            )
+        except redis.RedisError:
+            logger.exception("Bumping cache versions of %s failed", kind)
+
+    def forget(self, kind: str, ids: Iterable[int]):
+        """
+        Drops the versions of deleted objects. looking one up again makes a
+        new version, newer than the one their cached values were keyed with
+        """
+        if not settings.CACHE_ENABLED:
+            return
+        try:
+            self.redis.delete_many([self.VERSION_KEY % (kind, id) for id in ids])
+        except redis.RedisError:
+            logger.exception("Dropping cache versions of %s failed", kind)
+
+    def key(self, name: str, *parts, **versions: Iterable[int]) -> str:
+        """
+        Key of a cached value, versions are given by kind, e.g. feed=[1, 2]
+        """
+        for kind, ids in versions.items():
+            ids = sorted(ids)
+            current = self.versions(kind, ids)
+            if len(ids) > 1:
+                # a list of any length makes a fixed size key
+                digest = hashlib.sha1(json.dumps([ids, current]).encode("utf-8"))
+                parts += (kind, digest.hexdigest())
+            else:
+                parts += (kind,) + tuple(ids) + tuple(current)
+        return "cache:%s:%s" % (name, ":".join(str(part) for part in parts))
+
+    def get_or_set(self, name: str, ttl: int, load: Callable, *parts, **versions):
+        if not settings.CACHE_ENABLED:
+            return load()
+        try:
+            key = self.key(name, *parts, **versions)
+            value = self.redis.get(key)
+        except redis.RedisError:
+            logger.exception("Reading %s from the cache failed", name)
+            return load()
+        self._count(name, value is not None)
+        if value is not None:
+            return value
+        value = load()
+        try:
+            self.redis.set(key, value, ttl)
+        except redis.RedisError:
+            logger.exception("Writing %s to the cache failed", name)
+        return value
+
+    def _count(self, name: str, hit: bool):
+        self._counts["%s:%s" % (name, "hit" if hit else "miss")] += 1
+        if time.monotonic() - self._counted_at >= settings.CACHE_STATS_FLUSH_INTERVAL:
+            self._flush_counts()
+
+    def _flush_counts(self):
+        counts, self._counts = self._counts, Counter()
+        self._counted_at = time.monotonic()
+        if not counts:
+            return
+        try:
+            self.redis.hincr_many(self.STATS_KEY, counts)
+        except redis.RedisError:
+            pass
+
+    def stats(self) -> dict:
+        """
+        Hits, misses and hit ratio of every cached value name, not available
+        while redis isn't
+        """
+        self._flush_counts()
+        try:
+            fields = self.redis.hgetall(self.STATS_KEY)
+        except redis.RedisError:
+            logger.exception("Reading the cache stats failed")
+            return {"available": False, "names": {}}
+        stats = {}
+        for field, count in fields.items():
+            name, result = field.rsplit(":", 1)
+            stats.setdefault(name, {"hit": 0, "miss": 0})[result] = count
+        for counts in stats.values():
+            lookups = counts["hit"] + counts["miss"]
+            counts["hit_ratio"] = round(counts["hit"] / lookups, 3) if lookups else None
+        return {"available": True, "names": stats}
+
+
+response_cache = ResponseCache()
@@ -19,6 +19,112 @@ class Settings(BaseSettings):
     CELERY_BROKER_URL = "redis://redis:6379"
     CELERY_RESULT_BACKEND = "redis://redis:6379"
 
+    FEED_FETCH_TIMEOUT = 2
+    # feed documents are downloaded up to this many (decoded) bytes
+    FEED_MAX_BODY_SIZE = 5 * 1024 * 1024
+    # a successful response must have one of these in its content type
+    FEED_ALLOWED_CONTENT_TYPES: list = ["xml", "rss", "atom", "text/plain"]
+    # max number of in flight requests of a single feed_batch_parser task
+    FEED_FETCH_CONCURRENCY = 50
+    # entries up to this many seconds older than the newest stored one are
+    # still parsed, so backdated entries are not missed
+    FEED_PARSE_LOOKBACK = 7 * 24 * 60 * 60
+    # politeness limits for every host we fetch feeds from, they are kept by
+    # each worker process (see HostLimiter), a host's due feeds are fetched
+    # by one of them
+    FEED_HOST_CONCURRENCY = 4
+    FEED_HOST_MIN_INTERVAL = 0.2
+    # pause of a host that answered 429 without a Retry-After header
+    FEED_HOST_THROTTLE_DELAY = 60
+    # connection pool of the fetch client of each worker process
+    FEED_MAX_CONNECTIONS = 200
+    FEED_MAX_KEEPALIVE_CONNECTIONS = 50
+    # ingest pipeline stages, see app/reader/pipeline.py
+    INGEST_PARSE_WORKERS = 4
+    INGEST_PARSE_PROCESSES = True
+    INGEST_PERSIST_WORKERS = 2
+    INGEST_PERSIST_BATCH_SIZE = 50
+    INGEST_QUEUE_SIZE = 100
+    # max rows of a single multi-row entries insert
+    INGEST_INSERT_CHUNK_SIZE = 1000
+    # number of feeds handed to a single feed_batch_parser task, but for
+    # hosts with more due feeds than that (see feed_shards)
+    FEED_SHARD_SIZE = 100
+
+    # how often the scheduler claims due feeds, and how many at most
+    FEED_SCHEDULER_INTERVAL = 60
+    FEED_SCHEDULER_BATCH_SIZE = 5000
+    # a claimed feed is not claimed again within this many seconds
+    FEED_FETCH_LEASE = 10 * 60
+    # bounds (in seconds) of the per feed fetch interval
+    FEED_MIN_FETCH_INTERVAL = 60
+    FEED_MAX_FETCH_INTERVAL = 12 * 60 * 60
+    FEED_DEFAULT_FETCH_INTERVAL = 5 * 60
+    # number of newest entries used to estimate the publishing cadence
+    FEED_CADENCE_SAMPLES = 20
+    # a feed failing this many fetches in a row trips its circuit breaker,
+    # it is then left alone for CIRCUIT_BASE_DELAY, doubled with each further
+    # failure up to CIRCUIT_MAX_DELAY, and shifted by up to +-CIRCUIT_JITTER
+    FEED_CIRCUIT_FAILURE_THRESHOLD = 5
+    FEED_CIRCUIT_BASE_DELAY = 60 * 60
+    FEED_CIRCUIT_MAX_DELAY = 7 * 24 * 60 * 60
+    FEED_CIRCUIT_JITTER = 0.2
+
+    # public base url of this api, hubs push to WEBSUB_CALLBACK_URL/websub/...
+    # websub subscriptions are only made when it is set
+    WEBSUB_CALLBACK_URL: str = None
+    WEBSUB_LEASE_SECONDS = 10 * 24 * 60 * 60
+    # subscriptions are renewed when they expire within this many seconds
+    WEBSUB_RENEW_BEFORE = 2 * 24 * 60 * 60
+    # a hub that didn't verify a subscription is asked again after this long
+    WEBSUB_RETRY_INTERVAL = 24 * 60 * 60
+    # safety net poll interval of feeds whose updates are pushed to us
+    WEBSUB_POLL_INTERVAL = 24 * 60 * 60
+
+    # raw documents are archived here when set, see app/reader/archive.py
+    ARCHIVE_URL: str = None
+    # gzip, or zstd when the zstandard package is installed
+    ARCHIVE_COMPRESSION = "gzip"
+    # endpoint of s3 compatible object storage, None for aws
+    ARCHIVE_S3_ENDPOINT_URL: str = None
+
+    # read through cache of the hot read endpoints, see app/core/cache.py.
+    # values are invalidated by version bumps, the ttls only bound how long
+    # unreachable values linger in redis (and the staleness of feed priority)
+    CACHE_ENABLED = True
+    CACHE_FEED_TTL = 5 * 60
+    CACHE_ENTRY_TTL = 24 * 60 * 60
+    CACHE_LIST_TTL = 10 * 60
+    # versions outlive the values cached with them, a bump renews them
+    CACHE_VERSION_TTL = 2 * 24 * 60 * 60
+    # hits and misses are added up in the process and written every this
+    # many seconds, not on every lookup
+    CACHE_STATS_FLUSH_INTERVAL = 10
+
+    # entry bodies are stored zlib compressed in entry_contents, once for
+    # every feed syndicating the same text unless ENTRY_CONTENT_DEDUP is off
+    ENTRY_CONTENT_COMPRESSION_LEVEL = 6
+    ENTRY_CONTENT_DEDUP = True
+
+    # entries published more than ENTRY_RETENTION_DAYS ago are deleted by the
+    # entry_retention task (None keeps them forever), but the newest
+    # ENTRY_RETENTION_KEEP_LAST of every feed and anyone's favorites. with
+    # ARCHIVE_URL set the deleted entries can be brought back by a replay
+    ENTRY_RETENTION_DAYS: int = None
+    ENTRY_RETENTION_KEEP_LAST = 100
+    ENTRY_RETENTION_INTERVAL = 24 * 60 * 60
+    ENTRY_RETENTION_BATCH_SIZE = 1000
+
+    # comments of a page, the entry detail embeds the first one
+    COMMENT_PAGE_SIZE = 20
+
+    # max entry ids of a single batch state change
+    FEED_ENTRY_BATCH_SIZE = 1000
+    # searches rank at most this many (the newest) matching entries, of the
+    # entries published in the last FEED_SEARCH_MAX_AGE
+    FEED_SEARCH_MAX_MATCHES = 10000
+    FEED_SEARCH_MAX_AGE = 365 * 24 * 60 * 60
+
     DB_USER = "rssreader"
     DB_PASS = "rssreaderpass"
     DB_HOST = "postgres"
@@ -1,9 +1,12 @@
 import sys
+from typing import Iterable
 
 from sqlalchemy import create_engine
 from sqlalchemy import Boolean, Column, Integer, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session, sessionmaker, joinedload
+from pydantic import BaseModel as PydanticModel
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session, sessionmaker, joinedload, load_only, selectinload
 from sqlalchemy.orm import RelationshipProperty
 from sqlalchemy.sql import func
 
@@ -100,6 +103,42 @@ class BaseModel(Base):
         cols = [joinedload(arg) for arg in args]
         return db.query.options(*cols)
 
+    @classmethod
+    def load_options(
+        cls, schema, *extra: str, exclude: Iterable[str] = (), joined: Iterable[str] = ()
+    ) -> list:
+        """
+        Loader options fetching only what a response schema reads: the
+        columns it has fields for (plus extra ones), and the relationships
+        it nests, batch loaded with selectinload (or joinedload if they are
+        joined) and projected the same way. excluded fields are left alone
+        """
+        mapper = inspect(cls)
+        columns = set(extra)
+        options = []
+        for name, field in schema.__fields__.items():
+            if name in exclude:
+                continue
+            if name in mapper.column_attrs:
+                columns.add(name)
+            elif name in mapper.relationships and issubclass(
+                field.type_, PydanticModel
+            ):
+                relationship = mapper.relationships[name]
+                # many to one relationships are loaded by their foreign keys
+                columns.update(
+                    mapper.get_property_by_column(column).key
+                    for column in relationship.local_columns
+                    if not column.primary_key
+                )
+                loader = joinedload if name in joined else selectinload
+                options.append(
+                    loader(getattr(cls, name)).options(
+                        *relationship.mapper.class_.load_options(field.type_)
+                    )
+                )
+        return [load_only(*(getattr(cls, name) for name in sorted(columns)))] + options
+
 
 def setup_db():
     Base.metadata.create_all(bind=engine)
@@ -11,6 +11,7 @@ api_router = APIRouter()
 api_router.include_router(authnz.router, tags=["authnz"])
 api_router.include_router(reader.feed_admin_router, tags=["Feed Admin"])
 api_router.include_router(reader.feed_user_router, tags=["Feed User"])
+api_router.include_router(reader.websub_router, tags=["WebSub"])
 api_router.include_router(
     reader.feedentry_admin_router, tags=["FeedEntry Admin"])
 api_router.include_router(
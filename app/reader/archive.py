@@ -0,0 +1,217 @@
+"""
+Archive of the raw feed documents we fetched (or got pushed)
+
+documents are compressed and stored under <feed_id>/<fetch time><ext>, on
+local disk or in object storage, so history can be replayed through the
+parse and persist stages (see app/reader/replay.py). it is enabled by
+setting ARCHIVE_URL, e.g. file:///var/lib/rssreader/archive or
+s3://bucket/prefix
+"""
+import gzip
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+from app.core.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+KEY_TIME_FORMAT = "%Y%m%dT%H%M%S%fZ"
+
+
+class ArchiveStore:
+    """
+    Where archived documents are kept, stores are registered in STORES by
+    the scheme of their ARCHIVE_URL
+    """
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    # keys starting with prefix, in lexical (so chronological per feed) order
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        raise NotImplementedError
+
+
+class LocalArchiveStore(ArchiveStore):
+    def __init__(self, url: str):
+        self.root = urlparse(url).path
+
+    def put(self, key: str, data: bytes):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, readers never see half a document
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self.root, key), "rb") as f:
+            return f.read()
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        start = os.path.join(self.root, os.path.dirname(prefix))
+        for directory, dirs, files in os.walk(start):
+            dirs.sort()
+            relative = os.path.relpath(directory, self.root)
+            for name in sorted(files):
+                if name.endswith(".tmp"):
+                    continue
+                key = name if relative == "." else "%s/%s" % (relative, name)
+                if key.startswith(prefix):
+                    yield key
+
+
+class S3ArchiveStore(ArchiveStore):
+    def __init__(self, url: str):
+        # only needed by the deployments archiving to object storage
+        import boto3
+
+        parsed = urlparse(url)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.client = boto3.client(
+            "s3", endpoint_url=settings.ARCHIVE_S3_ENDPOINT_URL
+        )
+
+    def _object_key(self, key: str) -> str:
+        return "%s/%s" % (self.prefix, key) if self.prefix else key
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(
+            Bucket=self.bucket, Key=self._object_key(key), Body=data)
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(
+            Bucket=self.bucket, Key=self._object_key(key)
+        )["Body"].read()
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        strip = len(self._object_key(""))
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self._object_key(prefix)
+        ):
+            for item in page.get("Contents", []):
+                yield item["Key"][strip:]
+
+
+STORES = {
+    "file": LocalArchiveStore,
+    "s3": S3ArchiveStore,
+}
+
+
+class GzipCodec:
+    extension = ".gz"
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return gzip.compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class ZstdCodec:
+    extension = ".zst"
+
+    def __init__(self):
+        # zstandard is optional, gzip is used unless it is installed
+        import zstandard
+
+        self._compressor = zstandard.ZstdCompressor()
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+CODECS = {
+    "gzip": GzipCodec,
+    "zstd": ZstdCodec,
+}
+
+
+class FeedArchive:
+    def __init__(self, store: ArchiveStore, compression: str = None):
+        self.store = store
+        self.codec = CODECS[compression or settings.ARCHIVE_COMPRESSION]()
+        self._codecs = {self.codec.extension: self.codec}
+
+    @staticmethod
+    def make_key(feed_id: int, fetched_at: datetime, extension: str) -> str:
+        fetched_at = fetched_at.astimezone(timezone.utc)
+        return "%d/%s%s" % (feed_id, fetched_at.strftime(KEY_TIME_FORMAT), extension)
+
+    @staticmethod
+    def parse_key(key: str) -> Tuple[int, datetime]:
+        feed_id, name = key.split("/", 1)
+        fetched_at = datetime.strptime(name.split(".", 1)[0], KEY_TIME_FORMAT)
+        return int(feed_id), fetched_at.replace(tzinfo=timezone.utc)
+
+    def put(self, feed_id: int, fetched_at: datetime, content: bytes) -> str:
+        key = self.make_key(feed_id, fetched_at, self.codec.extension)
+        self.store.put(key, self.codec.compress(content))
+        return key
+
+    def get(self, key: str) -> bytes:
+        extension = "." + key.rsplit(".", 1)[-1]
+        if extension not in self._codecs:
+            codec = next(
+                codec for codec in CODECS.values() if codec.extension == extension
+            )
+            self._codecs[extension] = codec()
+        return self._codecs[extension].decompress(self.store.get(key))
+
+    def keys(
+        self,
+        feed_ids: Iterable[int] = None,
+        since: datetime = None,
+        until: datetime = None,
+    ) -> Iterator[str]:
+        prefixes = ["%d/" % feed_id for feed_id in feed_ids] if feed_ids else [""]
+        for prefix in prefixes:
+            for key in self.store.keys(prefix):
+                _, fetched_at = self.parse_key(key)
+                if since and fetched_at < since:
+                    continue
+                if until and fetched_at >= until:
+                    continue
+                yield key
+
+
+# one archive per process, the parse stage runs in worker processes too
+_archive_key = None
+_archive = None
+
+
+def get_archive() -> Optional[FeedArchive]:
+    global _archive_key, _archive
+    if not settings.ARCHIVE_URL:
+        return None
+    if _archive_key != (os.getpid(), settings.ARCHIVE_URL):
+        _archive_key = (os.getpid(), settings.ARCHIVE_URL)
+        store = STORES[urlparse(settings.ARCHIVE_URL).scheme](settings.ARCHIVE_URL)
+        _archive = FeedArchive(store)
+    return _archive
+
+
+def archive_content(feed_id: int, fetched_at: datetime, content: bytes):
+    if not settings.ARCHIVE_URL:
+        return
+    # losing a document from the archive must not lose its entries
+    try:
+        get_archive().put(feed_id, fetched_at, content)
+    except Exception:
+        logger.exception("Archiving a document of feed %s failed", feed_id)
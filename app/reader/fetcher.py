@@ -0,0 +1,306 @@
+import os
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Iterable, List, Mapping, Optional, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.core.config import settings
+
+
+class FetchAborted(Exception):
+    TOO_LARGE = "too_large"
+    UNSUPPORTED_CONTENT_TYPE = "unsupported_content_type"
+
+    def __init__(self, reason: str, detail: str = None):
+        super().__init__(reason, detail)
+        self.reason = reason
+        self.detail = detail
+
+    # what is stored as the feed's last_error
+    @property
+    def message(self) -> str:
+        if self.detail is None:
+            return self.reason
+        return "%s: %s" % (self.reason, self.detail)
+
+
+def check_content_type(content_type: Optional[str]):
+    # servers that don't send a content type get the benefit of the doubt
+    if not content_type:
+        return
+    content_type = content_type.lower()
+    if not any(
+        allowed in content_type for allowed in settings.FEED_ALLOWED_CONTENT_TYPES
+    ):
+        raise FetchAborted(FetchAborted.UNSUPPORTED_CONTENT_TYPE, content_type)
+
+
+def check_content_length(content_length: Optional[str]):
+    if content_length and content_length.isdigit():
+        if int(content_length) > settings.FEED_MAX_BODY_SIZE:
+            raise FetchAborted(
+                FetchAborted.TOO_LARGE,
+                "%s bytes, more than %d" % (content_length, settings.FEED_MAX_BODY_SIZE),
+            )
+
+
+def check_body_size(size: int):
+    if size > settings.FEED_MAX_BODY_SIZE:
+        raise FetchAborted(
+            FetchAborted.TOO_LARGE, "more than %d bytes" % settings.FEED_MAX_BODY_SIZE
+        )
+
+
+class FetchResult:
+    def __init__(
+        self,
+        feed_id: int,
+        url: str,
+        content: Optional[bytes] = None,
+        status_code: Optional[int] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        error: Optional[Exception] = None,
+        elapsed: float = 0,
+    ):
+        self.feed_id = feed_id
+        self.url = url
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def timed_out(self) -> bool:
+        return isinstance(self.error, httpx.TimeoutException)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def aborted(self) -> bool:
+        return isinstance(self.error, FetchAborted)
+
+    @property
+    def throttled(self) -> bool:
+        return self.status_code == 429
+
+    @property
+    def retry_after(self) -> Optional[float]:
+        return parse_retry_after(self.headers.get("Retry-After"))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    Politeness limits per host: at most `concurrency` requests in flight
+    and at least `min_interval` seconds between the start of two requests
+
+    the limits are kept in memory, so they hold within a worker process
+    only. feed_distributor hands all the due feeds of a host to the same
+    feed_batch_parser task, the fetches that bypass it (a new subscription,
+    a shard still running when the next one starts) may go beyond them
+    """
+
+    def __init__(self, concurrency: int = None, min_interval: float = None):
+        self.concurrency = concurrency or settings.FEED_HOST_CONCURRENCY
+        if min_interval is None:
+            min_interval = settings.FEED_HOST_MIN_INTERVAL
+        self.min_interval = min_interval
+        self._semaphores = {}
+        self._next_slot = {}
+
+    @asynccontextmanager
+    async def limit(self, host: str):
+        # semaphores are created lazily so they bind to the running loop
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.concurrency)
+        async with self._semaphores[host]:
+            await self._wait_for_slot(host)
+            yield
+
+    async def _wait_for_slot(self, host: str):
+        # reserving the slot doesn't await, so no lock is needed
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(host, 0))
+        self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def back_off(self, host: str, delay: float):
+        self._next_slot[host] = max(
+            self._next_slot.get(host, 0), time.monotonic() + delay
+        )
+
+
+class FetchClient:
+    """
+    Async http client with keep-alive connection pools shared by all the
+    fetches of a worker process, and the per host limits of HostLimiter
+    """
+
+    def __init__(
+        self,
+        timeout: float = None,
+        host_concurrency: int = None,
+        host_min_interval: float = None,
+    ):
+        self.limiter = HostLimiter(host_concurrency, host_min_interval)
+        self.client = httpx.AsyncClient(
+            timeout=timeout or settings.FEED_FETCH_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.FEED_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.FEED_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+
+    async def fetch(
+        self, feed_id: int, url: str, headers: Optional[Mapping[str, str]] = None
+    ) -> FetchResult:
+        started = time.monotonic()
+        try:
+            host = httpx.URL(url).host
+            async with self.limiter.limit(host):
+                started = time.monotonic()
+                async with self.client.stream("GET", url, headers=headers) as resp:
+                    content = await self._read_body(resp)
+        # socket and tls errors mostly surface as httpx.ConnectError, but not
+        # all of them, and hosts that don't encode as idna raise UnicodeError
+        except (
+            httpx.HTTPError,
+            httpx.InvalidURL,
+            FetchAborted,
+            OSError,
+            UnicodeError,
+        ) as e:
+            return FetchResult(
+                feed_id, url, error=e, elapsed=time.monotonic() - started
+            )
+        result = FetchResult(
+            feed_id,
+            url,
+            content=content,
+            status_code=resp.status_code,
+            headers=resp.headers,
+            elapsed=time.monotonic() - started,
+        )
+        if result.throttled:
+            self.limiter.back_off(
+                host, result.retry_after or settings.FEED_HOST_THROTTLE_DELAY
+            )
+        return result
+
+    # reads at most FEED_MAX_BODY_SIZE bytes of a feed document, oversized
+    # or non xml responses are dropped before (or while) downloading them
+    @staticmethod
+    async def _read_body(resp: httpx.Response) -> bytes:
+        if 200 <= resp.status_code < 300:
+            check_content_type(resp.headers.get("Content-Type"))
+            check_content_length(resp.headers.get("Content-Length"))
+        body = bytearray()
+        async for chunk in resp.aiter_bytes():
+            body += chunk
+            check_body_size(len(body))
+        return bytes(body)
+
+    # fetches all the given (feed_id, url, headers) items, the semaphore
+    # bounds the number of requests in flight at the same time
+    async def fetch_many(
+        self,
+        feeds: Iterable[Tuple[int, str, Optional[Mapping[str, str]]]],
+        concurrency: int = None,
+    ) -> List[FetchResult]:
+        semaphore = asyncio.Semaphore(
+            concurrency or settings.FEED_FETCH_CONCURRENCY)
+
+        async def fetch(feed_id, url, headers):
+            async with semaphore:
+                return await self.fetch(feed_id, url, headers)
+
+        return await asyncio.gather(
+            *(fetch(feed_id, url, headers) for feed_id, url, headers in feeds)
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+
+async def fetch_feeds(
+    feeds: Iterable[Tuple[int, str, Optional[Mapping[str, str]]]],
+    concurrency: int = None,
+    timeout: float = None,
+    host_concurrency: int = None,
+    host_min_interval: float = None,
+) -> List[FetchResult]:
+    client = FetchClient(timeout, host_concurrency, host_min_interval)
+    try:
+        return await client.fetch_many(feeds, concurrency)
+    finally:
+        await client.close()
+
+
+# the client and the loop it runs on live as long as the worker process,
+# so connections are kept alive between tasks. they are created after the
+# fork, celery prefork children must not share the parent's sockets
+_process_pid = None
+_process_loop = None
+_process_client = None
+_process_session = None
+
+
+def _check_process():
+    global _process_pid, _process_loop, _process_client, _process_session
+    if _process_pid != os.getpid():
+        _process_pid = os.getpid()
+        _process_loop = None
+        _process_client = None
+        _process_session = None
+
+
+def run_async(coro):
+    global _process_loop
+    _check_process()
+    if _process_loop is None:
+        _process_loop = asyncio.new_event_loop()
+    return _process_loop.run_until_complete(coro)
+
+
+def get_fetch_client() -> FetchClient:
+    global _process_client
+    _check_process()
+    if _process_client is None:
+        _process_client = FetchClient()
+    return _process_client
+
+
+def get_http_session() -> requests.Session:
+    """
+    Blocking pooled session, for the fetches that happen outside of the
+    worker's event loop (e.g. validating a url in a request handler)
+    """
+    global _process_session
+    _check_process()
+    if _process_session is None:
+        _process_session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=settings.FEED_HOST_CONCURRENCY)
+        _process_session.mount("http://", adapter)
+        _process_session.mount("https://", adapter)
+    return _process_session
@@ -0,0 +1,407 @@
+import hashlib
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Mapping, Optional, Tuple
+
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+
+from app.core.cache import response_cache
+from app.core.config import settings
+from app.reader.archive import archive_content
+from app.reader.fetcher import FetchResult
+from app.reader.models import EntryContent, Feed, FeedEntry, make_search_vector
+from app.reader.parsers import ParsedFeed, parse_feed
+from app.reader.retention import retention_cutoff
+
+
+logger = logging.getLogger(__name__)
+
+
+class FeedSnapshot:
+    """
+    The fields of a feed the fetch and parse stages need, detached from
+    the session so it can be handed between stages and processes
+    """
+
+    def __init__(self, feed: Feed):
+        self.id = feed.id
+        self.url = feed.url
+        self.headers = feed.conditional_headers()
+        self.content_hash = feed.content_hash
+        self.content_length = feed.content_length
+        self.last_entry_at = feed.last_entry_at
+
+    @property
+    def parse_since(self) -> Optional[datetime]:
+        if self.last_entry_at is None:
+            return None
+        return self.last_entry_at - timedelta(seconds=settings.FEED_PARSE_LOOKBACK)
+
+
+class IngestOutcome:
+    """
+    What a fetch of a feed amounted to, persist_outcomes applies it
+    """
+
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+    ABORTED = "aborted"
+    THROTTLED = "throttled"
+    NOT_MODIFIED = "not_modified"
+    UNCHANGED = "unchanged"
+    INVALID = "invalid"
+    PARSED = "parsed"
+    # content a websub hub pushed to us, it isn't a fetch of the feed
+    PUSHED = "pushed"
+    # an archived document parsed again, only its entries are stored
+    REPLAYED = "replayed"
+
+    # the outcomes that count towards tripping the circuit breaker, and
+    # those that close it again
+    FAILURES = (FAILED, TIMED_OUT, ABORTED, INVALID)
+    SUCCESSES = (NOT_MODIFIED, UNCHANGED, PARSED)
+
+    def __init__(
+        self,
+        feed_id: int,
+        status: str,
+        error: Optional[str] = None,
+        error_class: Optional[str] = None,
+        retry_after: Optional[float] = None,
+        bytes_saved: int = 0,
+        content: Optional[bytes] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        elapsed: float = 0,
+        fetched_at: datetime = None,
+    ):
+        self.feed_id = feed_id
+        self.status = status
+        self.error = error
+        self.error_class = error_class
+        self.retry_after = retry_after
+        self.bytes_saved = bytes_saved
+        # the downloaded document, until the parse stage is done with it
+        self.content = content
+        self.content_hash = None
+        self.content_length = None
+        self.etag = None
+        self.last_modified = None
+        if headers:
+            self.etag = headers.get("ETag")
+            self.last_modified = headers.get("Last-Modified")
+        self.parsed: Optional[ParsedFeed] = None
+        self.elapsed = elapsed
+        self.fetched_at = fetched_at or datetime.now(timezone.utc)
+        # set by persist_outcomes when the feed's websub hub should be asked
+        # for a subscription
+        self.subscribe = False
+
+    @property
+    def needs_parse(self) -> bool:
+        return self.content is not None and self.parsed is None
+
+    def set_parsed(self, parsed: Optional[ParsedFeed]):
+        self.content_hash = hashlib.sha256(self.content).hexdigest()
+        self.content_length = len(self.content)
+        self.content = None
+        self.parsed = parsed
+        if parsed is None:
+            self.status = IngestOutcome.INVALID
+            self.error_class = "InvalidFeed"
+
+
+def fetch_outcome(feed: FeedSnapshot, result: FetchResult) -> IngestOutcome:
+    def outcome(status, **kwargs):
+        return IngestOutcome(feed.id, status, elapsed=result.elapsed, **kwargs)
+
+    if result.timed_out:
+        return outcome(
+            IngestOutcome.TIMED_OUT, error_class=type(result.error).__name__)
+    if result.aborted:
+        return outcome(
+            IngestOutcome.ABORTED,
+            error=result.error.message,
+            error_class=type(result.error).__name__,
+        )
+    if not result.ok:
+        # connection refused, dns failures, broken responses...
+        logger.warning("Fetching feed %s failed: %r", feed.url, result.error)
+        return outcome(
+            IngestOutcome.FAILED, error_class=type(result.error).__name__)
+    if result.throttled:
+        # being rate limited says nothing about the health of the feed
+        return outcome(
+            IngestOutcome.THROTTLED,
+            retry_after=result.retry_after or settings.FEED_HOST_THROTTLE_DELAY,
+        )
+    if result.status_code >= 400:
+        return outcome(
+            IngestOutcome.FAILED, error_class="HTTP %d" % result.status_code)
+    # the server confirmed our cached validators, nothing has changed
+    if result.status_code == 304:
+        return outcome(
+            IngestOutcome.NOT_MODIFIED, bytes_saved=feed.content_length or 0
+        )
+    # servers without validators still tend to serve the very same document
+    if hashlib.sha256(result.content).hexdigest() == feed.content_hash:
+        return outcome(IngestOutcome.UNCHANGED)
+    return outcome(
+        IngestOutcome.PARSED, content=result.content, headers=result.headers
+    )
+
+
+def parse_outcome(outcome: IngestOutcome, since: datetime = None) -> IngestOutcome:
+    if outcome.needs_parse:
+        if outcome.status != IngestOutcome.REPLAYED:
+            archive_content(outcome.feed_id, outcome.fetched_at, outcome.content)
+        outcome.set_parsed(parse_feed(outcome.content, since=since))
+    return outcome
+
+
+def persist_outcomes(db: Session, outcomes: Iterable[IngestOutcome]):
+    """
+    Applies the outcomes of many feeds in a single transaction, with one
+    multi-row insert of their new entries and one update of their rows
+    """
+    outcomes = list(outcomes)
+    feeds = {
+        feed.id: feed
+        for feed in db.query(
+            Feed.id,
+            Feed.priority,
+            Feed.title,
+            Feed.last_entry_at,
+            Feed.fetch_interval,
+            Feed.failure_count,
+            Feed.circuit_open_until,
+            Feed.websub_expires_at,
+        ).filter(Feed.id.in_([outcome.feed_id for outcome in outcomes]))
+    }
+    rows = []
+    updates = []
+    for outcome in outcomes:
+        feed = feeds.get(outcome.feed_id)
+        if feed is None:
+            continue
+        if outcome.status == IngestOutcome.REPLAYED:
+            # history must not touch the current state of the feed
+            rows += _entry_rows(feed, outcome, {})
+            continue
+        feed_update, feed_rows = _feed_update(feed, outcome)
+        updates.append((feed, outcome, feed_update))
+        rows += feed_rows
+
+    # entries we already have are skipped by the unique (feed_id, guid_hash)
+    # constraint which makes retries safe, only the inserted ones are counted
+    entries_added = Counter()
+    for i in range(0, len(rows), settings.INGEST_INSERT_CHUNK_SIZE):
+        _store_contents(db, rows[i: i + settings.INGEST_INSERT_CHUNK_SIZE])
+        entries_added.update(
+            db.execute(
+                insert(FeedEntry)
+                .values(rows[i: i + settings.INGEST_INSERT_CHUNK_SIZE])
+                .on_conflict_do_nothing(constraint="feed_entry_guid_unique")
+                .returning(FeedEntry.feed_id)
+            ).scalars()
+        )
+    changed_feeds = set(entries_added)
+    for _, _, feed_update in updates:
+        feed_update["entries_added"] = entries_added.pop(feed_update["id"], 0)
+    # what is left was replayed
+    Feed.add_entry_counts(db, dict(entries_added))
+
+    # the cadence is measured on the stored entries, the new ones included
+    entry_times = Feed.recent_entry_times(
+        db,
+        [feed.id for feed, outcome, _ in updates if outcome.parsed is not None],
+    )
+    now = datetime.now(timezone.utc)
+    for feed, outcome, feed_update in updates:
+        if feed.id in entry_times:
+            feed_update["fetch_interval"] = Feed.cadence_interval(
+                entry_times[feed.id])
+        not_before = outcome.retry_after
+        # updates of push subscribed feeds come from the hub, polling them is
+        # only a safety net
+        if feed.websub_expires_at is not None and feed.websub_expires_at > now:
+            not_before = max(not_before or 0, settings.WEBSUB_POLL_INTERVAL)
+        next_fetch_at = Feed.next_fetch_time(
+            feed_update["fetch_interval"] or feed.fetch_interval,
+            (feed.priority or 0) + feed_update["priority_delta"],
+            not_before=not_before,
+        )
+        if feed_update["circuit_open_until"] is not None:
+            next_fetch_at = max(next_fetch_at, feed_update["circuit_open_until"])
+        feed_update["next_fetch_at"] = next_fetch_at
+    Feed.apply_fetch_updates(db, [feed_update for _, _, feed_update in updates])
+    db.commit()
+    # cached lists and counters of the feeds with new entries are stale now,
+    # and so are the cached feeds whose title or priority changed
+    changed_feeds.update(
+        feed_update["id"]
+        for _, _, feed_update in updates
+        if feed_update["title"] is not None or feed_update["priority_delta"]
+    )
+    response_cache.bump("feed", changed_feeds)
+
+    subscribe = set(Feed.websub_due(db, [feed.id for feed, _, _ in updates]))
+    for outcome in outcomes:
+        outcome.subscribe = outcome.feed_id in subscribe
+
+
+def _store_contents(db: Session, rows: List[dict]):
+    """
+    Stores the contents of entry rows in entry_contents, the rows are left
+    with their content_hash and search vector instead
+    """
+    contents = {}
+    for row in rows:
+        content = row.pop("content")
+        content_row = EntryContent.make_row(content, row["feed_id"])
+        contents[content_row["content_hash"]] = content_row
+        row["content_hash"] = content_row["content_hash"]
+        row["search_vector"] = make_search_vector(row["title"], row["summary"], content)
+    EntryContent.store(db, list(contents.values()))
+
+
+def _feed_update(feed, outcome: IngestOutcome) -> Tuple[dict, List[dict]]:
+    """
+    The row of Feed.apply_fetch_updates for the outcome, and the entries
+    to insert
+    """
+    feed_update = dict(
+        id=feed.id,
+        status=outcome.status,
+        elapsed=outcome.elapsed,
+        priority_delta=0,
+        last_error=None,
+        bytes_saved=0,
+        parses_saved=0,
+        replace_document=False,
+        etag=None,
+        last_modified=None,
+        content_hash=None,
+        content_length=None,
+        title=None,
+        last_entry_at=None,
+        fetch_interval=None,
+        next_fetch_at=None,
+        failure_count=feed.failure_count or 0,
+        last_error_class=outcome.error_class,
+        circuit_open_until=feed.circuit_open_until,
+        websub_hub=None,
+        websub_topic=None,
+        entries_added=0,
+    )
+    # a success closes the circuit, a failure (of a trial fetch, once the
+    # circuit was open) trips it for longer
+    if outcome.status in IngestOutcome.SUCCESSES:
+        feed_update["failure_count"] = 0
+        feed_update["circuit_open_until"] = None
+    elif outcome.status in IngestOutcome.FAILURES:
+        feed_update["failure_count"] += 1
+        feed_update["circuit_open_until"] = Feed.circuit_open_time(
+            feed_update["failure_count"]
+        )
+    old_priority = priority = feed.priority or 0
+
+    def result(rows=()):
+        feed_update["priority_delta"] = priority - old_priority
+        return feed_update, list(rows)
+
+    if outcome.status in (IngestOutcome.TIMED_OUT, IngestOutcome.ABORTED):
+        feed_update["last_error"] = outcome.error
+        priority += 1
+        return result()
+    if outcome.status in (IngestOutcome.FAILED, IngestOutcome.THROTTLED):
+        return result()
+    if outcome.status == IngestOutcome.PUSHED:
+        # says nothing about the health of the feed, only store the entries
+        return result(_entry_rows(feed, outcome, feed_update))
+
+    # the document was downloaded
+    priority = max(priority - 1, 0)
+    if outcome.status in (IngestOutcome.NOT_MODIFIED, IngestOutcome.UNCHANGED):
+        feed_update["bytes_saved"] = outcome.bytes_saved
+        feed_update["parses_saved"] = 1
+        return result()
+    # if feed is invalid, increase priority and return
+    if outcome.status == IngestOutcome.INVALID:
+        priority += 1
+        return result()
+    priority = max(priority - 1, 0)
+
+    # only remember valid documents, broken ones are fetched and parsed every time
+    feed_update.update(
+        replace_document=True,
+        etag=outcome.etag,
+        last_modified=outcome.last_modified,
+        content_hash=outcome.content_hash,
+        content_length=outcome.content_length,
+        websub_hub=outcome.parsed.hub,
+        websub_topic=outcome.parsed.self_url,
+    )
+    return result(_entry_rows(feed, outcome, feed_update))
+
+
+def _entry_rows(feed, outcome: IngestOutcome, feed_update: dict) -> List[dict]:
+    # update feed title if changed
+    parsed = outcome.parsed
+    if parsed.title and feed.title != parsed.title:
+        feed_update["title"] = parsed.title
+
+    # entries past their retention were deleted (or are about to be) and must
+    # not come back, except the first time a feed is stored and when an
+    # archive is replayed to bring them back
+    cutoff = None
+    if feed.last_entry_at is not None and outcome.status != IngestOutcome.REPLAYED:
+        cutoff = retention_cutoff()
+
+    rows = {}
+    for entry in parsed.entries:
+        if cutoff is not None and entry["published_at"] < cutoff:
+            continue
+        guid = entry["id"] or entry["link"] or entry["title"]
+        guid_hash = FeedEntry.make_guid_hash(guid)
+        rows[guid_hash] = dict(
+            feed_id=feed.id,
+            guid_hash=guid_hash,
+            title=entry["title"],
+            subtitle=entry["subtitle"],
+            link=entry["link"],
+            author=entry["author"],
+            summary=entry["summary"],
+            content=entry["content"],
+            published_at=entry["published_at"],
+        )
+    if rows:
+        # the high-water mark lets the next parse stop at entries it has seen,
+        # future dated entries must not push it past the present
+        newest = min(
+            max(row["published_at"] for row in rows.values()),
+            datetime.now(timezone.utc),
+        )
+        if feed.last_entry_at is None or newest > feed.last_entry_at:
+            feed_update["last_entry_at"] = newest
+    return list(rows.values())
+
+
+def store_fetch_result(db: Session, feed: Feed, result: FetchResult) -> IngestOutcome:
+    snapshot = FeedSnapshot(feed)
+    outcome = parse_outcome(fetch_outcome(snapshot, result), snapshot.parse_since)
+    persist_outcomes(db, [outcome])
+    return outcome
+
+
+def store_feed_content(
+    db: Session, feed: Feed, content: bytes, headers: Mapping[str, str] = None
+) -> IngestOutcome:
+    snapshot = FeedSnapshot(feed)
+    outcome = IngestOutcome(
+        feed.id, IngestOutcome.PARSED, content=content, headers=headers
+    )
+    outcome = parse_outcome(outcome, snapshot.parse_since)
+    persist_outcomes(db, [outcome])
+    return outcome
@@ -1,14 +1,49 @@
-from datetime import datetime
+import hashlib
+import random
+import statistics
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
 
-from sqlalchemy.sql.elements import and_
-from sqlalchemy.sql.expression import delete, select
+from sqlalchemy.sql.elements import and_, or_
+from sqlalchemy.sql.expression import (
+    case,
+    cast,
+    column,
+    delete,
+    desc,
+    literal,
+    select,
+    true,
+    update,
+    values,
+)
 from sqlalchemy.sql.functions import func
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Table, DateTime
-from sqlalchemy.orm import Session, relationship
+from sqlalchemy import (
+    event,
+    BigInteger,
+    DDL,
+    Boolean,
+    Column,
+    Float,
+    Integer,
+    String,
+    ForeignKey,
+    Table,
+    DateTime,
+    Index,
+    LargeBinary,
+    inspect,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import Session, deferred, relationship, synonym
 from sqlalchemy.sql.schema import UniqueConstraint
 
 from app.utils.i18n import trans
 from app.utils.exceptions import CustomException
+from app.core.cache import response_cache
+from app.core.config import settings
 from app.core.database import BaseModel
 from app.authnz.models import User
 
@@ -18,6 +53,34 @@ user_feed_table = Table(
     BaseModel.metadata,
     Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE")),
     Column("feed_id", Integer, ForeignKey("feeds.id", ondelete="CASCADE")),
+    Index("ix_user_feed_user_id_feed_id", "user_id", "feed_id"),
+)
+
+
+# the columns of a row of Feed.apply_fetch_updates
+FETCH_UPDATE_COLUMNS = (
+    ("id", Integer),
+    ("status", String),
+    ("elapsed", Float),
+    ("priority_delta", Integer),
+    ("last_error", String),
+    ("bytes_saved", BigInteger),
+    ("parses_saved", Integer),
+    ("replace_document", Boolean),
+    ("etag", String),
+    ("last_modified", String),
+    ("content_hash", String),
+    ("content_length", Integer),
+    ("title", String),
+    ("last_entry_at", DateTime(timezone=True)),
+    ("fetch_interval", Integer),
+    ("next_fetch_at", DateTime(timezone=True)),
+    ("failure_count", Integer),
+    ("last_error_class", String),
+    ("circuit_open_until", DateTime(timezone=True)),
+    ("websub_hub", String),
+    ("websub_topic", String),
+    ("entries_added", Integer),
 )
 
 
@@ -33,6 +96,47 @@ class Feed(BaseModel):
     title = Column(String)
     priority = Column(Integer, default=0, index=True)
 
+    # validators of the last fetched document, used for conditional requests
+    etag = Column(String)
+    last_modified = Column(String)
+    content_hash = Column(String)
+    content_length = Column(Integer)
+    # counters of the work skipped thanks to the conditional requests
+    bytes_saved = Column(BigInteger, default=0, server_default="0")
+    parses_saved = Column(Integer, default=0, server_default="0")
+
+    # number of entries of the feed, unread counts are derived from it
+    entry_count = Column(Integer, default=0, server_default="0")
+
+    # why the last fetch of the feed was dropped, if it was
+    last_error = Column(String)
+    # how the last fetch went (see ingest.IngestOutcome) and its latency
+    last_fetch_status = Column(String)
+    last_fetch_elapsed = Column(Float)
+
+    # published_at of the newest stored entry, parsing stops a bit before it
+    last_entry_at = Column(DateTime(timezone=True))
+
+    # seconds between two fetches, derived from the publishing cadence
+    fetch_interval = Column(Integer)
+    next_fetch_at = Column(
+        DateTime(timezone=True), server_default=func.now(), index=True
+    )
+
+    # circuit breaker: consecutive failed fetches, the kind of the last
+    # failure, and until when the feed is not fetched at all once tripped
+    failure_count = Column(Integer, default=0, server_default="0")
+    last_error_class = Column(String)
+    circuit_open_until = Column(DateTime(timezone=True))
+
+    # websub: the hub the feed advertises, the topic we subscribe to, the
+    # secret pushes are signed with and when the verified subscription ends
+    websub_hub = Column(String)
+    websub_topic = Column(String)
+    websub_secret = Column(String)
+    websub_requested_at = Column(DateTime(timezone=True))
+    websub_expires_at = Column(DateTime(timezone=True))
+
     def add_subscriber(self, db: Session, user: User):
         try:
             self.subscribers.append(user)
@@ -40,6 +144,7 @@ class Feed(BaseModel):
             raise CustomException(detail=trans(
                 "Already subscribed to this feed"))
         self.save(db)
+        response_cache.bump("user", [user.id])
 
     def remove_subscriber(self, db: Session, user: User):
         filter_statement = and_(
@@ -50,18 +155,268 @@ class Feed(BaseModel):
         ).fetchone()
         if item:
             db.bind.execute(delete(user_feed_table).where(filter_statement))
+            response_cache.bump("user", [user.id])
         else:
             raise CustomException(detail=trans(
                 "You do not subsribe to this feed"))
 
-    def increase_priority(self, db: Session):
-        self.priority += 1
+    @property
+    def push_subscribed(self) -> bool:
+        return (
+            self.websub_expires_at is not None
+            and self.websub_expires_at > datetime.now(timezone.utc)
+        )
+
+    @classmethod
+    def websub_due(cls, db: Session, feed_ids: List[int]) -> List[int]:
+        """
+        Those of the feeds whose hub should be asked for a (new) subscription:
+        they advertise a hub, the subscription is missing or about to expire,
+        and the hub wasn't asked recently
+        """
+        if not feed_ids or not settings.WEBSUB_CALLBACK_URL:
+            return []
+        now = datetime.now(timezone.utc)
+        return [
+            feed_id
+            for feed_id, in db.query(cls.id).filter(
+                cls.id.in_(feed_ids),
+                cls.websub_hub.isnot(None),
+                or_(
+                    cls.websub_expires_at.is_(None),
+                    cls.websub_expires_at
+                    < now + timedelta(seconds=settings.WEBSUB_RENEW_BEFORE),
+                ),
+                or_(
+                    cls.websub_requested_at.is_(None),
+                    cls.websub_requested_at
+                    < now - timedelta(seconds=settings.WEBSUB_RETRY_INTERVAL),
+                ),
+            )
+        ]
+
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    @classmethod
+    def claim_due(cls, db: Session, limit: int = None, lease: int = None) -> List[int]:
+        """
+        Claims the feeds whose next_fetch_at has passed and returns their ids
+
+        claimed feeds are pushed lease seconds into the future so the next
+        scheduler tick won't claim them again while they are being fetched,
+        if the fetch never reports back they become due again after the lease
+        """
+        now = datetime.now(timezone.utc)
+        due = (
+            select(cls.id)
+            .where(
+                cls.next_fetch_at <= now,
+                or_(cls.circuit_open_until.is_(None),
+                    cls.circuit_open_until <= now),
+            )
+            .order_by(cls.next_fetch_at)
+            .limit(limit or settings.FEED_SCHEDULER_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        feed_ids = (
+            db.execute(
+                update(cls)
+                .where(cls.id.in_(due))
+                .values(
+                    next_fetch_at=now
+                    + timedelta(seconds=lease or settings.FEED_FETCH_LEASE)
+                )
+                .returning(cls.id)
+                .execution_options(synchronize_session=False)
+            )
+            .scalars()
+            .all()
+        )
+        db.commit()
+        return sorted(feed_ids)
+
+    @classmethod
+    def recent_entry_times(
+        cls, db: Session, feed_ids: List[int]
+    ) -> Dict[int, List[datetime]]:
+        """
+        published_at of the newest FEED_CADENCE_SAMPLES entries of each feed,
+        newest first, in a single query
+        """
+        if not feed_ids:
+            return {}
+        ranked = (
+            select(
+                FeedEntry.feed_id,
+                FeedEntry.published_at,
+                func.row_number()
+                .over(
+                    partition_by=FeedEntry.feed_id,
+                    order_by=FeedEntry.published_at.desc(),
+                )
+                .label("rank"),
+            )
+            .where(FeedEntry.feed_id.in_(feed_ids))
+            .subquery()
+        )
+        times = {feed_id: [] for feed_id in feed_ids}
+        for feed_id, published_at in db.execute(
+            select(ranked.c.feed_id, ranked.c.published_at)
+            .where(ranked.c.rank <= settings.FEED_CADENCE_SAMPLES)
+            .order_by(ranked.c.feed_id, ranked.c.rank)
+        ):
+            times[feed_id].append(published_at)
+        return times
+
+    @staticmethod
+    def cadence_interval(published: List[datetime]) -> Optional[int]:
+        """
+        Fetch interval for entries published at the given times (newest first)
+        """
+        if len(published) < 2:
+            return None
+        # the gap since the newest entry counts too, so feeds that went quiet
+        # get polled less and less often
+        now = datetime.now(timezone.utc)
+        gaps = [
+            (newer - older).total_seconds()
+            for newer, older in zip([max(now, published[0])] + published, published)
+        ]
+        # poll twice per typical gap between entries so new ones don't lag
+        return int(
+            min(
+                max(statistics.median(gaps) / 2,
+                    settings.FEED_MIN_FETCH_INTERVAL),
+                settings.FEED_MAX_FETCH_INTERVAL,
+            )
+        )
+
+    @staticmethod
+    def next_fetch_time(
+        fetch_interval: Optional[int], priority: int, not_before: float = None
+    ) -> datetime:
+        interval = fetch_interval or settings.FEED_DEFAULT_FETCH_INTERVAL
+        # priority grows with each failed fetch, back off exponentially
+        interval *= 2 ** min(priority or 0, 10)
+        interval = min(interval, settings.FEED_MAX_FETCH_INTERVAL)
+        interval = max(interval, not_before or 0)
+        return datetime.now(timezone.utc) + timedelta(seconds=interval)
+
+    @classmethod
+    def add_entry_counts(cls, db: Session, counts: Dict[int, int]):
+        """
+        Adds to the entry_count of the feeds, {feed_id: entries added}
+        """
+        if not counts:
+            return
+        changes = values(
+            column("id", Integer), column("added", Integer), name="changes"
+        ).data(list(counts.items()))
+        db.execute(
+            update(cls)
+            .where(cls.id == changes.c.id)
+            .values(entry_count=cls.entry_count + changes.c.added)
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def circuit_open_time(failure_count: int) -> Optional[datetime]:
+        """
+        Until when a feed with this many consecutive failures is left alone,
+        None while the circuit is closed
+        """
+        tripped = failure_count - settings.FEED_CIRCUIT_FAILURE_THRESHOLD
+        if tripped < 0:
+            return None
+        delay = min(
+            settings.FEED_CIRCUIT_BASE_DELAY * 2 ** min(tripped, 20),
+            settings.FEED_CIRCUIT_MAX_DELAY,
+        )
+        # jitter keeps feeds that died together from being retried together
+        jitter = settings.FEED_CIRCUIT_JITTER
+        delay *= random.uniform(1 - jitter, 1 + jitter)
+        return datetime.now(timezone.utc) + timedelta(seconds=delay)
+
+    @classmethod
+    def tripped(cls, db: Session):
+        return (
+            db.query(cls)
+            .filter(cls.circuit_open_until.isnot(None))
+            .order_by(cls.circuit_open_until)
+            .all()
+        )
+
+    def reset_circuit(self, db: Session):
+        self.failure_count = 0
+        self.circuit_open_until = None
+        self.next_fetch_at = datetime.now(timezone.utc)
         self.save(db)
 
-    def decrease_priority(self, db: Session):
-        if self.priority > 0:
-            self.priority -= 1
-            self.save(db)
+    @classmethod
+    def apply_fetch_updates(cls, db: Session, updates: List[dict]):
+        """
+        Applies the fetch outcomes of many feeds with a single
+        UPDATE ... FROM (VALUES ...) statement, one row per feed
+
+        counters and priority are applied as deltas, the validators of the
+        document only when `replace_document` is set, title, last_entry_at,
+        fetch_interval and last_error_class only when given
+        """
+        if not updates:
+            return
+        changes = values(
+            *(column(name, type_) for name, type_ in FETCH_UPDATE_COLUMNS),
+            name="changes",
+        ).data(
+            [tuple(update[name] for name, _ in FETCH_UPDATE_COLUMNS)
+             for update in updates]
+        )
+
+        # all-NULL columns of a VALUES list are typed as text by postgres
+        def change(name):
+            return cast(changes.c[name], changes.c[name].type)
+
+        def replace_document(name):
+            return case(
+                (changes.c.replace_document, change(name)), else_=getattr(cls, name)
+            )
+
+        db.execute(
+            update(cls)
+            .where(cls.id == changes.c.id)
+            .values(
+                priority=func.greatest(cls.priority + changes.c.priority_delta, 0),
+                last_fetch_status=change("status"),
+                last_fetch_elapsed=change("elapsed"),
+                last_error=change("last_error"),
+                bytes_saved=cls.bytes_saved + changes.c.bytes_saved,
+                parses_saved=cls.parses_saved + changes.c.parses_saved,
+                etag=replace_document("etag"),
+                last_modified=replace_document("last_modified"),
+                content_hash=replace_document("content_hash"),
+                content_length=replace_document("content_length"),
+                title=func.coalesce(change("title"), cls.title),
+                last_entry_at=func.coalesce(
+                    change("last_entry_at"), cls.last_entry_at),
+                fetch_interval=func.coalesce(
+                    change("fetch_interval"), cls.fetch_interval),
+                next_fetch_at=change("next_fetch_at"),
+                failure_count=change("failure_count"),
+                last_error_class=func.coalesce(
+                    change("last_error_class"), cls.last_error_class),
+                circuit_open_until=change("circuit_open_until"),
+                websub_hub=replace_document("websub_hub"),
+                websub_topic=replace_document("websub_topic"),
+                entry_count=cls.entry_count + changes.c.entries_added,
+            )
+            .execution_options(synchronize_session=False)
+        )
 
 
 class UserFeedState(BaseModel):
@@ -74,11 +429,31 @@ class UserFeedState(BaseModel):
     feed = relationship("Feed", backref="states")
 
     last_entry_fetch_time = Column(DateTime(timezone=True), default=func.now())
+    # entries of the feed the user has read, unread is entry_count - read_count
+    read_count = Column(Integer, default=0, server_default="0")
 
     __table_args__ = (
         UniqueConstraint("user_id", "feed_id", name="user_feed_state_unique"),
     )
 
+    @classmethod
+    def add_reads(cls, db: Session, user_id: int, feed_id: int, reads: int):
+        # the state row may not exist yet, it is created without a fetch
+        # time so none of the entries stop counting as new
+        db.execute(
+            insert(cls)
+            .values(
+                user_id=user_id,
+                feed_id=feed_id,
+                read_count=max(reads, 0),
+                last_entry_fetch_time=None,
+            )
+            .on_conflict_do_update(
+                constraint="user_feed_state_unique",
+                set_={"read_count": func.greatest(cls.read_count + reads, 0)},
+            )
+        )
+
     @classmethod
     def get_item(cls, db: Session, feed_id: int, user_id: int):
         return (
@@ -94,6 +469,113 @@ class UserFeedState(BaseModel):
         feed_state.last_entry_fetch_time = datetime.now()
         feed_state.save(db)
 
+    @classmethod
+    def unread_count(cls, db: Session, feed: "Feed", user_id: int) -> int:
+        read_count = (
+            db.query(cls.read_count)
+            .filter(cls.feed_id == feed.id, cls.user_id == user_id)
+            .scalar()
+        )
+        return max((feed.entry_count or 0) - (read_count or 0), 0)
+
+
+# text search configuration of the entries, titles weigh the most. content
+# is cut so its vector stays below the 1MB limit of tsvector
+SEARCH_CONFIG = "english"
+
+
+def make_search_vector(title, summary, content):
+    """
+    The search vector of an entry, stored with it since its content lives
+    (compressed) in another table
+    """
+
+    def weighted(text, weight):
+        return func.setweight(
+            func.to_tsvector(SEARCH_CONFIG, func.coalesce(text, "")), weight
+        )
+
+    return (
+        weighted(title, "A")
+        .op("||")(weighted(summary, "B"))
+        .op("||")(weighted(func.left(content, 100000), "C"))
+    )
+
+
+class EntryContent(BaseModel):
+    """
+    Body of entries, kept out of the entries table so the scans of the lists
+    don't drag it along. stored compressed, and once for all the entries
+    with the same content_hash (see make_hash)
+    """
+
+    __refrence_context__ = __name__
+    __tablename__ = "entry_contents"
+
+    content_hash = Column(String)
+    # zlib compressed utf-8, its storage is external so postgres doesn't try
+    # to compress it again
+    data = Column(LargeBinary)
+    # of the uncompressed text, in bytes
+    size = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint("content_hash", name="entry_content_hash_unique"),
+    )
+
+    @staticmethod
+    def make_hash(content: str, feed_id: int = None) -> str:
+        # without dedup the feed is part of the hash, so feeds don't share
+        if not settings.ENTRY_CONTENT_DEDUP:
+            content = "%s:%s" % (feed_id, content)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def make_row(cls, content: str, feed_id: int = None) -> dict:
+        data = content.encode("utf-8")
+        return dict(
+            content_hash=cls.make_hash(content, feed_id),
+            data=zlib.compress(data, settings.ENTRY_CONTENT_COMPRESSION_LEVEL),
+            size=len(data),
+        )
+
+    @classmethod
+    def store(cls, connection, rows: List[dict]):
+        # the contents we already have are left as they are
+        if rows:
+            connection.execute(
+                insert(cls)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=[cls.content_hash])
+            )
+
+    @classmethod
+    def text_of(cls, connection, content_hash: Optional[str]) -> Optional[str]:
+        if content_hash is None:
+            return None
+        data = connection.execute(
+            select(cls.data).where(cls.content_hash == content_hash)
+        ).scalar()
+        return None if data is None else zlib.decompress(data).decode("utf-8")
+
+    @property
+    def text(self) -> str:
+        return zlib.decompress(self.data).decode("utf-8")
+
+    @classmethod
+    def delete_unused(cls, db: Session, content_hashes: List[str]):
+        """
+        Deletes the contents no entry uses anymore, of the given ones
+        """
+        if not content_hashes:
+            return
+        used = select(FeedEntry.id).where(FeedEntry.content_hash == cls.content_hash)
+        db.execute(
+            delete(cls)
+            .where(cls.content_hash.in_(content_hashes), ~used.exists())
+            .execution_options(synchronize_session=False)
+        )
+
 
 class FeedEntry(BaseModel):
     __refrence_context__ = __name__
@@ -105,9 +587,208 @@ class FeedEntry(BaseModel):
     subtitle = Column(String)
     link = Column(String)
     author = Column(String)
-    content = Column(String)
+    content_hash = Column(String, ForeignKey("entry_contents.content_hash"))
+    # only loaded by the entry detail, read and written through content
+    body = relationship("EntryContent")
     summary = Column(String)
     published_at = Column(DateTime(timezone=True), default=func.now())
+    # md5 of the entry guid (or link), identifies the entry within its feed
+    guid_hash = Column(String)
+    # kept by the comment events, so the detail doesn't count them
+    comment_count = Column(Integer, default=0, server_default="0")
+    # set on insert and update (see make_search_vector), only ever used in the
+    # database so it is deferred
+    search_vector = deferred(Column(TSVECTOR))
+
+    __table_args__ = (
+        UniqueConstraint("feed_id", "guid_hash", name="feed_entry_guid_unique"),
+        # entry lists walk a feed newest first, by keyset
+        Index("ix_entries_feed_id_id", "feed_id", desc("id")),
+        # the timeline merges per feed scans of it, newest first
+        Index(
+            "ix_entries_feed_id_published_at_id",
+            "feed_id",
+            desc("published_at"),
+            desc("id"),
+        ),
+        # searches are restricted to the subscribed feeds within the index,
+        # feed_id takes the btree_gin operator class (see create_btree_gin)
+        Index(
+            "ix_entries_feed_id_search_vector",
+            "feed_id",
+            "search_vector",
+            postgresql_using="gin",
+        ),
+        Index("ix_entries_content_hash", "content_hash"),
+    )
+
+    def _get_content(self) -> Optional[str]:
+        if "_new_content" in self.__dict__:
+            return self._new_content
+        return self.body.text if self.body is not None else None
+
+    def _set_content(self, content: Optional[str]):
+        # stored by store_content when the entry is flushed
+        self._new_content = content
+        self.content_hash = (
+            None if content is None else EntryContent.make_hash(content, self.feed_id)
+        )
+
+    # a synonym, so validators can set it like any column
+    content = synonym("content_hash", descriptor=property(_get_content, _set_content))
+
+    @staticmethod
+    def make_guid_hash(guid: str) -> str:
+        return hashlib.md5(guid.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def expired(
+        cls, db: Session, feed_ids: List[int], before: datetime, keep_last: int, limit: int
+    ) -> list:
+        """
+        Up to limit entries of the feeds published before the given time,
+        oldest first, except the newest keep_last entries of each feed and
+        the favorites of anyone. each feed is a walk of its (feed_id,
+        published_at, id) index
+        """
+        feeds = values(column("feed_id", Integer), name="feeds").data(
+            [(feed_id,) for feed_id in feed_ids]
+        )
+        favorite = select(UserFeedEntryState.id).where(
+            UserFeedEntryState.feed_entry_id == cls.id,
+            UserFeedEntryState.is_favorite == True,
+        )
+        per_feed = select(cls.id, cls.feed_id, cls.content_hash).where(
+            cls.feed_id == feeds.c.feed_id,
+            cls.published_at < before,
+            ~favorite.exists(),
+        )
+        if keep_last:
+            newer = cls.__table__.alias("newer")
+            # feeds with fewer entries have no such entry, and lose none
+            kept = (
+                select(newer.c.published_at)
+                .where(newer.c.feed_id == feeds.c.feed_id)
+                .order_by(newer.c.published_at.desc(), newer.c.id.desc())
+                .offset(keep_last - 1)
+                .limit(1)
+                .correlate_except(newer)
+                .scalar_subquery()
+            )
+            per_feed = per_feed.where(cls.published_at < kept)
+        per_feed = per_feed.order_by(cls.published_at).limit(limit).lateral()
+        return db.execute(
+            select(per_feed.c.id, per_feed.c.feed_id, per_feed.c.content_hash)
+            .select_from(feeds.join(per_feed, true()))
+            .limit(limit)
+        ).all()
+
+    @classmethod
+    def delete_many(cls, db: Session, entries: list):
+        """
+        Deletes entries (rows of expired) in bulk, the entry and read
+        counters are kept right like the orm deletes do one by one
+        """
+        if not entries:
+            return
+        ids = [entry.id for entry in entries]
+        reads = (
+            select(
+                UserFeedEntryState.user_id,
+                cls.feed_id,
+                func.count().label("reads"),
+            )
+            .join(cls, cls.id == UserFeedEntryState.feed_entry_id)
+            .where(
+                UserFeedEntryState.feed_entry_id.in_(ids),
+                UserFeedEntryState.is_read == True,
+            )
+            .group_by(UserFeedEntryState.user_id, cls.feed_id)
+            .subquery()
+        )
+        db.execute(
+            update(UserFeedState)
+            .where(
+                UserFeedState.user_id == reads.c.user_id,
+                UserFeedState.feed_id == reads.c.feed_id,
+            )
+            .values(read_count=func.greatest(UserFeedState.read_count - reads.c.reads, 0))
+            .execution_options(synchronize_session=False)
+        )
+        Feed.add_entry_counts(
+            db,
+            {
+                feed_id: -count
+                for feed_id, count in Counter(entry.feed_id for entry in entries).items()
+            },
+        )
+        # their states and comments go with them
+        db.execute(
+            delete(cls).where(cls.id.in_(ids)).execution_options(synchronize_session=False)
+        )
+        EntryContent.delete_unused(
+            db, list({entry.content_hash for entry in entries if entry.content_hash})
+        )
+
+
+# the extension ships with postgres (contrib) and is trusted, the owner of
+# the database can create it
+create_btree_gin = DDL("CREATE EXTENSION IF NOT EXISTS btree_gin")
+event.listen(FeedEntry.metadata, "before_create", create_btree_gin)
+
+
+# entries written through the orm (by admins) store their content and
+# search vector within the flush, ingest does it in bulk itself
+@event.listens_for(FeedEntry, "before_insert")
+@event.listens_for(FeedEntry, "before_update")
+def store_content(mapper, connection, entry: FeedEntry):
+    changed = [
+        name
+        for name in ("title", "summary", "content_hash")
+        if inspect(entry).attrs[name].history.has_changes()
+    ]
+    if entry.id is not None and not changed:
+        return
+    if "_new_content" in entry.__dict__:
+        content = entry.__dict__.pop("_new_content")
+        if content is not None:
+            EntryContent.store(
+                connection, [EntryContent.make_row(content, entry.feed_id)])
+    else:
+        content = EntryContent.text_of(connection, entry.content_hash)
+    entry.search_vector = make_search_vector(entry.title, entry.summary, content)
+
+
+# entries created or deleted through the orm (by admins) keep the counters
+# right within the flush, ingest inserts with core and counts them itself
+@event.listens_for(FeedEntry, "after_insert")
+def count_created_entry(mapper, connection, entry: FeedEntry):
+    connection.execute(
+        update(Feed)
+        .where(Feed.id == entry.feed_id)
+        .values(entry_count=Feed.entry_count + 1)
+    )
+
+
+@event.listens_for(FeedEntry, "before_delete")
+def count_deleted_entry(mapper, connection, entry: FeedEntry):
+    connection.execute(
+        update(Feed)
+        .where(Feed.id == entry.feed_id)
+        .values(entry_count=func.greatest(Feed.entry_count - 1, 0))
+    )
+    readers = select(UserFeedEntryState.user_id).where(
+        UserFeedEntryState.feed_entry_id == entry.id,
+        UserFeedEntryState.is_read == True,
+    )
+    connection.execute(
+        update(UserFeedState)
+        .where(
+            UserFeedState.feed_id == entry.feed_id,
+            UserFeedState.user_id.in_(readers),
+        )
+        .values(read_count=func.greatest(UserFeedState.read_count - 1, 0))
+    )
 
 
 class UserFeedEntryState(BaseModel):
@@ -129,6 +810,14 @@ class UserFeedEntryState(BaseModel):
         UniqueConstraint(
             "user_id", "feed_entry_id", name="user_feed_entry_state_unique"
         ),
+        # entry lists probe it per entry, and covering the flags makes that
+        # an index only scan. it also serves the entry's readers and cascades
+        Index(
+            "ix_user_feed_entry_states_feed_entry_id_user_id",
+            "feed_entry_id",
+            "user_id",
+            postgresql_include=["is_read", "is_favorite"],
+        ),
     )
 
     @classmethod
@@ -146,25 +835,66 @@ class UserFeedEntryState(BaseModel):
             user_state = cls(feed_entry_id=feed_entry_id, user_id=user_id)
         return user_state
 
+    # read state is flipped with a single statement which only returns a row
+    # when the state did change, so concurrent requests can't count a read
+    # twice in the user's read_count. every change of a user's states bumps
+    # the user's cache version
+
     @classmethod
     def mark_read(cls, db: Session, feed_entry_id: int, user_id: int):
-        user_state = cls.get_or_create(db, feed_entry_id, user_id)
-        user_state.is_read = True
-        user_state.read_time = datetime.now()
-        user_state.save(db)
+        feed_id = db.query(FeedEntry.feed_id).filter(
+            FeedEntry.id == feed_entry_id).scalar()
+        if feed_id is None:
+            return
+        now = datetime.now()
+        flipped = db.execute(
+            insert(cls)
+            .values(
+                feed_entry_id=feed_entry_id,
+                user_id=user_id,
+                is_read=True,
+                read_time=now,
+            )
+            .on_conflict_do_update(
+                constraint="user_feed_entry_state_unique",
+                set_={"is_read": True, "read_time": now},
+                where=cls.is_read.isnot(True),
+            )
+            .returning(cls.id)
+        ).first()
+        if flipped:
+            UserFeedState.add_reads(db, user_id, feed_id, 1)
+        db.commit()
+        if flipped:
+            response_cache.bump("user", [user_id])
 
     @classmethod
     def mark_unread(cls, db: Session, feed_entry_id: int, user_id: int):
-        user_state = cls.get_item(db, feed_entry_id, user_id)
-        if user_state and user_state.is_read:
-            user_state.is_read = False
-            user_state.save(db)
+        flipped = db.execute(
+            update(cls)
+            .where(
+                cls.feed_entry_id == feed_entry_id,
+                cls.user_id == user_id,
+                cls.is_read == True,
+            )
+            .values(is_read=False)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if flipped:
+            feed_id = db.query(FeedEntry.feed_id).filter(
+                FeedEntry.id == feed_entry_id).scalar()
+            UserFeedState.add_reads(db, user_id, feed_id, -1)
+        db.commit()
+        if flipped:
+            response_cache.bump("user", [user_id])
 
     @classmethod
     def favorite(cls, db: Session, feed_entry_id: int, user_id: int):
         user_state = cls.get_or_create(db, feed_entry_id, user_id)
         user_state.is_favorite = True
         user_state.save(db)
+        response_cache.bump("user", [user_id])
 
     @classmethod
     def unfavorite(cls, db: Session, feed_entry_id: int, user_id: int):
@@ -172,6 +902,133 @@ class UserFeedEntryState(BaseModel):
         if user_state and user_state.is_favorite:
             user_state.is_favorite = False
             user_state.save(db)
+            response_cache.bump("user", [user_id])
+
+    # batch versions of the above, each flag is set with one set based
+    # statement whatever the number of entries, and returns the ids of the
+    # entries whose state did change
+
+    @classmethod
+    def _upsert(
+        cls, db: Session, user_id: int, entries, values: dict, changed
+    ) -> List[int]:
+        # entries is a select of the entry ids to insert states for
+        return db.execute(
+            insert(cls)
+            .from_select(
+                ["user_id", "feed_entry_id"] + list(values),
+                select(
+                    literal(user_id),
+                    entries.c.id,
+                    *(literal(value) for value in values.values()),
+                ),
+                include_defaults=True,
+            )
+            .on_conflict_do_update(
+                constraint="user_feed_entry_state_unique",
+                set_={name: insert(cls).excluded[name] for name in values},
+                where=changed,
+            )
+            .returning(cls.feed_entry_id)
+        ).scalars().all()
+
+    @classmethod
+    def mark_feed_read(
+        cls,
+        db: Session,
+        feed_id: int,
+        user_id: int,
+        before_id: Optional[int] = None,
+    ) -> int:
+        """
+        Marks every entry of the feed (older than before_id) as read
+        """
+        entries = select(FeedEntry.id).where(FeedEntry.feed_id == feed_id)
+        if before_id is not None:
+            entries = entries.where(FeedEntry.id < before_id)
+        flipped = cls._upsert(
+            db,
+            user_id,
+            entries.subquery(),
+            {"is_read": True, "read_time": datetime.now()},
+            cls.is_read.isnot(True),
+        )
+        if flipped:
+            UserFeedState.add_reads(db, user_id, feed_id, len(flipped))
+        db.commit()
+        if flipped:
+            response_cache.bump("user", [user_id])
+        return len(flipped)
+
+    @classmethod
+    def set_read_many(
+        cls, db: Session, feed_entry_ids: List[int], user_id: int, is_read: bool
+    ) -> int:
+        feeds = dict(
+            db.query(FeedEntry.id, FeedEntry.feed_id)
+            .filter(FeedEntry.id.in_(feed_entry_ids))
+            .all()
+        )
+        if not feeds:
+            return 0
+        if is_read:
+            flipped = cls._upsert(
+                db,
+                user_id,
+                select(FeedEntry.id).where(FeedEntry.id.in_(list(feeds))).subquery(),
+                {"is_read": True, "read_time": datetime.now()},
+                cls.is_read.isnot(True),
+            )
+        else:
+            # entries without a state are unread already
+            flipped = db.execute(
+                update(cls)
+                .where(
+                    cls.feed_entry_id.in_(feeds),
+                    cls.user_id == user_id,
+                    cls.is_read == True,
+                )
+                .values(is_read=False)
+                .returning(cls.feed_entry_id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+        reads = Counter(feeds[feed_entry_id] for feed_entry_id in flipped)
+        for feed_id, count in reads.items():
+            UserFeedState.add_reads(
+                db, user_id, feed_id, count if is_read else -count)
+        db.commit()
+        if flipped:
+            response_cache.bump("user", [user_id])
+        return len(flipped)
+
+    @classmethod
+    def set_favorite_many(
+        cls, db: Session, feed_entry_ids: List[int], user_id: int, is_favorite: bool
+    ) -> int:
+        if is_favorite:
+            changed = cls._upsert(
+                db,
+                user_id,
+                select(FeedEntry.id).where(FeedEntry.id.in_(feed_entry_ids)).subquery(),
+                {"is_favorite": True},
+                cls.is_favorite.isnot(True),
+            )
+        else:
+            changed = db.execute(
+                update(cls)
+                .where(
+                    cls.feed_entry_id.in_(feed_entry_ids),
+                    cls.user_id == user_id,
+                    cls.is_favorite == True,
+                )
+                .values(is_favorite=False)
+                .returning(cls.feed_entry_id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+        db.commit()
+        if changed:
+            response_cache.bump("user", [user_id])
+        return len(changed)
 
 
 class Comment(BaseModel):
@@ -184,3 +1041,26 @@ class Comment(BaseModel):
         "entries.id", ondelete="CASCADE"))
     feed_entry = relationship("FeedEntry", backref="comments")
     content = Column(String)
+
+    __table_args__ = (
+        # comments of an entry are paged oldest first, by keyset
+        Index("ix_comments_feed_entry_id_id", "feed_entry_id", "id"),
+    )
+
+
+@event.listens_for(Comment, "after_insert")
+def count_created_comment(mapper, connection, comment: Comment):
+    connection.execute(
+        update(FeedEntry)
+        .where(FeedEntry.id == comment.feed_entry_id)
+        .values(comment_count=FeedEntry.comment_count + 1)
+    )
+
+
+@event.listens_for(Comment, "before_delete")
+def count_deleted_comment(mapper, connection, comment: Comment):
+    connection.execute(
+        update(FeedEntry)
+        .where(FeedEntry.id == comment.feed_entry_id)
+        .values(comment_count=func.greatest(FeedEntry.comment_count - 1, 0))
+    )
@@ -0,0 +1,250 @@
+import calendar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from typing import List, Optional
+
+import feedparser
+from dateutil import parser as date_parser
+from feedparser.sanitizer import _sanitize_html
+from lxml import etree
+
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+CONTENT_NS = "http://purl.org/rss/1.0/modules/content/"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+
+ATOM_ENTRY = "{%s}entry" % ATOM_NS
+ATOM_TITLE = "{%s}title" % ATOM_NS
+ATOM_LINK = "{%s}link" % ATOM_NS
+
+
+class ParsedFeed:
+    def __init__(
+        self,
+        title: str = None,
+        entries: List[dict] = None,
+        hub: str = None,
+        self_url: str = None,
+    ):
+        self.title = title
+        self.entries = entries or []
+        # websub hub the feed advertises and the topic url to subscribe with
+        self.hub = hub
+        self.self_url = self_url
+
+    def set_link(self, rel: Optional[str], href: Optional[str]):
+        if not href:
+            return
+        if rel == "hub" and self.hub is None:
+            self.hub = href.strip()
+        elif rel == "self" and self.self_url is None:
+            self.self_url = href.strip()
+
+
+def parse_feed(content: bytes, since: datetime = None) -> Optional[ParsedFeed]:
+    """
+    Parses a feed document into the fields the ingest keeps
+
+    well-formed rss 2.0 and atom documents go through an incremental lxml
+    parser, which stops once entries get older than `since` (when the
+    document lists them newest first). everything else falls back to
+    feedparser. returns None for invalid documents
+    """
+    try:
+        parsed = _fast_parse(content, since)
+    except etree.XMLSyntaxError:
+        parsed = None
+    if parsed is None:
+        parsed = _feedparser_parse(content)
+    return parsed
+
+
+def _fast_parse(content: bytes, since: datetime = None) -> Optional[ParsedFeed]:
+    events = etree.iterparse(
+        BytesIO(content),
+        events=("start", "end"),
+        resolve_entities=False,
+        no_network=True,
+        huge_tree=False,
+    )
+    _, root = next(events)
+    if root.tag == "rss":
+        entry_tag, parse_entry = "item", _rss_entry
+        title_tag, title_parent = "title", "channel"
+    elif root.tag == "{%s}feed" % ATOM_NS:
+        entry_tag, parse_entry = ATOM_ENTRY, _atom_entry
+        title_tag, title_parent = ATOM_TITLE, root.tag
+    else:
+        return None
+
+    parsed = ParsedFeed()
+    stop = _EarlyStop(since)
+    for event, element in events:
+        if event != "end":
+            continue
+        if element.tag == entry_tag:
+            entry = parse_entry(element)
+            parsed.entries.append(entry)
+            # entries are done, drop them to keep the tree small
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if stop.reached(entry["published_parsed"]):
+                break
+        elif (
+            element.tag == title_tag
+            and parsed.title is None
+            and element.getparent().tag == title_parent
+        ):
+            parsed.title = _text(element)
+        elif element.tag == ATOM_LINK and element.getparent().tag == title_parent:
+            parsed.set_link(element.get("rel"), element.get("href"))
+
+    for entry in parsed.entries:
+        entry["published_at"] = entry.pop("published_parsed") or _now()
+    return parsed
+
+
+class _EarlyStop:
+    """
+    Tells when two consecutive entries are older than `since` while the
+    document lists entries newest first, the rest of it is assumed to be old
+    """
+
+    def __init__(self, since: datetime = None):
+        self.since = since
+        self.previous = None
+        self.old_in_a_row = 0
+
+    def reached(self, published: Optional[datetime]) -> bool:
+        if self.since is None or published is None:
+            self.old_in_a_row = 0
+            return False
+        if self.previous is not None and published > self.previous:
+            # oldest first (or unordered) documents are read to the end
+            self.since = None
+            return False
+        self.previous = published
+        self.old_in_a_row = self.old_in_a_row + 1 if published < self.since else 0
+        return self.old_in_a_row >= 2
+
+
+def _rss_entry(item) -> dict:
+    description = item.findtext("description")
+    content = item.findtext("{%s}encoded" % CONTENT_NS)
+    guid = item.findtext("guid")
+    link = item.findtext("link")
+    published = item.findtext("pubDate") or item.findtext("{%s}date" % DC_NS)
+    return {
+        "id": (guid or "").strip(),
+        "title": (item.findtext("title") or "").strip(),
+        "subtitle": "",
+        "link": (link or "").strip(),
+        "author": (
+            item.findtext("author") or item.findtext("{%s}creator" % DC_NS) or ""
+        ).strip(),
+        "summary": _sanitize(description),
+        "content": _sanitize(content) + "\n" if content else "\n",
+        "published_parsed": _parse_date(published),
+    }
+
+
+def _atom_entry(entry) -> dict:
+    link = ""
+    for element in entry.iterfind("{%s}link" % ATOM_NS):
+        if element.get("rel", "alternate") == "alternate":
+            link = element.get("href", "")
+            break
+    content = entry.find("{%s}content" % ATOM_NS)
+    published = entry.findtext("{%s}published" % ATOM_NS) or entry.findtext(
+        "{%s}updated" % ATOM_NS
+    )
+    return {
+        "id": (entry.findtext("{%s}id" % ATOM_NS) or "").strip(),
+        "title": _text(entry.find(ATOM_TITLE)),
+        "subtitle": "",
+        "link": link.strip(),
+        "author": (
+            entry.findtext("{%s}author/{%s}name" % (ATOM_NS, ATOM_NS)) or ""
+        ).strip(),
+        "summary": _sanitize(_text(entry.find("{%s}summary" % ATOM_NS))),
+        "content": _sanitize(_text(content)) + "\n" if content is not None else "\n",
+        "published_parsed": _parse_date(published),
+    }
+
+
+# atom text constructs may hold xhtml markup instead of (escaped) text
+def _text(element) -> str:
+    if element is None:
+        return ""
+    if element.get("type") == "xhtml":
+        return "".join(
+            etree.tostring(child, encoding="unicode", with_tail=True)
+            for child in element
+        ).strip()
+    return (element.text or "").strip()
+
+
+# same html sanitizing feedparser applies, clients render these fields
+def _sanitize(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    if "<" not in value:
+        return value
+    return _sanitize_html(value, "utf-8", "text/html")
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        published = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        try:
+            published = date_parser.parse(value)
+        except (ValueError, OverflowError):
+            return None
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=timezone.utc)
+    return published.astimezone(timezone.utc)
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _feedparser_parse(content: bytes) -> Optional[ParsedFeed]:
+    parsed = feedparser.parse(content)
+    if parsed.bozo == 1:
+        return None
+
+    entries = []
+    for entry in parsed.entries:
+        published = None
+        for attr in ("published_parsed", "updated_parsed", "created_parsed"):
+            if entry.get(attr):
+                published = datetime.fromtimestamp(
+                    calendar.timegm(entry.get(attr)), tz=timezone.utc
+                )
+                break
+        content = ""
+        for item in entry.get("content", [{}]):
+            content += item.get("value", "") + "\n"
+        entries.append(
+            {
+                "id": entry.get("id", ""),
+                "title": entry.get("title", ""),
+                "subtitle": entry.get("subtitle", ""),
+                "link": entry.get("link", ""),
+                "author": entry.get("author", ""),
+                "summary": entry.get("summary", ""),
+                "content": content,
+                "published_at": published or _now(),
+            }
+        )
+    feed = ParsedFeed(title=parsed.feed.get("title"), entries=entries)
+    for link in parsed.feed.get("links", []):
+        feed.set_link(link.get("rel"), link.get("href"))
+    return feed
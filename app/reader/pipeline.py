@@ -0,0 +1,229 @@
+"""
+Ingest pipeline: fetch -> parse -> persist
+
+each stage has its own concurrency and bounded queues sit between them,
+so a slow stage applies back pressure instead of piling up documents:
+
+- fetch: coroutines on the shared FetchClient (I/O bound)
+- parse: the process pool of the worker process running parse_feed (CPU
+  bound), or threads when processes can't be forked (celery prefork
+  children are daemonic, they are many processes parsing already)
+- persist: threads writing the outcomes of many feeds in one transaction
+
+run it standalone, claiming due feeds itself, with
+
+    python -m app.reader.pipeline
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, List
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.reader.fetcher import FetchClient, get_fetch_client
+from app.reader.ingest import (
+    FeedSnapshot,
+    IngestOutcome,
+    fetch_outcome,
+    parse_outcome,
+    persist_outcomes,
+)
+from app.reader.models import Feed
+from app.reader.websub import subscribe_feeds
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+_parse_pid = None
+_parse_pool = None
+
+
+def can_fork() -> bool:
+    # daemonic processes aren't allowed to have children
+    return not multiprocessing.current_process().daemon
+
+
+def get_parse_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    The parse processes of this process, forked once and kept for the runs
+    that follow
+    """
+    global _parse_pid, _parse_pool
+    if _parse_pid != os.getpid():
+        _parse_pid = os.getpid()
+        _parse_pool = None
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(workers)
+    return _parse_pool
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        client: FetchClient = None,
+        fetch_concurrency: int = None,
+        parse_workers: int = None,
+        parse_processes: bool = None,
+        persist_workers: int = None,
+        persist_batch_size: int = None,
+        queue_size: int = None,
+    ):
+        self.client = client
+        self.fetch_concurrency = fetch_concurrency or settings.FEED_FETCH_CONCURRENCY
+        self.parse_workers = parse_workers or settings.INGEST_PARSE_WORKERS
+        if parse_processes is None:
+            parse_processes = settings.INGEST_PARSE_PROCESSES and can_fork()
+        self.parse_processes = parse_processes
+        self.persist_workers = persist_workers or settings.INGEST_PERSIST_WORKERS
+        self.persist_batch_size = (
+            persist_batch_size or settings.INGEST_PERSIST_BATCH_SIZE
+        )
+        self.queue_size = queue_size or settings.INGEST_QUEUE_SIZE
+
+    async def run(self, feeds: Iterable[FeedSnapshot]) -> List[IngestOutcome]:
+        client = self.client or get_fetch_client()
+        feed_queue = asyncio.Queue()
+        for feed in feeds:
+            feed_queue.put_nowait(feed)
+        parse_queue = asyncio.Queue(self.queue_size)
+        persist_queue = asyncio.Queue(self.queue_size)
+        outcomes = []
+
+        if self.parse_processes:
+            parse_executor = get_parse_pool(self.parse_workers)
+        else:
+            parse_executor = ThreadPoolExecutor(self.parse_workers)
+        persist_executor = ThreadPoolExecutor(self.persist_workers)
+        try:
+            parsers = [
+                asyncio.ensure_future(
+                    self._parse(parse_queue, persist_queue, parse_executor)
+                )
+                for _ in range(self.parse_workers)
+            ]
+            persisters = [
+                asyncio.ensure_future(
+                    self._persist(persist_queue, persist_executor, outcomes)
+                )
+                for _ in range(self.persist_workers)
+            ]
+            await asyncio.gather(
+                *(
+                    self._fetch(client, feed_queue, parse_queue)
+                    for _ in range(self.fetch_concurrency)
+                )
+            )
+            for _ in parsers:
+                await parse_queue.put(_DONE)
+            await asyncio.gather(*parsers)
+            for _ in persisters:
+                await persist_queue.put(_DONE)
+            await asyncio.gather(*persisters)
+        finally:
+            if not self.parse_processes:
+                parse_executor.shutdown()
+            persist_executor.shutdown()
+        return outcomes
+
+    @staticmethod
+    async def _fetch(
+        client: FetchClient, feed_queue: asyncio.Queue, parse_queue: asyncio.Queue
+    ):
+        while not feed_queue.empty():
+            feed = feed_queue.get_nowait()
+            result = await client.fetch(feed.id, feed.url, feed.headers)
+            await parse_queue.put((feed, fetch_outcome(feed, result)))
+
+    @staticmethod
+    async def _parse(
+        parse_queue: asyncio.Queue, persist_queue: asyncio.Queue, executor: Executor
+    ):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await parse_queue.get()
+            if item is _DONE:
+                return
+            feed, outcome = item
+            if outcome.needs_parse:
+                try:
+                    outcome = await loop.run_in_executor(
+                        executor, parse_outcome, outcome, feed.parse_since
+                    )
+                except Exception:
+                    logger.exception("Parsing feed %s failed", feed.url)
+                    outcome.set_parsed(None)
+            await persist_queue.put(outcome)
+
+    async def _persist(
+        self, persist_queue: asyncio.Queue, executor: Executor, outcomes: list
+    ):
+        loop = asyncio.get_event_loop()
+        done = False
+        while not done:
+            # wait for one outcome, then take whatever else is ready
+            batch = []
+            item = await persist_queue.get()
+            while True:
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.persist_batch_size or persist_queue.empty():
+                    break
+                item = persist_queue.get_nowait()
+            if batch:
+                await loop.run_in_executor(executor, _persist_batch, batch)
+                outcomes += batch
+
+
+# a failed batch is left to the fetch lease, its feeds get claimed again
+def _persist_batch(outcomes: List[IngestOutcome]):
+    db = SessionLocal()
+    try:
+        persist_outcomes(db, outcomes)
+    except Exception:
+        db.rollback()
+        logger.exception("Persisting %d feeds failed", len(outcomes))
+    finally:
+        db.close()
+
+
+def load_snapshots(feed_ids: List[int]) -> List[FeedSnapshot]:
+    db = SessionLocal()
+    try:
+        return [
+            FeedSnapshot(feed)
+            for feed in db.query(Feed).filter(Feed.id.in_(feed_ids))
+        ]
+    finally:
+        db.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    client = FetchClient()
+    pipeline = IngestPipeline(client=client)
+    loop = asyncio.new_event_loop()
+    while True:
+        db = SessionLocal()
+        feed_ids = Feed.claim_due(db)
+        db.close()
+        if not feed_ids:
+            time.sleep(settings.FEED_SCHEDULER_INTERVAL)
+            continue
+        started = time.monotonic()
+        outcomes = loop.run_until_complete(pipeline.run(load_snapshots(feed_ids)))
+        logger.info(
+            "ingested %d feeds in %.1fs", len(outcomes), time.monotonic() - started
+        )
+        subscribe_feeds([outcome.feed_id for outcome in outcomes if outcome.subscribe])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Replays archived feed documents through the parse and persist stages, at
+full speed and without network access
+
+    python -m app.reader.replay --feed 12 --feed 13 --since 2021-08-01
+
+entries we already have are skipped by the (feed_id, guid_hash) constraint
+so a replay is safe to repeat, and it leaves the fetch state of the feeds
+alone. with --dry-run documents are only parsed, which makes the archive a
+realistic and deterministic ingest benchmark corpus
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterable, Iterator, List
+
+from dateutil import parser as date_parser
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.reader.archive import FeedArchive, get_archive
+from app.reader.ingest import IngestOutcome, parse_outcome, persist_outcomes
+
+
+def replay_key(key: str) -> IngestOutcome:
+    # runs in the pool, reading and decompressing are spread over it too
+    feed_id, fetched_at = FeedArchive.parse_key(key)
+    outcome = IngestOutcome(
+        feed_id,
+        IngestOutcome.REPLAYED,
+        content=get_archive().get(key),
+        fetched_at=fetched_at,
+    )
+    return parse_outcome(outcome)
+
+
+def batches(keys: Iterable[str], size: int) -> Iterator[List[str]]:
+    keys = iter(keys)
+    while True:
+        batch = list(islice(keys, size))
+        if not batch:
+            return
+        yield batch
+
+
+def replay(
+    keys: Iterable[str],
+    workers: int = None,
+    batch_size: int = None,
+    persist: bool = True,
+) -> dict:
+    workers = workers or settings.INGEST_PARSE_WORKERS
+    batch_size = batch_size or settings.INGEST_PERSIST_BATCH_SIZE
+    stats = dict(documents=0, invalid=0, entries=0)
+    started = time.monotonic()
+    db = SessionLocal() if persist else None
+    try:
+        with Pool(workers) as pool:
+            # the keys are consumed a batch at a time, so memory stays flat
+            # however large the archive is
+            for batch in batches(keys, batch_size):
+                outcomes = pool.map(replay_key, batch)
+                for outcome in outcomes:
+                    stats["documents"] += 1
+                    if outcome.parsed is None:
+                        stats["invalid"] += 1
+                    else:
+                        stats["entries"] += len(outcome.parsed.entries)
+                if persist:
+                    persist_outcomes(
+                        db, [outcome for outcome in outcomes if outcome.parsed]
+                    )
+    finally:
+        if db is not None:
+            db.close()
+    elapsed = time.monotonic() - started
+    stats.update(
+        elapsed=round(elapsed, 3),
+        documents_per_sec=round(stats["documents"] / elapsed, 1),
+        entries_per_sec=round(stats["entries"] / elapsed, 1),
+    )
+    return stats
+
+
+def parse_date(value: str) -> datetime:
+    parsed = date_parser.parse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--archive", help="archive url, defaults to the ARCHIVE_URL setting")
+    parser.add_argument(
+        "--feed", type=int, action="append", help="only replay this feed id")
+    parser.add_argument("--since", type=parse_date,
+                        help="only documents fetched since")
+    parser.add_argument("--until", type=parse_date,
+                        help="only documents fetched before")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="parse without storing anything"
+    )
+    args = parser.parse_args()
+
+    if args.archive:
+        settings.ARCHIVE_URL = args.archive
+    archive = get_archive()
+    if archive is None:
+        parser.error("no archive, set ARCHIVE_URL or pass --archive")
+
+    stats = replay(
+        archive.keys(args.feed, args.since, args.until),
+        workers=args.workers,
+        batch_size=args.batch_size,
+        persist=not args.dry_run,
+    )
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Deletes the entries past their retention, see the ENTRY_RETENTION_*
+settings
+
+entries are deleted in small batches of a shard of feeds at a time, each
+in its own transaction, so the locks are short and the ingest running
+meanwhile isn't held up
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from app.core.cache import response_cache
+from app.core.config import settings
+from app.reader.models import Feed, FeedEntry
+
+
+logger = logging.getLogger(__name__)
+
+
+def retention_cutoff(now: datetime = None) -> Optional[datetime]:
+    """
+    The entries published before it are past their retention, None while
+    entries are kept forever
+    """
+    if settings.ENTRY_RETENTION_DAYS is None:
+        return None
+    return (now or datetime.now(timezone.utc)) - timedelta(
+        days=settings.ENTRY_RETENTION_DAYS
+    )
+
+
+def apply_retention(db: Session, now: datetime = None) -> int:
+    """
+    Deletes the expired entries of every feed, returns how many
+    """
+    before = retention_cutoff(now)
+    if before is None:
+        return 0
+    deleted = 0
+    last_feed_id = 0
+    while True:
+        feed_ids = [
+            feed_id
+            for feed_id, in db.query(Feed.id)
+            .filter(Feed.id > last_feed_id)
+            .order_by(Feed.id)
+            .limit(settings.FEED_SHARD_SIZE)
+        ]
+        if not feed_ids:
+            break
+        last_feed_id = feed_ids[-1]
+        while True:
+            entries = FeedEntry.expired(
+                db,
+                feed_ids,
+                before,
+                settings.ENTRY_RETENTION_KEEP_LAST,
+                settings.ENTRY_RETENTION_BATCH_SIZE,
+            )
+            if not entries:
+                break
+            FeedEntry.delete_many(db, entries)
+            db.commit()
+            # the lists and counters of their feeds, and their cached bodies
+            response_cache.bump("feed", {entry.feed_id for entry in entries})
+            response_cache.forget("entry", [entry.id for entry in entries])
+            deleted += len(entries)
+    logger.info("Deleted %d entries published before %s", deleted, before)
+    return deleted
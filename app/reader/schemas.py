@@ -1,21 +1,31 @@
 import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from sqlalchemy.sql.elements import and_, not_, or_
+from sqlalchemy.sql.elements import and_
+from sqlalchemy.sql.expression import cast, select, true, tuple_
+from sqlalchemy.sql.functions import func
+from sqlalchemy.orm import joinedload, noload
 from sqlalchemy.orm.session import Session
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from pydantic import conlist
 from pydantic.networks import AnyHttpUrl
 
+from app.core.cache import response_cache
+from app.core.config import settings
 from app.utils.i18n import trans
 from app.utils.exceptions import CustomException
+from app.utils.utils import decode_cursor, encode_cursor
 from app.authnz.schemas import UserPublicProfile
 from app.reader.utils import validate_feed_url
 from app.reader.tasks import feed_parser
 from app.reader.models import (
+    SEARCH_CONFIG,
     Comment,
     Feed,
     FeedEntry,
     UserFeedEntryState,
     UserFeedState,
+    user_feed_table,
 )
 from app.utils.schema import BaseFullModel, BaseIdModel, BaseOrmModel
 from app.authnz.models import User
@@ -62,30 +72,107 @@ class FeedResponse(BaseFullModel):
 
     @classmethod
     def for_user(cls, db: Session, user_id: int, feed: Feed):
-        all_feed_entries = len(feed.entries)
-        reads = (
-            db.query(UserFeedEntryState)
-            .filter(
-                UserFeedEntryState.feed_entry.has(feed_id=feed.id),
-                UserFeedEntryState.user_id == user_id,
-                UserFeedEntryState.is_read == True,
-            )
-            .count()
-        )
-
         validated = cls.from_orm(feed)
-        validated.unread_count = all_feed_entries - reads
+        validated.unread_count = UserFeedState.unread_count(db, feed, user_id)
         return validated
 
+    @classmethod
+    def cached_for_user(cls, db: Session, user_id: int, feed_id: int):
+        def load():
+            feed = db.get(Feed, feed_id)
+            if not feed:
+                raise CustomException(detail=trans("Feed does not exist"))
+            return cls.for_user(db, user_id, feed).dict()
+
+        return cls.parse_obj(
+            response_cache.get_or_set(
+                "feed",
+                settings.CACHE_FEED_TTL,
+                load,
+                feed=[feed_id],
+                user=[user_id],
+            )
+        )
+
 
 class FeedListItem(BaseIdModel):
     title: Optional[str] = None
     url: Optional[str] = None
+    unread_count: Optional[int] = None
 
 
 class FeedListResponse(BaseOrmModel):
     __root__: List[FeedListItem]
 
+    @classmethod
+    def for_user(cls, db: Session, user_id: int):
+        # the counters of every subscribed feed, in the same query
+        query = (
+            db.query(Feed, UserFeedState.read_count)
+            .outerjoin(
+                UserFeedState,
+                and_(
+                    UserFeedState.feed_id == Feed.id,
+                    UserFeedState.user_id == user_id,
+                ),
+            )
+            .filter(Feed.subscribers.any(id=user_id))
+            .options(*Feed.load_options(FeedListItem, "entry_count"))
+        )
+        items = []
+        for feed, read_count in query:
+            item = FeedListItem.from_orm(feed)
+            item.unread_count = max((feed.entry_count or 0) - (read_count or 0), 0)
+            items.append(item)
+        return cls(__root__=items)
+
+    @classmethod
+    def cached_for_user(cls, db: Session, user_id: int):
+        # subscribing bumps the user's version, new entries the feed's one
+        feed_ids = response_cache.get_or_set(
+            "subscriptions",
+            settings.CACHE_LIST_TTL,
+            lambda: db.execute(
+                select(user_feed_table.c.feed_id).where(
+                    user_feed_table.c.user_id == user_id
+                )
+            ).scalars().all(),
+            user=[user_id],
+        )
+        return cls.parse_obj(
+            response_cache.get_or_set(
+                "my_feed",
+                settings.CACHE_LIST_TTL,
+                lambda: cls.for_user(db, user_id).dict(),
+                user=[user_id],
+                feed=feed_ids,
+            )
+        )
+
+
+class FeedCircuitItem(BaseIdModel):
+    url: str
+    title: Optional[str] = None
+    failure_count: int
+    last_error_class: Optional[str] = None
+    circuit_open_until: Optional[datetime.datetime] = None
+
+
+class FeedCircuitListResponse(BaseOrmModel):
+    __root__: List[FeedCircuitItem]
+
+
+class CacheStatsItem(BaseOrmModel):
+    hit: int
+    miss: int
+    hit_ratio: Optional[float] = None
+
+
+class CacheStatsResponse(BaseOrmModel):
+    # false while redis can't be reached, names is empty then
+    available: bool
+    names: Dict[str, CacheStatsItem]
+
 
 class FeedAdminValidator(BaseIdModel):
     url: Optional[AnyHttpUrl] = None
@@ -108,47 +195,359 @@ class FeedEntryListResponse(BaseOrmModel):
     __root__: List[FeedEntryListItem]
 
     @staticmethod
-    def list_for_user(db: Session, feed_id: int, user_id: int, index: int, total: int):
+    def entries_query(db: Session, feed_id: int, user_id: int):
+        # at most one state per (entry, user), so the outer join keeps one
+        # row per entry and walks the (feed_id, id DESC) index
+        return (
+            db.query(
+                FeedEntry,
+                UserFeedEntryState.is_read,
+                UserFeedEntryState.is_favorite,
+            )
+            .outerjoin(
+                UserFeedEntryState,
+                and_(
+                    UserFeedEntryState.feed_entry_id == FeedEntry.id,
+                    UserFeedEntryState.user_id == user_id,
+                ),
+            )
+            .filter(FeedEntry.feed_id == feed_id)
+            .order_by(FeedEntry.id.desc())
+            .options(*FeedEntry.load_options(FeedEntryListItem, "created"))
+        )
+
+    @staticmethod
+    def list_for_user(
+        db: Session,
+        feed_id: int,
+        user_id: int,
+        index: int,
+        total: int,
+        cursor: Optional[str] = None,
+    ):
+        """
+        A page of the feed's entries, newest first. with a cursor (returned
+        with the previous page) the page starts right after its last entry,
+        so deep pages cost the same as the first one and new entries can't
+        shift it. returns the page and the cursor of the next page
+        """
+        last_id = None
+        if cursor:
+            # ids only grow, entries ingested meanwhile sort before the cursor
+            (last_id,) = decode_cursor(cursor, int)
+        page = response_cache.get_or_set(
+            "entry_list",
+            settings.CACHE_LIST_TTL,
+            lambda: FeedEntryListResponse.load_page(
+                db, feed_id, user_id, index, total, last_id
+            ),
+            feed_id,
+            last_id if last_id is not None else "index-%d" % index,
+            total,
+            feed=[feed_id],
+            user=[user_id],
+        )
+
         list_of_entries = []
         # fetch state of the feed
         feed_state = UserFeedState.get_item(db, feed_id, user_id)
+        for row in page:
+            item = FeedEntryListItem.parse_obj(row)
+            # is_new depends on the user's previous visit, not on the page
+            if feed_state and feed_state.last_entry_fetch_time and row["created"]:
+                created = datetime.datetime.fromisoformat(row["created"])
+                item.is_new = feed_state.last_entry_fetch_time < created
+            list_of_entries.append(item)
+        UserFeedState.update_fetch_time(db, feed_id, user_id)
+        next_cursor = None
+        if list_of_entries and len(list_of_entries) == total:
+            next_cursor = encode_cursor(list_of_entries[-1].id)
+        return FeedEntryListResponse(__root__=list_of_entries), next_cursor
 
-        # construct the joined query for entry and state
-        user_has_state_filter = and_(
-            UserFeedEntryState.user_id == user_id,
-            FeedEntry.id == UserFeedEntryState.feed_entry_id,
+    @staticmethod
+    def load_page(
+        db: Session,
+        feed_id: int,
+        user_id: int,
+        index: int,
+        total: int,
+        last_id: Optional[int] = None,
+    ) -> List[dict]:
+        # the page as it is cached, with the creation time of the entries
+        query = FeedEntryListResponse.entries_query(db, feed_id, user_id)
+        if last_id is not None:
+            query = query.filter(FeedEntry.id < last_id)
+        else:
+            query = query.offset(index)
+
+        page = []
+        for feed_entry, is_read, is_favorite in query.limit(total).all():
+            item = FeedEntryListItem.from_orm(feed_entry)
+            item.is_read = bool(is_read)
+            item.is_favorite = bool(is_favorite)
+            created = feed_entry.created.isoformat() if feed_entry.created else None
+            page.append(dict(item.dict(exclude={"is_new"}), created=created))
+        return page
+
+
+class TimelineItem(FeedEntryListItem):
+    feed_id: int
+    published_at: Optional[datetime.datetime] = None
+
+
+class TimelineResponse(BaseOrmModel):
+    __root__: List[TimelineItem]
+
+    @staticmethod
+    def page_query(db: Session, user_id: int, total: int, after=None):
+        """
+        k-way merge of the subscribed feeds: a lateral scan takes the newest
+        total entries of each feed from the (feed_id, published_at, id)
+        index and only those candidates get sorted together
+        """
+        feeds = (
+            select(user_feed_table.c.feed_id)
+            .where(user_feed_table.c.user_id == user_id)
+            .distinct()
+            .subquery()
         )
-        filter_statement = and_(
-            FeedEntry.feed_id == feed_id,
-            or_(user_has_state_filter, not_(
-                FeedEntry.states.any(user_id=user_id))),
+        newest_first = (FeedEntry.published_at.desc(), FeedEntry.id.desc())
+        per_feed = select(FeedEntry.id, FeedEntry.published_at).where(
+            FeedEntry.feed_id == feeds.c.feed_id
         )
-        query = (
-            db.query(FeedEntry, UserFeedEntryState)
-            .order_by(FeedEntry.id.desc())
-            .distinct(FeedEntry.id)
-            .filter(filter_statement)
+        if after:
+            per_feed = per_feed.where(
+                tuple_(FeedEntry.published_at, FeedEntry.id) < tuple_(*after)
+            )
+        per_feed = per_feed.order_by(*newest_first).limit(total).lateral()
+        page = (
+            select(per_feed.c.id)
+            .select_from(feeds.join(per_feed, true()))
+            .order_by(per_feed.c.published_at.desc(), per_feed.c.id.desc())
+            .limit(total)
+            .subquery()
+        )
+        return (
+            db.query(
+                FeedEntry,
+                UserFeedEntryState.is_read,
+                UserFeedEntryState.is_favorite,
+            )
+            .join(page, page.c.id == FeedEntry.id)
+            .outerjoin(
+                UserFeedEntryState,
+                and_(
+                    UserFeedEntryState.feed_entry_id == FeedEntry.id,
+                    UserFeedEntryState.user_id == user_id,
+                ),
+            )
+            .order_by(*newest_first)
+            .options(*FeedEntry.load_options(TimelineItem, "created"))
         )
 
-        # read from query and construct FeedEntryListItems
-        for feed_entry, user_state in query.offset(index).limit(total).all():
-            item = FeedEntryListItem.from_orm(feed_entry)
-            if feed_entry.id == user_state.feed_entry_id:
-                item.is_read = user_state.is_read
-                item.is_favorite = user_state.is_favorite
-            if feed_state:
-                item.is_new = feed_state.last_entry_fetch_time < feed_entry.created
+    @staticmethod
+    def for_user(db: Session, user_id: int, total: int, cursor: Optional[str] = None):
+        """
+        A page of the entries of every subscribed feed, newest first, and the
+        cursor of the next page
+        """
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, datetime.datetime.fromisoformat, int)
+        fetch_times = dict(
+            db.query(UserFeedState.feed_id, UserFeedState.last_entry_fetch_time)
+            .filter(UserFeedState.user_id == user_id)
+            .all()
+        )
+        list_of_entries = []
+        query = TimelineResponse.page_query(db, user_id, total, after)
+        for feed_entry, is_read, is_favorite in query.all():
+            item = TimelineItem.from_orm(feed_entry)
+            item.is_read = bool(is_read)
+            item.is_favorite = bool(is_favorite)
+            fetch_time = fetch_times.get(feed_entry.feed_id)
+            if fetch_time:
+                item.is_new = fetch_time < feed_entry.created
             list_of_entries.append(item)
-        UserFeedState.update_fetch_time(db, feed_id, user_id)
-        return FeedEntryListResponse(__root__=list_of_entries)
+        next_cursor = None
+        if list_of_entries and len(list_of_entries) == total:
+            last = list_of_entries[-1]
+            next_cursor = encode_cursor(last.published_at.isoformat(), last.id)
+        return TimelineResponse(__root__=list_of_entries), next_cursor
+
+
+SEARCH_HEADLINE_OPTIONS = (
+    "MaxFragments=2, MaxWords=20, MinWords=5, StartSel=<b>, StopSel=</b>"
+)
+
+
+class SearchItem(FeedEntryListItem):
+    feed_id: int
+    published_at: Optional[datetime.datetime] = None
+    rank: Optional[float] = None
+    # fragments of the title and summary with the matches in <b></b>
+    title_highlight: Optional[str] = None
+    summary_highlight: Optional[str] = None
+
+
+class SearchResponse(BaseOrmModel):
+    __root__: List[SearchItem]
+
+    @staticmethod
+    def page_query(db: Session, user_id: int, text: str, total: int, after=None):
+        """
+        Entries of the subscribed feeds matching text (web search syntax),
+        best ranked first. a lateral search per feed takes its newest
+        matches of the last FEED_SEARCH_MAX_AGE, its share of
+        FEED_SEARCH_MAX_MATCHES, either from the (feed_id, search_vector)
+        gin index or walking the (feed_id, published_at, id) index when the
+        words are common. only those are ranked and only the returned page
+        is highlighted. after is the (rank, id, max_id) of the last result of
+        the previous page, max_id the newest match of the first page: the
+        pages rank the same matches while new entries are stored
+        """
+        query = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+        feeds = (
+            select(user_feed_table.c.feed_id)
+            .where(user_feed_table.c.user_id == user_id)
+            .distinct()
+            .subquery()
+        )
+        feed_count = db.query(func.count()).select_from(feeds).scalar()
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=settings.FEED_SEARCH_MAX_AGE
+        )
+        per_feed = select(FeedEntry.id, FeedEntry.search_vector).where(
+            FeedEntry.feed_id == feeds.c.feed_id,
+            FeedEntry.search_vector.op("@@")(query),
+            FeedEntry.published_at >= since,
+        )
+        if after:
+            per_feed = per_feed.where(FeedEntry.id <= after[2])
+        per_feed = (
+            per_feed.order_by(FeedEntry.published_at.desc(), FeedEntry.id.desc())
+            .limit(-(-settings.FEED_SEARCH_MAX_MATCHES // max(feed_count, 1)))
+            .lateral()
+        )
+        matches = (
+            select(per_feed).select_from(feeds.join(per_feed, true())).subquery()
+        )
+        # real ranks don't survive the round trip through the cursor, doubles do
+        rank = cast(func.ts_rank_cd(matches.c.search_vector, query), DOUBLE_PRECISION)
+        ranked = select(
+            matches.c.id,
+            rank.label("rank"),
+            func.max(matches.c.id).over().label("max_id"),
+        ).subquery()
+        page = select(ranked)
+        if after:
+            page = page.where(tuple_(ranked.c.rank, ranked.c.id) < tuple_(*after[:2]))
+        page = (
+            page.order_by(ranked.c.rank.desc(), ranked.c.id.desc())
+            .limit(total)
+            .subquery()
+        )
+
+        def headline(column):
+            return func.ts_headline(
+                SEARCH_CONFIG,
+                func.coalesce(column, ""),
+                query,
+                SEARCH_HEADLINE_OPTIONS,
+            )
+
+        return (
+            db.query(
+                FeedEntry,
+                page.c.rank,
+                page.c.max_id,
+                headline(FeedEntry.title),
+                headline(FeedEntry.summary),
+                UserFeedEntryState.is_read,
+                UserFeedEntryState.is_favorite,
+            )
+            .join(page, page.c.id == FeedEntry.id)
+            .outerjoin(
+                UserFeedEntryState,
+                and_(
+                    UserFeedEntryState.feed_entry_id == FeedEntry.id,
+                    UserFeedEntryState.user_id == user_id,
+                ),
+            )
+            .order_by(page.c.rank.desc(), page.c.id.desc())
+            .options(*FeedEntry.load_options(SearchItem))
+        )
+
+    @staticmethod
+    def for_user(
+        db: Session, user_id: int, text: str, total: int, cursor: Optional[str] = None
+    ):
+        """
+        A page of search results and the cursor of the next page
+        """
+        after = decode_cursor(cursor, float, int, int) if cursor else None
+        list_of_entries = []
+        max_id = None
+        query = SearchResponse.page_query(db, user_id, text, total, after)
+        for (
+            feed_entry,
+            rank,
+            max_id,
+            title_highlight,
+            summary_highlight,
+            is_read,
+            is_favorite,
+        ) in query.all():
+            item = SearchItem.from_orm(feed_entry)
+            item.rank = rank
+            item.title_highlight = title_highlight
+            item.summary_highlight = summary_highlight
+            item.is_read = bool(is_read)
+            item.is_favorite = bool(is_favorite)
+            list_of_entries.append(item)
+        next_cursor = None
+        if list_of_entries and len(list_of_entries) == total:
+            last = list_of_entries[-1]
+            next_cursor = encode_cursor(last.rank, last.id, max_id)
+        return SearchResponse(__root__=list_of_entries), next_cursor
 
 
-class FeedEntryCommentItem(BaseOrmModel):
+class FeedEntryCommentItem(BaseIdModel):
     user: UserPublicProfile
     content: str
     created: datetime.datetime
 
 
+class CommentPageResponse(BaseOrmModel):
+    __root__: List[FeedEntryCommentItem]
+
+    @staticmethod
+    def page(query, total: int, cursor: str = None):
+        """
+        A page of a comments query, oldest first, and the cursor of the next
+        one. pages walk the (feed_entry_id, id) index
+        """
+        if cursor:
+            (last_id,) = decode_cursor(cursor, int)
+            query = query.filter(Comment.id > last_id)
+        comments = query.order_by(Comment.id).limit(total).all()
+        next_cursor = None
+        if comments and len(comments) == total:
+            next_cursor = encode_cursor(comments[-1].id)
+        return comments, next_cursor
+
+    @staticmethod
+    def for_entry(db: Session, feed_entry_id: int, total: int, cursor: str = None):
+        # authors come in the same query
+        query = (
+            db.query(Comment)
+            .options(*Comment.load_options(FeedEntryCommentItem, joined=["user"]))
+            .filter(Comment.feed_entry_id == feed_entry_id)
+        )
+        comments, next_cursor = CommentPageResponse.page(query, total, cursor)
+        return CommentPageResponse.from_orm(comments), next_cursor
+
+
 class FeedEntryValidator(BaseFullModel):
     feed: Optional[FeedListItem] = None
     title: Optional[str] = None
@@ -158,26 +557,80 @@ class FeedEntryValidator(BaseFullModel):
     content: Optional[str] = None
     summary: Optional[str] = None
 
+    comment_count: Optional[int] = 0
+    # only the first page, comments_cursor is the cursor of the next one
     comments: List[FeedEntryCommentItem]
+    comments_cursor: Optional[str] = None
     is_read: Optional[bool] = False
     read_time: Optional[datetime.datetime] = None
     is_favorite: Optional[bool] = False
 
     @staticmethod
-    def for_user(db: Session, user_id: User, feed_entry: FeedEntry):
-        feed_entry_validated = FeedEntryValidator.from_orm(feed_entry)
-        user_state = UserFeedEntryState.get_item(db, feed_entry.id, user_id)
+    def for_user(db: Session, user_id: User, feed_entry_id: int):
+        # the body is shared by every user, only the state is theirs
+        body = response_cache.get_or_set(
+            "entry",
+            settings.CACHE_ENTRY_TTL,
+            lambda: FeedEntryValidator.load_body(db, feed_entry_id),
+            entry=[feed_entry_id],
+        )
+        feed_entry_validated = FeedEntryValidator.parse_obj(body)
+        user_state = UserFeedEntryState.get_item(db, feed_entry_id, user_id)
         if user_state:
             feed_entry_validated.is_read = user_state.is_read
             feed_entry_validated.is_favorite = user_state.is_favorite
             feed_entry_validated.read_time = user_state.read_time
         return feed_entry_validated
 
+    @staticmethod
+    def load_body(db: Session, feed_entry_id: int) -> dict:
+        feed_entry = (
+            db.query(FeedEntry)
+            .options(
+                *FeedEntry.load_options(
+                    FeedEntryValidator, "content_hash", exclude=["comments"]
+                ),
+                joinedload(FeedEntry.body),
+                noload(FeedEntry.comments),
+            )
+            .filter(FeedEntry.id == feed_entry_id)
+            .first()
+        )
+        if not feed_entry:
+            raise CustomException(detail=trans("FeedEntry does not exist"))
+        validated = FeedEntryValidator.from_orm(feed_entry)
+        comments, validated.comments_cursor = CommentPageResponse.for_entry(
+            db, feed_entry_id, settings.COMMENT_PAGE_SIZE
+        )
+        validated.comments = comments.__root__
+        return validated.dict(exclude={"is_read", "read_time", "is_favorite"})
+
 
 class FavoriteStateValidator(BaseOrmModel):
     is_favorite: bool
 
 
+class BatchStateValidator(BaseOrmModel):
+    ids: conlist(int, min_items=1, max_items=settings.FEED_ENTRY_BATCH_SIZE)
+    is_read: Optional[bool] = None
+    is_favorite: Optional[bool] = None
+
+    def apply(self, db: Session, user_id: int) -> "StateChangeResponse":
+        changed = 0
+        if self.is_read is not None:
+            changed += UserFeedEntryState.set_read_many(
+                db, self.ids, user_id, self.is_read)
+        if self.is_favorite is not None:
+            changed += UserFeedEntryState.set_favorite_many(
+                db, self.ids, user_id, self.is_favorite)
+        return StateChangeResponse(changed=changed)
+
+
+class StateChangeResponse(BaseOrmModel):
+    # number of states that did change
+    changed: int
+
+
 class CommentValidator(BaseIdModel):
     content: str
 
@@ -186,6 +639,7 @@ class CommentValidator(BaseIdModel):
             feed_entry_id=feed_entry_id, user_id=user.id, content=self.content
         )
         comment.save(db)
+        response_cache.bump("entry", [feed_entry_id])
         return comment
 
 
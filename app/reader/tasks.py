@@ -1,145 +1,94 @@
-import time
-from datetime import datetime
+from urllib.parse import urlsplit
 
-import requests
-import pytz
-import feedparser
-from requests.exceptions import Timeout
-from celery import group, shared_task, current_app
-from sqlalchemy.sql.functions import func
+from celery import group, shared_task
 
-from app.reader.models import Feed, FeedEntry
+from app.core.config import settings
+from app.reader.models import Feed
+from app.reader.fetcher import get_fetch_client, run_async
+from app.reader.ingest import store_fetch_result
+from app.reader.pipeline import IngestPipeline, load_snapshots
+from app.reader.retention import apply_retention
+from app.reader import websub
 from app.core.database import SessionLocal
 
 
-def get_count(q):
-    count_q = q.statement.with_only_columns([func.count()]).order_by(None)
-    count = q.session.execute(count_q).scalar()
-    return count
+# splits the claimed feed ids into shards of up to shard_size ids. given the
+# feeds' hosts ({feed_id: host}) the feeds of a host all go to the same shard,
+# even past shard_size: the per host limits of the fetcher hold within a
+# worker process, and a shard is fetched by a single one
+def feed_shards(feed_ids, shard_size=None, hosts=None):
+    shard_size = shard_size or settings.FEED_SHARD_SIZE
+    hosts = hosts or {}
+    by_host = {}
+    for feed_id in sorted(feed_ids):
+        by_host.setdefault(hosts.get(feed_id) or feed_id, []).append(feed_id)
+    shards = [[]]
+    for host_feed_ids in by_host.values():
+        if shards[-1] and len(shards[-1]) + len(host_feed_ids) > shard_size:
+            shards.append([])
+        shards[-1] += host_feed_ids
+    return [shard for shard in shards if shard]
 
 
 @shared_task
-def feed_distributor(priority):
+def feed_distributor():
     db = SessionLocal()
-    if priority < 3:
-        feeds_count = get_count(
-            db.query(Feed).filter(Feed.priority == priority))
-    elif priority >= 3:
-        feeds_count = get_count(
-            db.query(Feed).filter(Feed.priority >= priority))
-    else:
-        raise ValueError("Priority not provided")
+    feed_ids = Feed.claim_due(db)
+    hosts = {
+        feed_id: urlsplit(url).hostname
+        for feed_id, url in db.query(Feed.id, Feed.url).filter(Feed.id.in_(feed_ids))
+    }
     db.close()
 
-    def interval_seq(start, stop, step=1):
-        i = start
-        while (i + step) < stop:
-            yield i, i + step
-            i += step
-        if i < stop:
-            yield i, stop
-
-    node_count = len(current_app.control.ping())
-    group(
-        feed_parse_allocator.s(priority, i, j)
-        for i, j in interval_seq(0, feeds_count, node_count)
-    ).delay()
-
-
-@shared_task
-def feed_parse_allocator(priority, beg, end):
-    db = SessionLocal()
-    if priority < 3:
-        feeds = (
-            db.query(Feed)
-            .filter(Feed.priority == priority)
-            .offset(beg)
-            .limit(end)
-            .all()
-        )
-    elif priority >= 3:
-        feeds = (
-            db.query(Feed)
-            .filter(Feed.priority >= priority)
-            .offset(beg)
-            .limit(end)
-            .all()
-        )
-    else:
-        raise ValueError("Priority not provided")
-    group(feed_parser.s(feed.url, feed.id) for feed in feeds).delay()
-    db.close()
+    if feed_ids:
+        group(
+            feed_batch_parser.s(shard) for shard in feed_shards(feed_ids, hosts=hosts)
+        ).delay()
 
 
 @shared_task
 def feed_parser(url, feed_id):
     db = SessionLocal()
-    feed = db.get(Feed, feed_id)
     try:
-        # Todo: add async requests
-        resp = requests.get(url, timeout=2)
-        feed.decrease_priority(db)
-    except Timeout:
-        feed.increase_priority(db)
-        return
+        feed = db.get(Feed, feed_id)
+        if feed is None:
+            return
+        result = run_async(
+            get_fetch_client().fetch(feed.id, url, feed.conditional_headers())
+        )
+        outcome = store_fetch_result(db, feed, result)
+    finally:
+        db.close()
+    if outcome.subscribe:
+        websub_subscriber.delay(feed_id)
 
-    parsed = feedparser.parse(resp.content)
-    # if feed is invalid, decrease priority and return the method
-    if parsed.bozo == 1:
-        feed.increase_priority(db)
-        return
-    else:
-        feed.decrease_priority(db)
 
-    # update feed title if changed
-    if feed.title is not parsed.feed.title:
-        feed.title = parsed.feed.title
-        db.add(feed)
+@shared_task
+def feed_batch_parser(feed_ids):
+    # parses in threads under the prefork pool, whose children are daemonic
+    # and can't fork, and in the process pool of the worker otherwise
+    pipeline = IngestPipeline()
+    outcomes = run_async(pipeline.run(load_snapshots(feed_ids)))
+    for outcome in outcomes:
+        if outcome.subscribe:
+            websub_subscriber.delay(outcome.feed_id)
 
-    # Replace time.struct_time with datetime.datetime
-    for entry in parsed.entries:
-        published_time = time.gmtime(time.time())
-        for attr in ("published_parsed", "updated_parsed", "created_parsed"):
-            try:
-                published_time = getattr(entry, attr)
-                break
-            except AttributeError:
-                continue
-        entry.published_parsed = datetime.fromtimestamp(
-            time.mktime(published_time)
-        ).replace(tzinfo=pytz.UTC)
 
-    last_entry = (
-        db.query(FeedEntry)
-        .filter(FeedEntry.feed_id == feed_id)
-        .order_by(FeedEntry.published_at.desc())
-        .first()
-    )
+@shared_task
+def websub_subscriber(feed_id):
+    db = SessionLocal()
+    try:
+        feed = db.get(Feed, feed_id)
+        if feed is not None:
+            websub.subscribe(db, feed)
+    finally:
+        db.close()
 
-    def add_entry(entry, feed_id):
-        content = ""
-        for item in entry.get("content", [{}]):
-            content += item.get("value", "") + "\n"
-        db.add(
-            FeedEntry(
-                feed_id=feed_id,
-                title=entry.get("title", ""),
-                subtitle=entry.get("subtitle", ""),
-                link=entry.get("link", ""),
-                author=entry.get("author", ""),
-                summary=entry.get("summary", ""),
-                content=content,
-                published_at=entry.published_parsed,
-            )
-        )
 
-    if last_entry:
-        [
-            add_entry(entry, feed_id)
-            for entry in parsed.entries
-            if entry.published_parsed > last_entry.published_at
-        ]
-    else:
-        [add_entry(entry, feed_id) for entry in parsed.entries]
-    db.commit()
-    db.close()
+@shared_task
+def entry_retention():
+    db = SessionLocal()
+    try:
+        return apply_retention(db)
+    finally:
+        db.close()
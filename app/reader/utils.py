@@ -1,14 +1,32 @@
-import requests
 import feedparser
 from requests.exceptions import Timeout, ConnectionError
 
 from app.utils.i18n import trans
 from app.utils.exceptions import CustomException
+from app.reader.fetcher import (
+    FetchAborted,
+    check_body_size,
+    check_content_length,
+    check_content_type,
+    get_http_session,
+)
+
+
+def read_feed_url(url: str) -> bytes:
+    with get_http_session().get(url, timeout=3, stream=True) as resp:
+        if resp.ok:
+            check_content_type(resp.headers.get("Content-Type"))
+            check_content_length(resp.headers.get("Content-Length"))
+        body = bytearray()
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            body += chunk
+            check_body_size(len(body))
+        return bytes(body)
 
 
 def validate_feed_url(url: str):
     try:
-        resp = requests.get(url, timeout=3)
+        content = read_feed_url(url)
     except Timeout:
         raise CustomException(
             detail="Validation Error", errors=trans("Timeout while fetching feed url")
@@ -17,8 +35,12 @@ def validate_feed_url(url: str):
         raise CustomException(
             detail="Validation Error", errors="Error resolving feed url"
         )
+    except FetchAborted as e:
+        raise CustomException(
+            detail="Validation Error", errors="Feed is not valid (%s)" % e.reason
+        )
 
-    parsed_feed = feedparser.parse(resp.content)
+    parsed_feed = feedparser.parse(content)
     if parsed_feed.bozo == 1:
         raise CustomException(detail="Validation Error",
                               errors="Feed is not valid")
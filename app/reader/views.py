@@ -1,18 +1,29 @@
-from fastapi import Depends, APIRouter, status
+from typing import Optional
+
+from fastapi import Depends, APIRouter, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, Response
 from fastapi_utils.cbv import cbv
 from fastapi_utils.inferring_router import InferringRouter
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import count
 
+from app.core.cache import response_cache
+from app.core.config import settings
 from app.core.database import get_db
 from app.utils.schema import SuccessResponse
 from app.utils.exceptions import CustomException
 from app.utils.i18n import trans
+from app.utils.utils import decode_cursor
 from app.authnz.utils import get_active_user
 from app.utils.view_types import AdminView
 from app.authnz.models import User
 from app.reader.schemas import (
+    BatchStateValidator,
+    CacheStatsResponse,
+    CommentListItem,
     CommentListResponse,
+    CommentPageResponse,
     CommentResponse,
     CommentValidator,
     FavoriteStateValidator,
@@ -22,8 +33,14 @@ from app.reader.schemas import (
     FeedResponse,
     FeedListResponse,
     FeedAdminValidator,
+    FeedCircuitItem,
+    FeedCircuitListResponse,
+    SearchResponse,
+    StateChangeResponse,
+    TimelineResponse,
 )
 from app.reader.models import Comment, Feed, FeedEntry, UserFeedEntryState
+from app.reader import websub
 
 
 ############################
@@ -63,7 +80,42 @@ class FeedAdmin(AdminView):
         """
         Feed Update
         """
-        return self.edit_view(id, item)
+        response = self.edit_view(id, item)
+        response_cache.bump("feed", [id])
+        return response
+
+    @feed_admin_router.get("/admin/feed/cache_stats")
+    def cache_stats(self):
+        """
+        Hits and misses of the response cache, by cached value
+        """
+        return SuccessResponse(
+            data=CacheStatsResponse.parse_obj(response_cache.stats()),
+        )
+
+    @feed_admin_router.get("/admin/feed/tripped")
+    def tripped(self):
+        """
+        Feeds whose circuit breaker is tripped, they are not fetched until
+        circuit_open_until
+        """
+        return SuccessResponse(
+            data=FeedCircuitListResponse.from_orm(Feed.tripped(self.db)),
+        )
+
+    @feed_admin_router.post("/admin/feed/{id}/reset_circuit")
+    def reset_circuit(self, id: int):
+        """
+        Close the circuit breaker of a feed, it is fetched on the next tick
+        """
+        feed = self.db.get(Feed, id)
+        if not feed:
+            raise CustomException(detail=trans("Feed does not exist"))
+        feed.reset_circuit(self.db)
+        return SuccessResponse(
+            message=trans("Feed circuit reset"),
+            data=FeedCircuitItem.from_orm(feed),
+        )
 
     @feed_admin_router.get("/admin/feed/{id}")
     def retrieve(self, id: int):
@@ -77,7 +129,9 @@ class FeedAdmin(AdminView):
         """
         Feed Delete
         """
-        return self.delete_view(id)
+        response = self.delete_view(id)
+        response_cache.bump("feed", [id])
+        return response
 
     @feed_admin_router.get("/admin/feed")
     def list(self):
@@ -136,10 +190,8 @@ def feed_list(
     """
     Current User (Logged in user) subscribed feed list
     """
-    user_feed = db.query(Feed).filter(
-        Feed.subscribers.any(id=current_user.id)).all()
     return SuccessResponse(
-        data=FeedListResponse.from_orm(user_feed),
+        data=FeedListResponse.cached_for_user(db, current_user.id),
         status_code=status.HTTP_200_OK,
     )
 
@@ -153,16 +205,64 @@ def feed_item(
     """
     Detail of feed
     """
-    feed_item = db.get(Feed, id)
-    if not feed_item:
-        raise CustomException(detail=trans("Feed does not exist"))
     return SuccessResponse(
-        data=FeedResponse.for_user(
-            db, feed=feed_item, user_id=current_user.id),
+        data=FeedResponse.cached_for_user(db, current_user.id, id),
         status_code=status.HTTP_200_OK,
     )
 
 
+############################
+###### WebSub methods ######
+############################
+
+websub_router = APIRouter()
+
+
+@websub_router.get("/websub/callback/{feed_id}")
+def websub_verify(
+    feed_id: int,
+    mode: str = Query(..., alias="hub.mode"),
+    topic: str = Query(..., alias="hub.topic"),
+    challenge: str = Query("", alias="hub.challenge"),
+    lease_seconds: Optional[int] = Query(None, alias="hub.lease_seconds"),
+    db: Session = Depends(get_db),
+):
+    """
+    Verification of intent, hubs call it to confirm the subscriptions we
+    asked for (or to tell they were denied)
+    """
+    feed = db.get(Feed, feed_id)
+    if not feed or not websub.verify_intent(db, feed, mode, topic, lease_seconds):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return PlainTextResponse(challenge)
+
+
+@websub_router.post("/websub/callback/{feed_id}")
+async def websub_push(
+    feed_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+):
+    """
+    Content distribution, hubs post new feed content to it
+    """
+    body = await request.body()
+    signature = request.headers.get("X-Hub-Signature")
+
+    def receive() -> bool:
+        # the session is sync, kept off the event loop with the ingest
+        feed = db.get(Feed, feed_id)
+        if not feed:
+            return False
+        # the hub gets a 2xx even for pushes we drop, as the spec asks
+        websub.receive_push(db, feed, body, signature)
+        return True
+
+    if not await run_in_threadpool(receive):
+        raise HTTPException(status_code=status.HTTP_410_GONE)
+    return Response(status_code=status.HTTP_202_ACCEPTED)
+
+
 ############################
 # FeedEntry Admin methods ##
 ############################
@@ -185,7 +285,10 @@ class FeedEntryAdmin(AdminView):
         """
         FeedEntry Create
         """
-        return self.create_view(item)
+        response = self.create_view(item)
+        if response.data.feed:
+            response_cache.bump("feed", [response.data.feed.id])
+        return response
 
     @feedentry_admin_router.patch("/admin/feed_entry/{id}")
     def edit(
@@ -196,7 +299,9 @@ class FeedEntryAdmin(AdminView):
         """
         FeedEntry Update
         """
-        return self.edit_view(id, item)
+        response = self.edit_view(id, item)
+        self.bump_cache(id)
+        return response
 
     @feedentry_admin_router.get("/admin/feed_entry/{id}")
     def retrieve(self, id: int):
@@ -210,6 +315,7 @@ class FeedEntryAdmin(AdminView):
         """
         FeedEntry Delete
         """
+        self.bump_cache(id, deleted=True)
         return self.delete_view(id)
 
     @feedentry_admin_router.get("/admin/feed_entry")
@@ -219,6 +325,16 @@ class FeedEntryAdmin(AdminView):
         """
         return self.list_view()
 
+    def bump_cache(self, id: int, deleted: bool = False):
+        # the entry's body and the lists of its feed
+        feed_id = self.db.query(FeedEntry.feed_id).filter(FeedEntry.id == id).scalar()
+        if deleted:
+            response_cache.forget("entry", [id])
+        else:
+            response_cache.bump("entry", [id])
+        if feed_id:
+            response_cache.bump("feed", [feed_id])
+
 
 ############################
 ## FeedEntry User methods ##
@@ -244,6 +360,46 @@ def mark_entry_unread(
     )
 
 
+@feedentry_user_router.post("/feed_entry/mark_all_read/{feed_id}")
+def mark_feed_read(
+    feed_id: int,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_active_user),
+) -> SuccessResponse:
+    """
+    Mark every FeedEntry of the feed as read, or only the ones older than
+    the given list cursor (for current user)
+    """
+    before_id = None
+    if cursor:
+        (before_id,) = decode_cursor(cursor, int)
+    changed = UserFeedEntryState.mark_feed_read(
+        db, feed_id, current_user.id, before_id
+    )
+    return SuccessResponse(
+        message=trans("Set feedentries as read"),
+        data=StateChangeResponse(changed=changed),
+        status_code=status.HTTP_200_OK,
+    )
+
+
+@feedentry_user_router.post("/feed_entry/batch_state")
+def set_entries_state(
+    batch: BatchStateValidator,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_active_user),
+) -> SuccessResponse:
+    """
+    Set read and/or favorite state of FeedEntries by id (for current user)
+    """
+    return SuccessResponse(
+        message=trans("Set feedentries state"),
+        data=batch.apply(db, current_user.id),
+        status_code=status.HTTP_200_OK,
+    )
+
+
 @feedentry_user_router.post("/feed_entry/set_favorite/{feed_entry_id}")
 def set_entry_favorite(
     feed_entry_id: int,
@@ -271,18 +427,64 @@ def feed_entry_list(
     feed_id: int,
     index: int = 0,
     total: int = 10,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_active_user),
 ) -> SuccessResponse:
     """
-    FeedEntry list for certain feed id
+    FeedEntry list for certain feed id, pass the cursor of a page to get the next one
     """
-    item_list = FeedEntryListResponse.list_for_user(
-        db, feed_id, current_user.id, index, total
+    item_list, next_cursor = FeedEntryListResponse.list_for_user(
+        db, feed_id, current_user.id, index, total, cursor
     )
     return SuccessResponse(
         index=index,
         total=len(item_list.__root__),
+        cursor=next_cursor,
+        data=item_list,
+        status_code=status.HTTP_200_OK,
+    )
+
+
+@feedentry_user_router.get("/feed_entry/timeline")
+def feed_entry_timeline(
+    total: int = 10,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_active_user),
+) -> SuccessResponse:
+    """
+    Entries of every subscribed feed, newest first, pass the cursor for the next page
+    """
+    item_list, next_cursor = TimelineResponse.for_user(
+        db, current_user.id, total, cursor
+    )
+    return SuccessResponse(
+        total=len(item_list.__root__),
+        cursor=next_cursor,
+        data=item_list,
+        status_code=status.HTTP_200_OK,
+    )
+
+
+@feedentry_user_router.get("/feed_entry/search")
+def feed_entry_search(
+    q: str = Query(..., min_length=1, max_length=256),
+    total: int = 10,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_active_user),
+) -> SuccessResponse:
+    """
+    Search the entries of the subscribed feeds ("quoted phrases", or, -word),
+    best matches first, pass the cursor for the next page
+    """
+    item_list, next_cursor = SearchResponse.for_user(
+        db, current_user.id, q, total, cursor
+    )
+    return SuccessResponse(
+        total=len(item_list.__root__),
+        cursor=next_cursor,
         data=item_list,
         status_code=status.HTTP_200_OK,
     )
@@ -297,11 +499,8 @@ def feed_entry_item(
     """
     Detail of FeedEntry
     """
-    feed_entry_item = db.get(FeedEntry, id)
-    if not feed_entry_item:
-        raise CustomException(detail=trans("FeedEntry does not exist"))
     data = FeedEntryValidator.for_user(
-        db, feed_entry=feed_entry_item, user_id=current_user.id
+        db, feed_entry_id=id, user_id=current_user.id
     )
     UserFeedEntryState.mark_read(db, id, current_user.id)
     return SuccessResponse(
@@ -331,15 +530,24 @@ def add_comment_to_feed_entry(
 @feedentry_user_router.get("/feed_entry/{id}/my_comments")
 def get_my_comment_on_feed_entries(
     id: int,
+    total: int = settings.COMMENT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_active_user),
 ) -> SuccessResponse:
     """
-    My comments list
+    My comments list, oldest first, pass the cursor for the next page
     """
-    comments = db.query(Comment).filter(
-        Comment.user_id == current_user.id, Comment.feed_entry_id == id).all()
+    comments, next_cursor = CommentPageResponse.page(
+        db.query(Comment)
+        .options(*Comment.load_options(CommentListItem))
+        .filter(Comment.user_id == current_user.id, Comment.feed_entry_id == id),
+        total,
+        cursor,
+    )
     return SuccessResponse(
+        total=len(comments),
+        cursor=next_cursor,
         data=CommentListResponse.from_orm(comments),
         status_code=status.HTTP_200_OK,
     )
@@ -348,14 +556,24 @@ def get_my_comment_on_feed_entries(
 @feedentry_user_router.get("/feed_entry/{id}/comments")
 def get_feed_entry_comments(
     id: int,
+    total: int = settings.COMMENT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_active_user),
 ) -> SuccessResponse:
     """
-    FeedEntry comments list
+    FeedEntry comments list, oldest first, pass the cursor for the next page
     """
-    comments = db.query(Comment).filter(Comment.feed_entry_id == id).all()
+    comments, next_cursor = CommentPageResponse.page(
+        db.query(Comment)
+        .options(*Comment.load_options(CommentListItem, joined=["feed_entry"]))
+        .filter(Comment.feed_entry_id == id),
+        total,
+        cursor,
+    )
     return SuccessResponse(
+        total=len(comments),
+        cursor=next_cursor,
         data=CommentListResponse.from_orm(comments),
         status_code=status.HTTP_200_OK,
     )
@@ -0,0 +1,164 @@
+"""
+WebSub (formerly PubSubHubbub) subscriber
+
+feeds advertising a rel="hub" link are subscribed to their hub once parsed,
+the hub verifies the subscription with a GET on our callback url and then
+POSTs new content to it, which is stored like fetched content. polling such
+feeds drops to the WEBSUB_POLL_INTERVAL safety net
+"""
+import hashlib
+import hmac
+import logging
+import secrets
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from requests.exceptions import RequestException
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.reader.fetcher import get_http_session
+from app.reader.ingest import (
+    FeedSnapshot,
+    IngestOutcome,
+    parse_outcome,
+    persist_outcomes,
+)
+from app.reader.models import Feed
+
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_METHODS = {
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "sha384": hashlib.sha384,
+    "sha512": hashlib.sha512,
+}
+
+
+def callback_url(feed_id: int) -> str:
+    return "%s/websub/callback/%d" % (
+        settings.WEBSUB_CALLBACK_URL.rstrip("/"),
+        feed_id,
+    )
+
+
+def subscribe(db: Session, feed: Feed) -> bool:
+    """
+    Asks the hub of the feed for a subscription, it is active once the hub
+    verified it through the callback
+    """
+    if not feed.websub_hub or not settings.WEBSUB_CALLBACK_URL:
+        return False
+    if not feed.websub_secret:
+        feed.websub_secret = secrets.token_hex(20)
+    feed.websub_requested_at = datetime.now(timezone.utc)
+    feed.save(db)
+    try:
+        resp = get_http_session().post(
+            feed.websub_hub,
+            data={
+                "hub.callback": callback_url(feed.id),
+                "hub.mode": "subscribe",
+                "hub.topic": feed.websub_topic or feed.url,
+                "hub.secret": feed.websub_secret,
+                "hub.lease_seconds": settings.WEBSUB_LEASE_SECONDS,
+            },
+            timeout=settings.FEED_FETCH_TIMEOUT,
+        )
+    except RequestException as e:
+        logger.warning("Subscribing to hub %s failed: %r", feed.websub_hub, e)
+        return False
+    if not 200 <= resp.status_code < 300:
+        logger.warning(
+            "Hub %s refused subscription: %d", feed.websub_hub, resp.status_code
+        )
+        return False
+    return True
+
+
+def subscribe_feeds(feed_ids: List[int]):
+    db = SessionLocal()
+    try:
+        for feed in db.query(Feed).filter(Feed.id.in_(feed_ids)):
+            subscribe(db, feed)
+    finally:
+        db.close()
+
+
+def verify_intent(
+    db: Session,
+    feed: Feed,
+    mode: str,
+    topic: str,
+    lease_seconds: Optional[int] = None,
+) -> bool:
+    """
+    Handles the hub's verification of a subscription (or its denial), returns
+    whether we asked for it
+    """
+    if not feed.websub_hub or topic != (feed.websub_topic or feed.url):
+        return False
+    now = datetime.now(timezone.utc)
+    # only the subscription we asked for lately, a verification replayed
+    # later or one we never asked for (unsubscribing included) is refused
+    requested_at = feed.websub_requested_at
+    if requested_at is None or requested_at < now - timedelta(
+        seconds=settings.WEBSUB_RETRY_INTERVAL
+    ):
+        return False
+    if mode == "subscribe":
+        # the hub may shorten the lease we asked for, not stretch it
+        if not lease_seconds or lease_seconds < 1:
+            lease_seconds = settings.WEBSUB_LEASE_SECONDS
+        lease_seconds = min(lease_seconds, settings.WEBSUB_LEASE_SECONDS)
+        feed.websub_expires_at = now + timedelta(seconds=lease_seconds)
+        # fetched again only as a safety net from now on
+        feed.next_fetch_at = now + timedelta(seconds=settings.WEBSUB_POLL_INTERVAL)
+        feed.websub_requested_at = None
+    elif mode == "denied":
+        # the request stays on record so that it is retried only later
+        feed.websub_expires_at = None
+        feed.next_fetch_at = now
+    else:
+        return False
+    feed.save(db)
+    return True
+
+
+def valid_signature(secret: Optional[str], body: bytes, signature: Optional[str]) -> bool:
+    # X-Hub-Signature: method=hexdigest, keyed with the secret we subscribed with
+    if not secret or not signature or "=" not in signature:
+        return False
+    method, digest = signature.split("=", 1)
+    if method not in SIGNATURE_METHODS:
+        return False
+    expected = hmac.new(
+        secret.encode("utf-8"), body, SIGNATURE_METHODS[method]
+    ).hexdigest()
+    return hmac.compare_digest(expected, digest.strip().lower())
+
+
+def receive_push(db: Session, feed: Feed, body: bytes, signature: Optional[str]) -> bool:
+    """
+    Stores content pushed by the hub, through the same path as fetched
+    content. pushes that aren't signed with our secret are ignored
+    """
+    if not valid_signature(feed.websub_secret, body, signature):
+        logger.warning("Dropped push with a bad signature for feed %s", feed.url)
+        return False
+    if len(body) > settings.FEED_MAX_BODY_SIZE:
+        logger.warning("Dropped oversized push for feed %s", feed.url)
+        return False
+    snapshot = FeedSnapshot(feed)
+    outcome = parse_outcome(
+        IngestOutcome(feed.id, IngestOutcome.PUSHED, content=body),
+        snapshot.parse_since,
+    )
+    if outcome.status == IngestOutcome.INVALID:
+        logger.warning("Dropped invalid push for feed %s", feed.url)
+        return False
+    persist_outcomes(db, [outcome])
+    return True
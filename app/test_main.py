@@ -1,12 +1,52 @@
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
 import pytest
+import requests
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
 from fastapi.testclient import TestClient
 
 from app.core.main import app
 from app.test_data import test_data
+from app.authnz.models import User
 from app.authnz.schemas import UserRegister
-from app.reader.models import Feed
-from app.core.database import SessionLocal
-from app.reader.tasks import feed_parser
+from app.reader.models import (
+    EntryContent,
+    Feed,
+    FeedEntry,
+    UserFeedEntryState,
+    UserFeedState,
+)
+from app.core.cache import CustomRedis, ResponseCache, response_cache
+from app.core.config import settings
+from app.core.database import Base, SessionLocal, engine
+from app.reader.tasks import feed_parser, feed_shards
+from app.reader.ingest import (
+    IngestOutcome,
+    persist_outcomes,
+    store_feed_content,
+    store_fetch_result,
+)
+from app.reader.parsers import parse_feed
+from app.reader.pipeline import IngestPipeline, get_parse_pool
+from app.reader.schemas import FeedEntryListResponse, SearchResponse
+from app.reader import websub
+from app.reader.archive import FeedArchive, LocalArchiveStore
+from app.reader.fetcher import FetchAborted, fetch_feeds
+from benchmarks.feed_farm import FeedFarm
 
 client = TestClient(app)
 
@@ -22,7 +62,32 @@ def user_headers(user_token):
     return {"Authorization": "Bearer %s" % (user_token)}
 
 
+@contextmanager
+def count_queries(prefix: str = ""):
+    """
+    Collects the statements sent to the database within the block, those
+    starting with prefix
+    """
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if statement.startswith(prefix):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
 class BaseTest:
+    @contextmanager
+    def assert_max_queries(self, count: int):
+        with count_queries() as statements:
+            yield statements
+        assert len(statements) <= count, "\n".join(statements)
+
     def has_data(self, res):
         assert res.json().get("data") is not None
         return res.json().get("data")
@@ -92,11 +157,23 @@ class TestFeed(BaseTest):
         )
         assert data.get("url") == test_data.feed_validator_item.url
 
+    @pytest.mark.order(22)
+    def test_retrieve_feed_twice_should_hit_the_cache(self, user_headers):
+        hits = response_cache.stats()["names"].get("feed", {}).get("hit", 0)
+        first = self.has_data_code_200(
+            client.get("/feed/%d" % test_data.feed_id, headers=user_headers)
+        )
+        second = self.has_data_code_200(
+            client.get("/feed/%d" % test_data.feed_id, headers=user_headers)
+        )
+        assert first == second
+        assert response_cache.stats()["names"]["feed"]["hit"] > hits
+
     @pytest.mark.order(22)
     def test_priority_increase_should_succeed_on_failing_feed_retrieve(self):
         db = SessionLocal()
+        persist_outcomes(db, [IngestOutcome(test_data.feed_id, IngestOutcome.NOT_MODIFIED)])
         feed = db.query(Feed).get(test_data.feed_id)
-        feed.decrease_priority(db)
         old_priority = feed.priority
         db.close()
 
@@ -110,8 +187,8 @@ class TestFeed(BaseTest):
     @pytest.mark.order(23)
     def test_priority_decrease_should_succeed_on_successful_feed_retrieve(self):
         db = SessionLocal()
+        persist_outcomes(db, [IngestOutcome(test_data.feed_id, IngestOutcome.TIMED_OUT)])
         feed = db.query(Feed).get(test_data.feed_id)
-        feed.increase_priority(db)
         old_priority = feed.priority
         db.close()
 
@@ -122,6 +199,35 @@ class TestFeed(BaseTest):
         assert feed.priority < old_priority
         db.close()
 
+    @pytest.mark.order(24)
+    def test_refetching_unchanged_feed_should_skip_parse(self):
+        db = SessionLocal()
+        feed = db.query(Feed).get(test_data.feed_id)
+        old_parses_saved = feed.parses_saved
+        db.close()
+
+        feed_parser(feed.url, feed.id)
+
+        db = SessionLocal()
+        feed = db.query(Feed).get(test_data.feed_id)
+        assert feed.parses_saved == old_parses_saved + 1
+        db.close()
+
+    @pytest.mark.order(24)
+    def test_storing_same_feed_content_twice_should_not_duplicate_entries(self):
+        db = SessionLocal()
+        feed = db.query(Feed).get(test_data.feed_id)
+        content = requests.get(feed.url, timeout=10).content
+        entries = db.query(FeedEntry).filter(FeedEntry.feed_id == feed.id)
+
+        store_feed_content(db, feed, content)
+        entries_count = entries.count()
+        store_feed_content(db, feed, content)
+
+        assert entries_count > 0
+        assert entries.count() == entries_count
+        db.close()
+
     @pytest.mark.order(24)
     def test_retrieve_feed_entry_list(self, user_headers):
         data = self.has_data_code_200(
@@ -131,6 +237,79 @@ class TestFeed(BaseTest):
         assert len(data) > 0
         test_data.feed_entry_id = data[0].get("id")
 
+    @pytest.mark.order(25)
+    def test_feed_entry_list_cursor_should_not_skip_or_repeat(self, user_headers):
+        url = "/feed_entry/list/%d" % test_data.feed_id
+        everything = self.has_data_code_200(
+            client.get(url, params={"total": 1000}, headers=user_headers)
+        )
+        seen, cursor = [], None
+        while True:
+            params = {"total": 2}
+            if cursor:
+                params["cursor"] = cursor
+            res = self.code_200(client.get(url, params=params, headers=user_headers))
+            seen += [item["id"] for item in res.json()["data"]]
+            cursor = res.json().get("cursor")
+            if not cursor:
+                break
+
+        assert seen == [item["id"] for item in everything]
+        assert client.get(
+            url, params={"cursor": "not a cursor"}, headers=user_headers
+        ).status_code == 400
+
+    @pytest.mark.order(25)
+    def test_timeline_should_merge_subscribed_feeds_newest_first(self, user_headers):
+        seen, published, cursor = [], [], None
+        while True:
+            params = {"total": 3}
+            if cursor:
+                params["cursor"] = cursor
+            res = self.code_200(
+                client.get("/feed_entry/timeline", params=params, headers=user_headers)
+            )
+            for item in res.json()["data"]:
+                seen.append(item["id"])
+                published.append((item["published_at"], item["id"]))
+            cursor = res.json().get("cursor")
+            if not cursor:
+                break
+
+        feed_entries = self.has_data_code_200(
+            client.get(
+                "/feed_entry/list/%d" % test_data.feed_id,
+                params={"total": 1000},
+                headers=user_headers,
+            )
+        )
+        assert len(seen) == len(set(seen))
+        assert {item["id"] for item in feed_entries} <= set(seen)
+        assert published == sorted(published, reverse=True)
+
+    @pytest.mark.order(25)
+    def test_syndicated_entry_content_should_be_stored_once(self, user_headers):
+        db = SessionLocal()
+        entry = db.get(FeedEntry, test_data.feed_entry_id)
+        assert entry.content_hash is not None
+        contents = db.query(EntryContent).count()
+
+        other_feed = Feed(url="https://syndicated.example/feed")
+        other_feed.save(db)
+        copy = FeedEntry(feed_id=other_feed.id, title="copy", guid_hash="copy")
+        copy.content = entry.content
+        copy.save(db)
+
+        assert copy.content_hash == entry.content_hash
+        assert db.query(EntryContent).count() == contents
+        data = self.has_data_code_200(
+            client.get("/feed_entry/%d" % test_data.feed_entry_id, headers=user_headers)
+        )
+        assert data.get("content") == entry.content
+        db.query(Feed).filter(Feed.id == other_feed.id).delete()
+        db.commit()
+        db.close()
+
     # Fetch feed entry and Check Read State after fetching the feed entry
     @pytest.mark.order(26)
     def test_retrieve_feed_entry(self, user_headers):
@@ -140,6 +319,22 @@ class TestFeed(BaseTest):
         )
         assert data.get("id") == test_data.feed_entry_id
 
+    @pytest.mark.order(26)
+    def test_search_should_find_and_highlight_entry(self, user_headers):
+        entry = self.has_data_code_200(
+            client.get("/feed_entry/%d" % test_data.feed_entry_id, headers=user_headers)
+        )
+        words = [word for word in entry["title"].split() if word.isalpha()]
+        word = max(words, key=len)
+
+        res = self.code_200(
+            client.get("/feed_entry/search", params={"q": word}, headers=user_headers)
+        )
+        found = [item for item in res.json()["data"] if item["id"] == entry["id"]]
+        ranks = [item["rank"] for item in res.json()["data"]]
+        assert found and "<b>" in found[0]["title_highlight"]
+        assert ranks == sorted(ranks, reverse=True)
+
     @pytest.mark.order(27)
     def test_feed_entry_check_is_read(self, user_headers):
         data = self.has_data_code_200(
@@ -166,6 +361,55 @@ class TestFeed(BaseTest):
         )
         assert data.get("is_read") == False
 
+    # reading the entry (order 29) and marking it unread again move the counter
+    @pytest.mark.order(30)
+    def test_feed_unread_count_should_follow_read_state(self, user_headers):
+        def unread_counts():
+            feed = self.has_data_code_200(
+                client.get("/feed/%d" % test_data.feed_id, headers=user_headers)
+            )
+            my_feed = self.has_data_code_200(
+                client.get("/feed/my_feed", headers=user_headers)
+            )
+            listed = [item for item in my_feed if item["id"] == test_data.feed_id]
+            return feed.get("unread_count"), listed[0].get("unread_count")
+
+        read_unread, read_listed = unread_counts()
+        self.code_200(
+            client.post(
+                "/feed_entry/mark_unread/%d" % test_data.feed_entry_id,
+                headers=user_headers,
+            )
+        )
+        unread, listed = unread_counts()
+
+        assert read_unread == read_listed
+        assert unread == listed == read_unread + 1
+
+    @pytest.mark.order(31)
+    def test_bulk_state_changes_should_keep_unread_count(self, user_headers):
+        def unread_count():
+            return self.has_data_code_200(
+                client.get("/feed/%d" % test_data.feed_id, headers=user_headers)
+            ).get("unread_count")
+
+        marked = self.has_data_code_200(
+            client.post(
+                "/feed_entry/mark_all_read/%d" % test_data.feed_id,
+                headers=user_headers,
+            )
+        )
+        assert marked["changed"] > 0
+        assert unread_count() == 0
+
+        batch = {"ids": [test_data.feed_entry_id], "is_read": False}
+        for changed in (1, 0):
+            data = self.has_data_code_200(
+                client.post("/feed_entry/batch_state", json=batch, headers=user_headers)
+            )
+            assert data["changed"] == changed
+        assert unread_count() == 1
+
     # set to favorite and check
     @pytest.mark.order(26)
     def test_feed_entry_set_favorite_status_to_true(self, user_headers):
@@ -238,6 +482,50 @@ class TestFeed(BaseTest):
 
     # unsubscribe from the feed
 
+    # lists load their relationships in batches, not once per item
+    @pytest.mark.order(28)
+    def test_comment_list_queries_should_not_grow_with_comments(self, user_headers):
+        url = "/feed_entry/%d/comments" % test_data.feed_entry_id
+        with count_queries() as statements:
+            self.has_data_code_200(client.get(url, headers=user_headers))
+        self.code_200(
+            client.post(
+                "/feed_entry/%d/add_comment" % test_data.feed_entry_id,
+                json=test_data.comment_validator_item.dict(),
+                headers=user_headers,
+            )
+        )
+        with self.assert_max_queries(len(statements)):
+            data = self.has_data_code_200(client.get(url, headers=user_headers))
+        assert len(data) > 1
+        assert not any("entry_contents" in statement for statement in statements)
+
+    @pytest.mark.order(29)
+    def test_comments_should_be_paged_and_first_page_embedded(self, user_headers):
+        url = "/feed_entry/%d/comments" % test_data.feed_entry_id
+        everything = self.has_data_code_200(
+            client.get(url, params={"total": 1000}, headers=user_headers)
+        )
+        seen, cursor = [], None
+        while True:
+            params = {"total": 1}
+            if cursor:
+                params["cursor"] = cursor
+            res = self.code_200(client.get(url, params=params, headers=user_headers))
+            seen += [item["id"] for item in res.json()["data"]]
+            cursor = res.json().get("cursor")
+            if not cursor:
+                break
+
+        assert seen == [item["id"] for item in everything]
+        # the items of the list before it was paged
+        assert all({"feed_entry", "content", "created"} <= item.keys() for item in everything)
+        data = self.has_data_code_200(
+            client.get("/feed_entry/%d" % test_data.feed_entry_id, headers=user_headers)
+        )
+        assert data["comment_count"] == len(everything)
+        assert [item["id"] for item in data["comments"]] == seen[: settings.COMMENT_PAGE_SIZE]
+
     @pytest.mark.order(49)
     def test_unsubscribe_from_feed_should_be_successful(self, user_headers):
         data = self.has_data_code_200(
@@ -248,3 +536,748 @@ class TestFeed(BaseTest):
             )
         )
         assert data.get("url") == test_data.feed_validator_item.url
+
+
+class TestResponseCache(BaseTest):
+    @pytest.fixture
+    def cache(self, monkeypatch):
+        cache = ResponseCache()
+        monkeypatch.setattr(cache, "STATS_KEY", "cache:stats:test")
+        yield cache
+        cache.redis._redis.delete("cache:stats:test")
+
+    def test_versions_should_expire_unless_bumped(self, cache):
+        key = cache.VERSION_KEY % ("test", 1)
+        cache.redis._redis.delete(key)
+        cache.versions("test", [1])
+        assert 0 < cache.redis._redis.ttl(key) <= settings.CACHE_VERSION_TTL
+        cache.redis._redis.expire(key, 10)
+        cache.bump("test", [1])
+        assert cache.redis._redis.ttl(key) > 10
+
+    def test_forgotten_versions_should_not_find_their_values(self, cache):
+        # versions are made of the current time in ms
+        cache.forget("test", [2])
+        time.sleep(0.002)
+        assert cache.get_or_set("forgotten", 60, lambda: "old", test=[2]) == "old"
+        cache.forget("test", [2])
+        assert not cache.redis._redis.exists(cache.VERSION_KEY % ("test", 2))
+        time.sleep(0.002)
+        assert cache.get_or_set("forgotten", 60, lambda: "new", test=[2]) == "new"
+
+    def test_stats_should_be_written_in_batches(self, cache, monkeypatch):
+        monkeypatch.setattr(settings, "CACHE_STATS_FLUSH_INTERVAL", 60)
+        # a key of its own, values of earlier runs may still be cached
+        part = time.time_ns()
+        for _ in range(2):
+            cache.get_or_set("stats", 60, lambda: 1, part)
+        assert not cache.redis._redis.exists("cache:stats:test")
+        assert cache.stats()["names"]["stats"] == {"hit": 1, "miss": 1, "hit_ratio": 0.5}
+
+    def test_cache_stats_should_be_unavailable_without_redis(self):
+        cache = ResponseCache(CustomRedis(port=1))
+        assert cache.stats() == {"available": False, "names": {}}
+
+    def test_renamed_feed_should_be_stale_in_the_cache(self):
+        db = SessionLocal()
+        feed = Feed(url="https://renamed.test/feed", title="Feed", priority=0)
+        feed.save(db)
+        try:
+            store_feed_content(db, feed, TestFeedParsing.rss)
+            (version,) = response_cache.versions("feed", [feed.id])
+            # no new entries, only a new title
+            renamed = TestFeedParsing.rss.replace(b"<title>Feed<", b"<title>Renamed<")
+            store_feed_content(db, feed, renamed)
+            assert response_cache.versions("feed", [feed.id])[0] > version
+        finally:
+            db.query(Feed).filter(Feed.id == feed.id).delete()
+            db.commit()
+            db.close()
+
+
+class TestFeedScheduling(BaseTest):
+    feed_urls = ["https://scheduling.test/feed/%d" % i for i in range(7)]
+
+    @pytest.fixture
+    def feeds(self):
+        db = SessionLocal()
+        feeds = [Feed(url=url) for url in self.feed_urls]
+        for feed in feeds:
+            feed.save(db)
+        yield [feed.id for feed in feeds]
+        db.query(Feed).filter(Feed.url.in_(self.feed_urls)).delete(
+            synchronize_session=False
+        )
+        db.commit()
+        db.close()
+
+    def test_due_feeds_should_be_claimed_exactly_once(self, feeds):
+        db = SessionLocal()
+        claimed = Feed.claim_due(db)
+        claimed_again = Feed.claim_due(db)
+        db.close()
+
+        assert set(feeds) <= set(claimed)
+        assert not set(feeds) & set(claimed_again)
+
+    def test_shards_should_cover_every_feed_exactly_once(self, feeds):
+        shards = feed_shards(feeds, shard_size=3)
+
+        assert [len(shard) for shard in shards] == [3, 3, 1]
+        assert sum(shards, []) == sorted(feeds)
+
+    def test_feeds_of_a_host_should_share_a_shard(self):
+        hosts = {1: "a.test", 2: "b.test", 3: "a.test", 4: "a.test", 5: None}
+        shards = feed_shards([5, 4, 3, 2, 1], shard_size=2, hosts=hosts)
+
+        assert shards == [[1, 3, 4], [2, 5]]
+
+    def test_failing_feed_should_back_off(self, feeds):
+        db = SessionLocal()
+        persist_outcomes(db, [IngestOutcome(feeds[0], IngestOutcome.NOT_MODIFIED)])
+        healthy_next_fetch_at = db.get(Feed, feeds[0]).next_fetch_at
+        persist_outcomes(db, [IngestOutcome(feeds[0], IngestOutcome.TIMED_OUT)])
+        feed = db.get(Feed, feeds[0])
+        db.refresh(feed)
+        assert feed.priority == 1
+        assert feed.next_fetch_at > healthy_next_fetch_at + timedelta(
+            seconds=settings.FEED_DEFAULT_FETCH_INTERVAL / 2)
+        db.close()
+
+    def test_batch_outcomes_should_update_feeds_in_one_statement(self, feeds):
+        db = SessionLocal()
+        with count_queries("UPDATE feeds") as statements:
+            persist_outcomes(
+                db,
+                [
+                    IngestOutcome(feeds[0], IngestOutcome.TIMED_OUT),
+                    IngestOutcome(
+                        feeds[1], IngestOutcome.NOT_MODIFIED, bytes_saved=10),
+                ],
+            )
+
+        timed_out, not_modified = db.get(Feed, feeds[0]), db.get(Feed, feeds[1])
+        assert len(statements) == 1
+        assert timed_out.priority == 1
+        assert timed_out.last_fetch_status == IngestOutcome.TIMED_OUT
+        assert not_modified.priority == 0
+        assert not_modified.parses_saved == 1
+        assert not_modified.bytes_saved == 10
+        db.close()
+
+    def test_failing_feed_should_trip_its_circuit_until_reset(self, feeds):
+        db = SessionLocal()
+        for _ in range(settings.FEED_CIRCUIT_FAILURE_THRESHOLD):
+            persist_outcomes(
+                db,
+                [IngestOutcome(feeds[0], IngestOutcome.FAILED,
+                               error_class="ConnectError")],
+            )
+        feed = db.get(Feed, feeds[0])
+        assert feed.failure_count == settings.FEED_CIRCUIT_FAILURE_THRESHOLD
+        assert feed.last_error_class == "ConnectError"
+        assert feed.circuit_open_until > datetime.now(timezone.utc)
+        assert feed in Feed.tripped(db)
+
+        feed.next_fetch_at = datetime.now(timezone.utc)
+        feed.save(db)
+        assert feeds[0] not in Feed.claim_due(db)
+
+        feed.reset_circuit(db)
+        assert feed not in Feed.tripped(db)
+        assert feeds[0] in Feed.claim_due(db)
+        db.close()
+
+
+class TestFetchClient(BaseTest):
+    def fetch(self, farm, **kwargs):
+        feeds = [(n, url, None) for n, url in enumerate(farm.urls())]
+        return asyncio.run(fetch_feeds(feeds, **kwargs))
+
+    def test_host_limits_should_hold_for_its_feeds(self):
+        with FeedFarm(feed_count=8, latency=0.05) as farm:
+            started = time.monotonic()
+            results = self.fetch(farm, host_concurrency=2, host_min_interval=0.05)
+            elapsed = time.monotonic() - started
+
+        assert [result.status_code for result in results] == [200] * 8
+        assert farm.stats["max_in_flight"] <= 2
+        assert elapsed >= 7 * 0.05
+
+    def test_connections_should_be_kept_alive_between_fetches(self):
+        with FeedFarm(feed_count=10) as farm:
+            self.fetch(farm, concurrency=1, host_min_interval=0)
+
+        assert farm.stats["requests"] == 10
+        assert farm.stats["connections"] == 1
+
+
+class TestFetchAbort(BaseTest):
+    feed_url = "https://abort.test/feed"
+
+    @pytest.fixture
+    def feed(self, monkeypatch):
+        monkeypatch.setattr(settings, "FEED_MAX_BODY_SIZE", 1024)
+        db = SessionLocal()
+        feed = Feed(url=self.feed_url)
+        feed.save(db)
+        yield db, feed
+        db.query(Feed).filter(Feed.url == self.feed_url).delete()
+        db.commit()
+        db.close()
+
+    def fetch(self, db, feed, **farm_options):
+        with FeedFarm(feed_count=1, entry_count=50, **farm_options) as farm:
+            (result,) = asyncio.run(fetch_feeds([(feed.id, farm.url(0), None)]))
+        self.document = farm.body(0)
+        outcome = store_fetch_result(db, feed, result)
+        assert outcome.status == IngestOutcome.ABORTED
+        assert outcome.parsed is None
+        assert not db.query(FeedEntry).filter(FeedEntry.feed_id == feed.id).count()
+        db.refresh(feed)
+        return result, feed
+
+    def test_too_large_document_should_not_be_downloaded(self, feed):
+        _, feed = self.fetch(*feed)
+        # refused on its Content-Length
+        assert feed.last_error == "%s: %d bytes, more than 1024" % (
+            FetchAborted.TOO_LARGE, len(self.document))
+
+    def test_too_large_chunked_document_should_not_be_downloaded(self, feed):
+        _, feed = self.fetch(*feed, chunked=True, entry_size=2000)
+        # dropped while downloading it
+        assert feed.last_error == "%s: more than 1024 bytes" % FetchAborted.TOO_LARGE
+
+    def test_document_that_is_not_a_feed_should_not_be_downloaded(self, feed):
+        _, feed = self.fetch(*feed, content_type="text/html")
+        assert feed.last_error == "%s: text/html" % FetchAborted.UNSUPPORTED_CONTENT_TYPE
+
+
+class TestEntryListPlan(BaseTest):
+    feed_urls = ["https://plan.test/feed/%d" % i for i in range(50)]
+    entries_per_feed = 1000
+
+    @pytest.fixture
+    def feed_id(self):
+        db = SessionLocal()
+        feeds = [Feed(url=url) for url in self.feed_urls]
+        db.add_all(feeds)
+        db.commit()
+        feed_ids = [feed.id for feed in feeds]
+        db.execute(
+            text(
+                "INSERT INTO entries (feed_id, title, guid_hash, is_active, is_deleted) "
+                "SELECT feed_id, 'entry ' || n, md5(feed_id || '-' || n), true, false "
+                "FROM unnest(:feed_ids) AS feed_id, generate_series(1, :n) AS n"
+            ),
+            {"feed_ids": feed_ids, "n": self.entries_per_feed},
+        )
+        db.execute(text("ANALYZE entries"))
+        db.commit()
+        yield feed_ids[len(feed_ids) // 2]
+        db.query(Feed).filter(Feed.url.in_(self.feed_urls)).delete(
+            synchronize_session=False
+        )
+        db.commit()
+        db.close()
+
+    def test_entry_list_should_not_scan_every_entry(self, feed_id):
+        db = SessionLocal()
+        query = FeedEntryListResponse.entries_query(db, feed_id, 0)
+        first_page = query.limit(10)
+        cursor_page = query.filter(FeedEntry.id < 2 ** 31 - 1).limit(10)
+        for page in (first_page, cursor_page):
+            sql = page.statement.compile(
+                dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+            )
+            plan = "\n".join(row[0] for row in db.execute(text("EXPLAIN %s" % sql)))
+            assert "Seq Scan on entries" not in plan, plan
+        db.close()
+
+
+class TestSearchPaging(BaseTest):
+    feed_url = "https://search.test/feed"
+    username = "search-test"
+
+    def add_entries(self, db, feed_id, guids):
+        ids = []
+        for guid in guids:
+            entry = FeedEntry(feed_id=feed_id, title="paged search", guid_hash=guid)
+            entry.content = ""
+            entry.save(db)
+            ids.append(entry.id)
+        return ids
+
+    @pytest.fixture
+    def subscriber(self):
+        db = SessionLocal()
+        user = User(username=self.username, password="")
+        user.save(db)
+        feed = Feed(url=self.feed_url)
+        feed.save(db)
+        feed.add_subscriber(db, user)
+        yield db, user.id, feed.id
+        db.query(Feed).filter(Feed.url == self.feed_url).delete()
+        db.query(User).filter(User.username == self.username).delete()
+        db.commit()
+        db.close()
+
+    def test_pages_should_not_shift_when_entries_are_stored(self, subscriber, monkeypatch):
+        db, user_id, feed_id = subscriber
+        monkeypatch.setattr(settings, "FEED_SEARCH_MAX_MATCHES", 3)
+        oldest, *newest = self.add_entries(db, feed_id, "abcd")
+
+        first, cursor = SearchResponse.for_user(db, user_id, "paged", 2)
+        self.add_entries(db, feed_id, "ef")
+        second, cursor = SearchResponse.for_user(db, user_id, "paged", 2, cursor)
+
+        seen = [item.id for item in first.__root__ + second.__root__]
+        assert sorted(seen) == newest
+        assert cursor is None
+
+    def test_entries_older_than_the_search_age_should_not_be_found(self, subscriber):
+        db, user_id, feed_id = subscriber
+        old, new = self.add_entries(db, feed_id, "ab")
+        entry = db.get(FeedEntry, old)
+        entry.published_at = datetime.now(timezone.utc) - timedelta(
+            seconds=settings.FEED_SEARCH_MAX_AGE + 60
+        )
+        entry.save(db)
+
+        found, _ = SearchResponse.for_user(db, user_id, "paged", 10)
+        assert [item.id for item in found.__root__] == [new]
+
+
+class TestEntryRetention(BaseTest):
+    feed_url = "https://retention.test/feed"
+    username = "retention-test"
+    # days ago each entry was published
+    ages = [1, 40, 50, 60, 70]
+
+    @pytest.fixture
+    def entries(self):
+        db = SessionLocal()
+        user = User(username=self.username, password="")
+        user.save(db)
+        feed = Feed(url=self.feed_url)
+        feed.save(db)
+        now = datetime.now(timezone.utc)
+        entries = []
+        for age in self.ages:
+            entry = FeedEntry(
+                feed_id=feed.id,
+                title="%d days old" % age,
+                guid_hash=str(age),
+                published_at=now - timedelta(days=age),
+            )
+            entry.content = "retention %d" % age
+            entry.save(db)
+            entries.append(entry.id)
+        yield db, user.id, feed.id, entries
+        db.query(Feed).filter(Feed.url == self.feed_url).delete()
+        db.query(User).filter(User.username == self.username).delete()
+        db.commit()
+        db.close()
+
+    def test_expired_entries_should_be_deleted_with_their_counts(self, entries):
+        db, user_id, feed_id, entry_ids = entries
+        newest, _, read, favorite, oldest = entry_ids
+        UserFeedEntryState.set_read_many(db, [newest, read], user_id, True)
+        UserFeedEntryState.set_favorite_many(db, [favorite], user_id, True)
+        content_hash = db.get(FeedEntry, read).content_hash
+
+        expired = FeedEntry.expired(
+            db,
+            [feed_id],
+            datetime.now(timezone.utc) - timedelta(days=30),
+            keep_last=2,
+            limit=100,
+        )
+        assert sorted(entry.id for entry in expired) == sorted([read, oldest])
+        FeedEntry.delete_many(db, expired)
+        db.commit()
+
+        remaining = db.query(FeedEntry.id).filter(FeedEntry.feed_id == feed_id)
+        assert {entry_id for entry_id, in remaining} == set(entry_ids) - {read, oldest}
+        assert db.get(Feed, feed_id).entry_count == 3
+        assert UserFeedState.get_item(db, feed_id, user_id).read_count == 1
+        assert not db.query(EntryContent).filter(
+            EntryContent.content_hash == content_hash).count()
+
+    def test_expired_entries_should_not_be_stored_again(self, entries, monkeypatch):
+        db, _, feed_id, entry_ids = entries
+        monkeypatch.setattr(settings, "ENTRY_RETENTION_DAYS", 30)
+        feed = db.get(Feed, feed_id)
+        feed.last_entry_at = datetime.now(timezone.utc) - timedelta(days=1)
+        db.commit()
+
+        now = datetime.now(timezone.utc)
+        items = "".join(
+            "<item><title>%s</title><guid>%s</guid><pubDate>%s</pubDate></item>"
+            % (guid, guid, (now - age).strftime("%a, %d %b %Y %H:%M:%S +0000"))
+            for guid, age in (("new", timedelta(hours=1)), ("expired", timedelta(days=50)))
+        )
+        document = (
+            '<?xml version="1.0"?><rss version="2.0"><channel><title>Retention</title>'
+            "%s</channel></rss>" % items
+        ).encode()
+        store_feed_content(db, feed, document)
+        titles = db.query(FeedEntry.title).filter(
+            FeedEntry.feed_id == feed_id, FeedEntry.id.notin_(entry_ids))
+        assert [title for title, in titles] == ["new"]
+
+
+class TestFeedParsing(BaseTest):
+    rss = (
+        b'<?xml version="1.0"?><rss version="2.0"><channel><title>Feed</title>'
+        b"<item><title>New</title><guid>2</guid>"
+        b"<pubDate>Mon, 16 Aug 2021 10:00:00 GMT</pubDate>"
+        b"<description>&lt;b onclick='x()'&gt;hi&lt;/b&gt;</description></item>"
+        b"<item><title>Old</title><guid>1</guid>"
+        b"<pubDate>Sun, 01 Aug 2021 10:00:00 GMT</pubDate></item>"
+        b"<item><title>Older</title><guid>0</guid>"
+        b"<pubDate>Sat, 31 Jul 2021 10:00:00 GMT</pubDate></item>"
+        b"<item><title>Oldest</title><guid>-1</guid>"
+        b"<pubDate>Fri, 30 Jul 2021 10:00:00 GMT</pubDate></item>"
+        b"</channel></rss>"
+    )
+
+    def test_fast_parser_should_match_feedparser_fields(self):
+        parsed = parse_feed(self.rss)
+        assert parsed.title == "Feed"
+        assert [entry["id"] for entry in parsed.entries] == ["2", "1", "0", "-1"]
+        assert parsed.entries[0]["summary"] == "<b>hi</b>"
+        assert parsed.entries[0]["published_at"].day == 16
+
+    def test_fast_parser_should_stop_at_old_entries(self):
+        since = parse_feed(self.rss).entries[0]["published_at"]
+        entries = parse_feed(self.rss, since=since).entries
+        assert [entry["id"] for entry in entries] == ["2", "1", "0"]
+
+    def test_malformed_feed_should_be_invalid(self):
+        assert parse_feed(b"<rss><channel><item></channel>") is None
+
+    def test_parse_processes_should_be_kept_across_runs(self):
+        pool = get_parse_pool(1)
+        assert get_parse_pool(1) is pool
+        assert pool.submit(parse_feed, self.rss).result().title == "Feed"
+        assert IngestPipeline().parse_processes
+
+    def test_daemonic_workers_should_parse_in_threads(self, monkeypatch):
+        monkeypatch.setattr(multiprocessing.current_process(), "daemon", True)
+        assert not IngestPipeline().parse_processes
+
+
+class TestFeedArchive(BaseTest):
+    def test_archived_documents_should_be_listed_by_feed_and_time(self, tmp_path):
+        archive = FeedArchive(LocalArchiveStore("file://%s" % tmp_path))
+        now = datetime.now(timezone.utc)
+        old_key = archive.put(1, now - timedelta(days=2), b"<rss>old</rss>")
+        new_key = archive.put(1, now, b"<rss>new</rss>")
+        archive.put(2, now, b"<rss>other</rss>")
+
+        assert list(archive.keys([1])) == [old_key, new_key]
+        assert list(archive.keys([1], since=now - timedelta(days=1))) == [new_key]
+        assert archive.get(new_key) == b"<rss>new</rss>"
+        assert FeedArchive.parse_key(new_key)[0] == 1
+
+
+class TestWebSub(BaseTest):
+    feed_url = "https://websub.test/feed"
+    document = (
+        b'<?xml version="1.0"?><rss version="2.0" '
+        b'xmlns:atom="http://www.w3.org/2005/Atom"><channel><title>Pushed</title>'
+        b'<atom:link rel="hub" href="%s"/>'
+        b'<atom:link rel="self" href="https://websub.test/feed"/>'
+        b"<item><title>Entry</title><guid>websub-1</guid></item>"
+        b"</channel></rss>"
+    )
+
+    @pytest.fixture
+    def hub(self):
+        # stub hub, records the subscription requests posted to it
+        requests_received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                requests_received.append(parse_qs(body.decode()))
+                self.send_response(202)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield "http://127.0.0.1:%d/" % server.server_port, requests_received
+        server.shutdown()
+
+    @pytest.fixture
+    def feed_id(self, monkeypatch):
+        monkeypatch.setattr(settings, "WEBSUB_CALLBACK_URL", "http://testserver")
+        db = SessionLocal()
+        feed = Feed(url=self.feed_url)
+        feed.save(db)
+        yield feed.id
+        db.query(Feed).filter(Feed.url == self.feed_url).delete()
+        db.commit()
+        db.close()
+
+    def test_pushed_feed_should_be_stored_once_subscribed(self, hub, feed_id):
+        hub_url, hub_requests = hub
+        document = self.document % hub_url.encode()
+        db = SessionLocal()
+        feed = db.get(Feed, feed_id)
+        outcome = store_feed_content(db, feed, document)
+        assert feed.websub_hub == hub_url
+        assert outcome.subscribe
+
+        assert websub.subscribe(db, feed)
+        callback = hub_requests[0]["hub.callback"][0]
+        assert callback == "http://testserver/websub/callback/%d" % feed_id
+        assert hub_requests[0]["hub.topic"] == [self.feed_url]
+
+        res = client.get(
+            callback,
+            params={
+                "hub.mode": "subscribe",
+                "hub.topic": self.feed_url,
+                "hub.challenge": "challenge",
+                "hub.lease_seconds": 3600,
+            },
+        )
+        assert res.text == "challenge"
+        db.refresh(feed)
+        assert feed.push_subscribed
+
+        pushed = document.replace(b"websub-1", b"websub-2")
+        signature = "sha256=" + hmac.new(
+            feed.websub_secret.encode(), pushed, hashlib.sha256
+        ).hexdigest()
+        client.post(callback, data=pushed, headers={"X-Hub-Signature": "sha256=0"})
+        assert client.post(
+            callback, data=pushed, headers={"X-Hub-Signature": signature}
+        ).status_code == 202
+        entries = db.query(FeedEntry).filter(FeedEntry.feed_id == feed_id)
+        assert entries.count() == 2
+        db.close()
+
+    def test_unrequested_subscription_should_not_be_verified(self, feed_id):
+        res = client.get(
+            "/websub/callback/%d" % feed_id,
+            params={
+                "hub.mode": "subscribe",
+                "hub.topic": self.feed_url,
+                "hub.challenge": "challenge",
+            },
+        )
+        assert res.status_code == 404
+
+    def verify(self, feed_id, mode, **params):
+        params.update({"hub.mode": mode, "hub.topic": self.feed_url})
+        return client.get("/websub/callback/%d" % feed_id, params=params)
+
+    def request_subscription(self, feed_id, requested_at):
+        db = SessionLocal()
+        feed = db.get(Feed, feed_id)
+        feed.websub_hub = "http://hub.test/"
+        feed.websub_requested_at = requested_at
+        feed.save(db)
+        db.close()
+
+    def test_lease_should_not_exceed_the_one_asked_for(self, feed_id):
+        now = datetime.now(timezone.utc)
+        self.request_subscription(feed_id, now)
+        res = self.verify(feed_id, "subscribe", **{"hub.lease_seconds": 10 ** 12})
+        assert res.status_code == 200
+        db = SessionLocal()
+        feed = db.get(Feed, feed_id)
+        assert feed.websub_expires_at <= now + timedelta(
+            seconds=settings.WEBSUB_LEASE_SECONDS + 60
+        )
+        assert feed.websub_requested_at is None
+        db.close()
+        # the verification can't be replayed once the subscription is active
+        assert self.verify(feed_id, "subscribe").status_code == 404
+        assert self.verify(feed_id, "denied").status_code == 404
+
+    def test_stale_or_unrequested_verifications_should_be_refused(self, feed_id):
+        stale = datetime.now(timezone.utc) - timedelta(
+            seconds=settings.WEBSUB_RETRY_INTERVAL + 60
+        )
+        self.request_subscription(feed_id, stale)
+        assert self.verify(feed_id, "subscribe").status_code == 404
+        self.request_subscription(feed_id, datetime.now(timezone.utc))
+        assert self.verify(feed_id, "unsubscribe").status_code == 404
+        assert self.verify(feed_id, "denied").status_code == 200
+
+    def test_push_for_a_missing_feed_should_be_gone(self):
+        assert client.post(
+            "/websub/callback/0", data=b"<rss/>"
+        ).status_code == 410
+
+
+class TestMigrations(BaseTest):
+    # the oldest revision the downgrades of the current schema get back to
+    base_revision = "d84121d15868"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    @pytest.fixture
+    def migrations(self, monkeypatch):
+        """
+        A scratch database with the current schema stamped at head, the
+        migrations are run on it by alembic as on a deployed database
+        """
+        name = settings.DB_NAME + "_migrations"
+        admin = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        admin.execute(text("DROP DATABASE IF EXISTS %s WITH (FORCE)" % name))
+        admin.execute(text("CREATE DATABASE %s" % name))
+        scratch = create_engine(engine.url.set(database=name))
+        Base.metadata.create_all(bind=scratch)
+        monkeypatch.setattr(settings, "DB_NAME", name)
+        config = Config(os.path.join(self.root, "alembic.ini"))
+        config.set_main_option("script_location", os.path.join(self.root, "alembic"))
+        command.stamp(config, "head")
+        yield config, scratch
+        scratch.dispose()
+        admin.execute(text("DROP DATABASE %s WITH (FORCE)" % name))
+        admin.close()
+
+    def seed(self, connection):
+        """
+        A user subscribed to a feed, who read, starred and commented one of
+        its entries. returns the entry
+        """
+        user_id = connection.execute(
+            text("INSERT INTO users (username, is_active, is_deleted) VALUES ('migrations', true, false) RETURNING id")
+        ).scalar()
+        feed_id = connection.execute(
+            text("INSERT INTO feeds (url, title, is_active, is_deleted) VALUES ('http://migrations.test/feed', 'Feed', true, false) RETURNING id")
+        ).scalar()
+        connection.execute(
+            text("INSERT INTO user_feed (user_id, feed_id) VALUES (:user_id, :feed_id)"),
+            dict(user_id=user_id, feed_id=feed_id),
+        )
+        entry_id = connection.execute(
+            text(
+                "INSERT INTO entries (feed_id, title, link, content, published_at, is_active, is_deleted) "
+                "VALUES (:feed_id, 'Entry', 'http://migrations.test/entry', 'Entry content', "
+                "now() - interval '2 days', true, false) RETURNING id"
+            ),
+            dict(feed_id=feed_id),
+        ).scalar()
+        connection.execute(
+            text(
+                "INSERT INTO user_feed_entry_states (user_id, feed_entry_id, is_read, is_favorite) "
+                "VALUES (:user_id, :entry_id, true, true)"
+            ),
+            dict(user_id=user_id, entry_id=entry_id),
+        )
+        connection.execute(
+            text(
+                "INSERT INTO comments (user_id, feed_entry_id, content, is_active, is_deleted) "
+                "VALUES (:user_id, :entry_id, 'Comment', true, false)"
+            ),
+            dict(user_id=user_id, entry_id=entry_id),
+        )
+        return entry_id
+
+    def test_seeded_database_should_upgrade_and_downgrade(self, migrations):
+        config, scratch = migrations
+        command.downgrade(config, self.base_revision)
+        with scratch.begin() as connection:
+            entry_id = self.seed(connection)
+
+        command.upgrade(config, "head")
+        with scratch.connect() as connection:
+            entry = connection.execute(
+                text(
+                    "SELECT entries.comment_count, entry_contents.data FROM entries "
+                    "JOIN entry_contents ON entry_contents.content_hash = entries.content_hash "
+                    "WHERE entries.id = :entry_id"
+                ),
+                dict(entry_id=entry_id),
+            ).one()
+            assert entry.comment_count == 1
+            assert zlib.decompress(entry.data) == b"Entry content"
+            assert connection.execute(text("SELECT read_count FROM user_feed_states")).scalar() == 1
+            index = connection.execute(
+                text("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_user_feed_entry_states_feed_entry_id_user_id'")
+            ).scalar()
+            assert "INCLUDE (is_read, is_favorite)" in index
+
+        command.downgrade(config, self.base_revision)
+        with scratch.connect() as connection:
+            assert connection.execute(
+                text("SELECT content FROM entries WHERE id = :entry_id"), dict(entry_id=entry_id)
+            ).scalar() == "Entry content"
+        command.upgrade(config, "head")
+
+    def test_contents_should_move_when_the_app_created_their_table(self, migrations):
+        config, scratch = migrations
+        command.downgrade(config, self.base_revision)
+        with scratch.begin() as connection:
+            entry_id = self.seed(connection)
+        command.upgrade(config, "0a1c5d6e7f48")
+        # the app started with the new models before the migrations were run
+        Base.metadata.create_all(bind=scratch)
+
+        command.upgrade(config, "head")
+        with scratch.connect() as connection:
+            data = connection.execute(
+                text(
+                    "SELECT entry_contents.data FROM entries "
+                    "JOIN entry_contents ON entry_contents.content_hash = entries.content_hash "
+                    "WHERE entries.id = :entry_id"
+                ),
+                dict(entry_id=entry_id),
+            ).scalar()
+            assert zlib.decompress(data) == b"Entry content"
+
+    def test_entries_stored_before_guids_should_keep_their_rows(self, migrations):
+        config, scratch = migrations
+        command.downgrade(config, self.base_revision)
+        with scratch.begin() as connection:
+            entry_id = self.seed(connection)
+            # stored twice, the copy has its reader state too
+            copy_id = connection.execute(
+                text(
+                    "INSERT INTO entries (feed_id, title, link, content, published_at, is_active, is_deleted) "
+                    "SELECT feed_id, title, link, content, published_at, is_active, is_deleted "
+                    "FROM entries WHERE id = :entry_id RETURNING id"
+                ),
+                dict(entry_id=entry_id),
+            ).scalar()
+            connection.execute(
+                text(
+                    "INSERT INTO user_feed_entry_states (user_id, feed_entry_id, is_read, is_favorite) "
+                    "SELECT id, :copy_id, false, true FROM users"
+                ),
+                dict(copy_id=copy_id),
+            )
+        command.upgrade(config, "head")
+
+        published = datetime.now(timezone.utc) - timedelta(days=1)
+        document = (
+            '<?xml version="1.0"?><rss version="2.0"><channel><title>Feed</title>'
+            "<item><title>Entry</title><link>http://migrations.test/entry</link>"
+            "<pubDate>%s</pubDate><description>Entry content</description></item>"
+            "</channel></rss>" % published.strftime("%a, %d %b %Y %H:%M:%S +0000")
+        ).encode()
+        db = Session(bind=scratch)
+        feed = db.query(Feed).one()
+        store_feed_content(db, feed, document)
+        entries = db.query(FeedEntry.id, FeedEntry.guid_hash).order_by(FeedEntry.id).all()
+        # the oldest copy is the one the ingest finds on its link
+        assert entries == [
+            (entry_id, FeedEntry.make_guid_hash("http://migrations.test/entry")),
+            (copy_id, FeedEntry.make_guid_hash("entry:%d" % copy_id)),
+        ]
+        states = db.execute(
+            text("SELECT count(*) FROM user_feed_entry_states WHERE feed_entry_id IN (:a, :b)"),
+            dict(a=entry_id, b=copy_id),
+        ).scalar()
+        assert states == 2
+        db.close()
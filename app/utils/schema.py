@@ -40,5 +40,7 @@ class ErrorResponse(BaseResponse):
 class SuccessResponse(BaseResponse):
     index: Optional[int] = None
     total: Optional[int] = None
+    # opaque, passed back to get the next page of cursor paginated lists
+    cursor: Optional[str] = None
     data: Optional[BaseModel] = None
     success: bool = True
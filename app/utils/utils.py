@@ -1,5 +1,33 @@
+import base64
+import json
 from uuid import uuid4
 
+from app.utils.exceptions import CustomException
+from app.utils.i18n import trans
+
 
 def generate_random_string() -> str:
     return uuid4().hex
+
+
+def encode_cursor(*values) -> str:
+    """
+    Opaque pagination cursor holding the sort key of the last item of a page
+    """
+    data = json.dumps(values, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, *parsers) -> list:
+    """
+    Values of a cursor made by encode_cursor, each one read by its parser
+    (e.g. int), a cursor that doesn't fit them is a bad request
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(parsers):
+            raise ValueError(cursor)
+        return [parse(value) for parse, value in zip(parsers, values)]
+    except (TypeError, ValueError, UnicodeError):
+        raise CustomException(detail=trans("Invalid cursor"))
@@ -0,0 +1,261 @@
+import hashlib
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytz
+
+
+LOREM = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua "
+)
+
+
+# filler text making entries about entry_size bytes larger
+def filler(entry_size: int) -> str:
+    return (LOREM * (entry_size // len(LOREM) + 1))[:entry_size]
+
+
+def build_rss(feed_number: int, entry_count: int = 20, entry_size: int = 0) -> bytes:
+    now = datetime.now(tz=pytz.UTC)
+    items = "".join(
+        "<item>"
+        f"<title>Feed {feed_number} entry {n}</title>"
+        f"<link>http://feeds.local/{feed_number}/{n}</link>"
+        f"<guid>feed-{feed_number}-entry-{n}</guid>"
+        f"<description>Summary of entry {n} {filler(entry_size)}</description>"
+        f"<pubDate>{format_datetime(now - timedelta(hours=i))}</pubDate>"
+        "</item>"
+        # newest first, so entries added by a larger entry_count come on top
+        for i, n in enumerate(range(entry_count - 1, -1, -1))
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0"><channel>'
+        f"<title>Feed {feed_number}</title>"
+        f"<link>http://feeds.local/{feed_number}</link>"
+        "<description>Synthetic benchmark feed</description>"
+        f"{items}</channel></rss>"
+    ).encode()
+
+
+def build_atom(feed_number: int, entry_count: int = 20, entry_size: int = 0) -> bytes:
+    now = datetime.now(tz=pytz.UTC)
+    entries = "".join(
+        "<entry>"
+        f"<title>Feed {feed_number} entry {n}</title>"
+        f'<link rel="alternate" href="http://feeds.local/{feed_number}/{n}"/>'
+        f"<id>urn:feed-{feed_number}:entry-{n}</id>"
+        f"<updated>{(now - timedelta(hours=i)).isoformat()}</updated>"
+        f"<author><name>Author {n}</name></author>"
+        f"<summary>Summary of entry {n} {filler(entry_size)}</summary>"
+        f'<content type="html">&lt;p&gt;Content of entry {n}&lt;/p&gt;</content>'
+        "</entry>"
+        for i, n in enumerate(range(entry_count - 1, -1, -1))
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<feed xmlns="http://www.w3.org/2005/Atom">'
+        f"<title>Feed {feed_number}</title>"
+        f"<id>urn:feed-{feed_number}</id>"
+        f"<updated>{now.isoformat()}</updated>"
+        f"{entries}</feed>"
+    ).encode()
+
+
+class FeedFarm:
+    """
+    Local HTTP server serving synthetic feeds under /feed/<n>.xml
+
+    every atom_every-th feed is atom, the others rss. error_rate of the
+    requests fail with a 500. etag is how validators behave:
+
+    - "none": no validators, every request gets the full document
+    - "stable": an etag that changes with the document, matching
+      If-None-Match requests get a 304
+    - "random": a new etag on every response, for the same document
+
+    documents are served as content_type, chunked ones without a
+    Content-Length
+    """
+
+    ETAG_MODES = ("none", "stable", "random")
+
+    def __init__(
+        self,
+        feed_count: int = 100,
+        entry_count: int = 20,
+        latency: float = 0,
+        entry_size: int = 0,
+        error_rate: float = 0,
+        etag: str = "none",
+        atom_every: int = 0,
+        seed: int = 0,
+        content_type: str = "application/rss+xml",
+        chunked: bool = False,
+    ):
+        if etag not in self.ETAG_MODES:
+            raise ValueError("etag must be one of %s" % ", ".join(self.ETAG_MODES))
+        self.feed_count = feed_count
+        self.entry_count = entry_count
+        self.latency = latency
+        self.entry_size = entry_size
+        self.error_rate = error_rate
+        self.etag = etag
+        self.atom_every = atom_every
+        self.content_type = content_type
+        self.chunked = chunked
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._bodies = {}
+        self._server = None
+        self._thread = None
+        self.stats = dict(
+            requests=0, not_modified=0, errors=0, bytes=0, connections=0,
+            max_in_flight=0,
+        )
+        self._in_flight = 0
+
+    def body(self, feed_number: int) -> bytes:
+        if feed_number not in self._bodies:
+            if self.atom_every and feed_number % self.atom_every == 0:
+                build = build_atom
+            else:
+                build = build_rss
+            self._bodies[feed_number] = build(
+                feed_number, self.entry_count, self.entry_size)
+        return self._bodies[feed_number]
+
+    # new entries on top of every feed, with their own etags
+    def publish(self, entry_count: int = None):
+        self.entry_count += entry_count or 1
+        self._bodies = {}
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    # how many requests are served at the same time, at most
+    def _enter(self):
+        with self._lock:
+            self._in_flight += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self._in_flight)
+
+    def _leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _handler(self):
+        farm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                farm._count("connections")
+
+            def do_GET(self):
+                farm._count("requests")
+                farm._enter()
+                try:
+                    self._serve()
+                finally:
+                    farm._leave()
+
+            def _serve(self):
+                try:
+                    feed_number = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+                except ValueError:
+                    feed_number = -1
+                if not 0 <= feed_number < farm.feed_count:
+                    self.send_error(404)
+                    return
+                if farm.latency:
+                    time.sleep(farm.latency)
+                if farm._fails():
+                    farm._count("errors")
+                    self.send_error(500)
+                    return
+                body = farm.body(feed_number)
+                etag = None
+                if farm.etag == "stable":
+                    etag = '"%s"' % hashlib.md5(body).hexdigest()
+                elif farm.etag == "random":
+                    etag = '"%016x"' % random.getrandbits(64)
+                if etag and self.headers.get("If-None-Match") == etag:
+                    farm._count("not_modified")
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", farm.content_type)
+                if farm.chunked:
+                    self.send_header("Transfer-Encoding", "chunked")
+                else:
+                    self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                try:
+                    if farm.chunked:
+                        self._write_chunked(body)
+                    else:
+                        self.wfile.write(body)
+                # clients may hang up on documents they don't want
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+                    return
+                farm._count("bytes", len(body))
+
+            def _write_chunked(self, body: bytes, chunk_size: int = 16 * 1024):
+                for i in range(0, len(body), chunk_size):
+                    chunk = body[i: i + chunk_size]
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, feed_number: int) -> str:
+        return f"{self.base_url}/feed/{feed_number}.xml"
+
+    def urls(self):
+        return [self.url(i) for i in range(self.feed_count)]
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,65 @@
+"""
+Compares sequential blocking fetches (the old feed_parser behaviour)
+with the asyncio batch fetcher used by feed_batch_parser
+
+    python -m benchmarks.fetch_benchmark --feeds 500 --latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+import requests
+
+from app.reader.fetcher import fetch_feeds
+from benchmarks.feed_farm import FeedFarm
+
+
+def run_sequential(urls, session=requests):
+    started = time.monotonic()
+    for url in urls:
+        session.get(url, timeout=10)
+    return time.monotonic() - started
+
+
+def run_batch(urls, concurrency):
+    started = time.monotonic()
+    results = asyncio.run(
+        fetch_feeds(
+            ((i, url, None) for i, url in enumerate(urls)),
+            concurrency=concurrency,
+            timeout=10,
+            # every farm feed lives on the same host
+            host_concurrency=concurrency,
+            host_min_interval=0,
+        )
+    )
+    elapsed = time.monotonic() - started
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RuntimeError("%d fetches failed: %r" % (len(failed), failed[0].error))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--feeds", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+
+    with FeedFarm(args.feeds, args.entries, args.latency) as farm:
+        urls = farm.urls()
+        if not args.skip_sequential:
+            elapsed = run_sequential(urls)
+            print("sequential:        %8.1f feeds/sec" % (len(urls) / elapsed))
+            with requests.Session() as session:
+                elapsed = run_sequential(urls, session)
+            print("sequential pooled: %8.1f feeds/sec" % (len(urls) / elapsed))
+        elapsed = run_batch(urls, args.concurrency)
+        print("batch:             %8.1f feeds/sec" % (len(urls) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
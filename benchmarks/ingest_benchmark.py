@@ -0,0 +1,180 @@
+"""
+End to end ingest benchmark: feed_distributor -> feed_batch_parser ->
+ingest pipeline, with celery in eager mode, against a local feed farm and
+a local postgres
+
+    DB_HOST=localhost python -m benchmarks.ingest_benchmark --feeds 1000 \\
+        --latency 0.05 --etag stable --error-rate 0.01 --output result.json
+
+the distributor claims every due feed of the database, so point it to a
+scratch database. each round makes all the benchmark feeds due and runs
+one scheduler tick, the first round is cold, the following ones exercise
+the conditional requests (see --etag) and --publish adds new entries to
+every feed between rounds. results are printed (or written) as json
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+
+from app.core.celery_utils import celery_app
+from app.core.config import settings
+from app.core.database import SessionLocal, engine, setup_db
+from app.reader.models import Feed, FeedEntry
+from app.reader.tasks import feed_distributor
+from benchmarks.feed_farm import FeedFarm
+
+
+class StatementCounter:
+    """
+    Counts the statements sent to the database, i.e. its round trips
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, "before_cursor_execute", self)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+def create_feeds(urls):
+    db = SessionLocal()
+    feeds = [Feed(url=url) for url in urls]
+    db.add_all(feeds)
+    db.commit()
+    feed_ids = [feed.id for feed in feeds]
+    db.close()
+    return feed_ids
+
+
+def delete_feeds(feed_ids):
+    db = SessionLocal()
+    db.query(Feed).filter(Feed.id.in_(feed_ids)).delete(synchronize_session=False)
+    db.commit()
+    db.close()
+
+
+def count_entries(db, feed_ids):
+    return db.query(FeedEntry).filter(FeedEntry.feed_id.in_(feed_ids)).count()
+
+
+def run_round(farm, feed_ids):
+    db = SessionLocal()
+    db.query(Feed).filter(Feed.id.in_(feed_ids)).update(
+        {Feed.next_fetch_at: datetime.now(timezone.utc)}, synchronize_session=False
+    )
+    db.commit()
+    entries_before = count_entries(db, feed_ids)
+    farm_before = dict(farm.stats)
+
+    with StatementCounter() as statements:
+        started = time.perf_counter()
+        feed_distributor()
+        elapsed = time.perf_counter() - started
+
+    entries = count_entries(db, feed_ids) - entries_before
+    fetches = db.query(Feed.last_fetch_status, Feed.last_fetch_elapsed).filter(
+        Feed.id.in_(feed_ids)
+    ).all()
+    db.close()
+    latencies = [elapsed_ * 1000 for _, elapsed_ in fetches if elapsed_ is not None]
+    return dict(
+        feeds=len(feed_ids),
+        elapsed=round(elapsed, 3),
+        feeds_per_sec=round(len(feed_ids) / elapsed, 1),
+        entries=entries,
+        entries_per_sec=round(entries / elapsed, 1),
+        db_round_trips=statements.count,
+        db_round_trips_per_feed=round(statements.count / len(feed_ids), 2),
+        fetch_latency_ms_p50=percentile(latencies, 50),
+        fetch_latency_ms_p99=percentile(latencies, 99),
+        statuses=dict(Counter(status for status, _ in fetches)),
+        farm={name: farm.stats[name] - farm_before[name] for name in farm.stats},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--feeds", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=20)
+    parser.add_argument("--entry-size", type=int, default=500,
+                        help="extra bytes of text per entry")
+    parser.add_argument("--atom-every", type=int, default=4,
+                        help="every n-th feed is atom, 0 for rss only")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--etag", choices=FeedFarm.ETAG_MODES, default="stable")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--publish", type=int, default=0,
+                        help="entries published to every feed between rounds")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--shard-size", type=int, default=settings.FEED_SHARD_SIZE)
+    parser.add_argument("--output", help="file to write the json results to")
+    args = parser.parse_args()
+
+    celery_app.conf.task_always_eager = True
+    # every farm feed lives on the same host, lift the politeness limits
+    settings.FEED_HOST_CONCURRENCY = args.concurrency
+    settings.FEED_HOST_MIN_INTERVAL = 0
+    settings.FEED_FETCH_CONCURRENCY = args.concurrency
+    settings.FEED_SHARD_SIZE = args.shard_size
+    setup_db()
+
+    farm = FeedFarm(
+        args.feeds,
+        args.entries,
+        latency=args.latency,
+        entry_size=args.entry_size,
+        error_rate=args.error_rate,
+        etag=args.etag,
+        atom_every=args.atom_every,
+    )
+    rounds = []
+    with farm:
+        feed_ids = create_feeds(farm.urls())
+        try:
+            for i in range(args.rounds):
+                if i and args.publish:
+                    farm.publish(args.publish)
+                rounds.append(run_round(farm, feed_ids))
+        finally:
+            delete_feeds(feed_ids)
+
+    result = dict(
+        config={
+            name: value for name, value in vars(args).items() if name != "output"
+        },
+        rounds=rounds,
+    )
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
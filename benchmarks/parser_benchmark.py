@@ -0,0 +1,68 @@
+"""
+Compares feedparser with the fast lxml parser used by the ingest
+
+    python -m benchmarks.parser_benchmark --corpus path/to/recorded/feeds
+    python -m benchmarks.parser_benchmark --archive file:///path/to/archive
+
+without --corpus or --archive a synthetic corpus of rss and atom documents
+is used
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import feedparser
+
+from app.core.config import settings
+from app.reader.archive import get_archive
+from app.reader.parsers import parse_feed
+from benchmarks.feed_farm import build_atom, build_rss
+
+
+def load_corpus(path, archive_url=None):
+    if archive_url:
+        settings.ARCHIVE_URL = archive_url
+        archive = get_archive()
+        return [archive.get(key) for key in archive.keys()]
+    if path:
+        return [item.read_bytes() for item in sorted(Path(path).iterdir()) if item.is_file()]
+    return [build_rss(i, 10 + i % 90) for i in range(50)] + [
+        build_atom(i, 10 + i % 90) for i in range(50)
+    ]
+
+
+def measure(parse, corpus, repeat):
+    started = time.perf_counter()
+    entries = 0
+    for _ in range(repeat):
+        for document in corpus:
+            entries += len(parse(document).entries)
+    elapsed = time.perf_counter() - started
+    return len(corpus) * repeat / elapsed, entries / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", help="directory of recorded feed documents")
+    parser.add_argument("--archive", help="url of an archive of fetched documents")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.archive)
+    size = sum(len(document) for document in corpus)
+    print("corpus: %d documents, %.1f MB" % (len(corpus), size / 1024 / 1024))
+
+    since = datetime.now(timezone.utc) - timedelta(hours=5)
+    runs = (
+        ("feedparser", feedparser.parse),
+        ("fast", parse_feed),
+        ("fast, stopping at 5h old", lambda document: parse_feed(document, since)),
+    )
+    for name, parse in runs:
+        documents, entries = measure(parse, corpus, args.repeat)
+        print("%-25s %8.1f documents/sec %10.1f entries/sec" % (name, documents, entries))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Full text search benchmark on a synthetic corpus, against a local postgres
+
+    DB_HOST=localhost DB_NAME=search python -m benchmarks.search_benchmark \\
+        --entries 20000000 --feeds 20000 --subscriptions 300 --keep --output result.json
+
+the corpus is generated by postgres itself: entries made of pseudo words
+drawn from a skewed (zipf like) vocabulary, so there are very common, mid
+and rare terms, spread over the feeds and --days, with their search vectors
+computed like ingest does (they have no content). a benchmark user
+subscribes to some of the feeds and searches them through
+SearchResponse.for_user, like the /feed_entry/search endpoint does.
+
+the entry indexes are dropped while the corpus is loaded and built again
+at the end, run it against a scratch database. pass --keep to leave the
+corpus for the next runs. results are printed (or written) as json
+"""
+import argparse
+import json
+import math
+import random
+import time
+
+from sqlalchemy import text
+
+from app.authnz.models import User
+from app.core.config import settings
+from app.core.database import SessionLocal, setup_db
+from app.reader.models import Feed, FeedEntry, user_feed_table
+from app.reader.schemas import SearchResponse
+from benchmarks.ingest_benchmark import percentile
+
+
+USERNAME = "search-benchmark"
+FEED_URL = "https://search.benchmark/feed/%d"
+SYLLABLES = [
+    consonant + vowel
+    for consonant in "bdfgklmnprstvz"
+    for vowel in ["a", "e", "i", "o", "u", "ai", "ou"]
+]
+
+# the words of the vocabulary are 3 syllables, the digits of their number
+# in base len(SYLLABLES). entries draw the rank of their words, the stride
+# maps it to a number so which words are common is random
+WORD = (
+    "syllables[1 + number % {base}] || syllables[1 + number / {base} % {base}]"
+    " || syllables[1 + number / {base} / {base} % {base}]"
+).format(base=len(SYLLABLES))
+
+WORDS = """(SELECT string_agg({word}, ' ') FROM (
+            SELECT floor(power(random(), 3) * :vocabulary)::bigint * :stride % :vocabulary AS number
+            FROM generate_series(1, :{count}) WHERE g IS NOT NULL
+        ) AS draws)"""
+
+INSERT_ENTRIES = """
+INSERT INTO entries (feed_id, title, summary, guid_hash, published_at, is_active, is_deleted, search_vector)
+SELECT
+    feed_id, title, summary, guid_hash, published_at, true, false,
+    setweight(to_tsvector('english', title), 'A') ||
+    setweight(to_tsvector('english', summary), 'B')
+FROM (
+    SELECT
+        (:feed_ids)[1 + g % cardinality(:feed_ids)] AS feed_id,
+        {title} AS title,
+        {summary} AS summary,
+        md5(g::text) AS guid_hash,
+        -- newer entries get higher ids, as they do when they are fetched
+        now() - (:entries - g) * :interval * interval '1 second' AS published_at
+    FROM generate_series(:start, :stop) AS g, CAST(:syllables AS text[]) AS syllables
+) AS generated
+""".format(
+    title=WORDS.format(word=WORD, count="title_words"),
+    summary=WORDS.format(word=WORD, count="summary_words"),
+)
+
+
+class Vocabulary:
+    """
+    The words INSERT_ENTRIES draws, by rank: the first ones are in a good
+    part of the entries and the last ones in very few
+    """
+
+    def __init__(self, size: int, seed: int):
+        assert size <= len(SYLLABLES) ** 3
+        self.size = size
+        self.stride = random.Random(seed).randrange(1, size)
+        while math.gcd(self.stride, size) != 1:
+            self.stride += 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, rank):
+        if isinstance(rank, slice):
+            return [self[i] for i in range(*rank.indices(self.size))]
+        number = rank % self.size * self.stride % self.size
+        base = len(SYLLABLES)
+        return "".join(
+            SYLLABLES[number // base ** digit % base] for digit in range(3)
+        )
+
+
+def create_corpus(db, args, vocabulary):
+    user = User(username=USERNAME, password="")
+    user.save(db)
+    feeds = [Feed(url=FEED_URL % i) for i in range(args.feeds)]
+    db.add_all(feeds)
+    db.commit()
+    feed_ids = [feed.id for feed in feeds]
+    rng = random.Random(args.seed)
+    db.execute(
+        user_feed_table.insert(),
+        [
+            {"user_id": user.id, "feed_id": feed_id}
+            for feed_id in rng.sample(feed_ids, min(args.subscriptions, len(feed_ids)))
+        ],
+    )
+    db.commit()
+
+    started = time.perf_counter()
+    # loaded without the entry indexes, which are built once at the end
+    indexes = FeedEntry.__table__.indexes
+    for index in indexes:
+        index.drop(bind=db.get_bind(), checkfirst=True)
+    for start in range(0, args.entries, args.chunk_size):
+        db.execute(
+            text(INSERT_ENTRIES),
+            dict(
+                feed_ids=feed_ids,
+                syllables=SYLLABLES,
+                vocabulary=len(vocabulary),
+                stride=vocabulary.stride,
+                title_words=args.title_words,
+                summary_words=args.summary_words,
+                entries=args.entries,
+                interval=args.days * 24 * 60 * 60 / args.entries,
+                start=start,
+                stop=min(start + args.chunk_size, args.entries) - 1,
+            ),
+        )
+        db.commit()
+        print("generated %d entries" % min(start + args.chunk_size, args.entries))
+    for index in indexes:
+        print("building %s" % index.name)
+        index.create(bind=db.get_bind())
+    db.execute(text("ANALYZE entries"))
+    db.commit()
+    return user.id, time.perf_counter() - started
+
+
+def delete_corpus(db):
+    # the entries go with their feeds
+    db.query(Feed).filter(Feed.url.like(FEED_URL.replace("%d", "%"))).delete(
+        synchronize_session=False
+    )
+    db.query(User).filter(User.username == USERNAME).delete(synchronize_session=False)
+    db.commit()
+
+
+def make_queries(vocabulary, count, seed):
+    # the generator draws vocabulary[n * random() ** 3], so the first words
+    # are in a good part of the entries and the last ones in very few
+    rng = random.Random(seed)
+    n = len(vocabulary)
+    bands = {
+        "common": vocabulary[: n // 100],
+        "mid": vocabulary[n // 10: n // 4],
+        "rare": vocabulary[-(n // 10):],
+    }
+    queries = {
+        name: [rng.choice(words) for _ in range(count)]
+        for name, words in bands.items()
+    }
+    queries["two_words"] = [
+        "%s %s" % (rng.choice(bands["mid"]), rng.choice(bands["common"]))
+        for _ in range(count)
+    ]
+    queries["phrase"] = [
+        '"%s %s"' % (rng.choice(bands["common"]), rng.choice(bands["common"]))
+        for _ in range(count)
+    ]
+    queries["exclusion"] = [
+        "%s -%s" % (rng.choice(bands["mid"]), rng.choice(bands["common"]))
+        for _ in range(count)
+    ]
+    return queries
+
+
+def run_queries(db, user_id, queries, total, pages):
+    latencies, results = [], 0
+    for query in queries:
+        cursor = None
+        for _ in range(pages):
+            started = time.perf_counter()
+            items, cursor = SearchResponse.for_user(db, user_id, query, total, cursor)
+            latencies.append((time.perf_counter() - started) * 1000)
+            results += len(items.__root__)
+            if not cursor:
+                break
+    return dict(
+        searches=len(latencies),
+        results=results,
+        latency_ms_p50=round(percentile(latencies, 50), 2),
+        latency_ms_p95=round(percentile(latencies, 95), 2),
+        latency_ms_p99=round(percentile(latencies, 99), 2),
+        latency_ms_max=round(max(latencies), 2),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--feeds", type=int, default=2000)
+    parser.add_argument("--subscriptions", type=int, default=300)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--title-words", type=int, default=8)
+    parser.add_argument("--summary-words", type=int, default=40)
+    parser.add_argument("--days", type=int, default=730,
+                        help="the entries are published over that many days")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=50,
+                        help="searches of every kind")
+    parser.add_argument("--total", type=int, default=20, help="page size")
+    parser.add_argument("--pages", type=int, default=2,
+                        help="pages fetched through the cursor per search")
+    parser.add_argument("--max-matches", type=int,
+                        default=settings.FEED_SEARCH_MAX_MATCHES)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true",
+                        help="leave the corpus, and reuse it when it exists")
+    parser.add_argument("--output", help="file to write the json results to")
+    args = parser.parse_args()
+
+    settings.FEED_SEARCH_MAX_MATCHES = args.max_matches
+    setup_db()
+    vocabulary = Vocabulary(args.vocabulary, args.seed)
+    db = SessionLocal()
+    generation = None
+    user = User.get_user_by_username(db, USERNAME)
+    if user is None:
+        user_id, generation = create_corpus(db, args, vocabulary)
+    else:
+        user_id = user.id
+        print("reusing the existing corpus, its size options are ignored")
+
+    try:
+        result = dict(
+            config={
+                name: value
+                for name, value in vars(args).items()
+                if name not in ("output", "keep")
+            },
+            generation_sec=round(generation, 1) if generation else None,
+            searches={
+                name: run_queries(db, user_id, queries, args.total, args.pages)
+                for name, queries in make_queries(
+                    vocabulary, args.queries, args.seed
+                ).items()
+            },
+        )
+    finally:
+        if not args.keep:
+            delete_corpus(db)
+        db.close()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()